@@ -0,0 +1,271 @@
+from collections import OrderedDict
+
+import h5py
+import numpy as np
+from six.moves import cPickle
+
+import logging
+logger = logging.getLogger(__name__)
+
+CODE_BITS = 16  # bits per word in an n-gram code, 4-grams fill an uint64
+
+
+def caption_tokens(captions, use_eos=0):
+    """
+    The words utils.array_to_str keeps of every row of captions (num_captions, seq_length):
+    the words before the first <eos> (0), plus the <eos> itself with use_eos 1, without <bos> (1) tokens
+    returns them left aligned in a (num_captions, max_length) array and their lengths
+    """
+    captions = np.asarray(captions, dtype=np.int64).reshape(len(captions), -1)
+    is_eos = captions == 0
+    keep = (np.cumsum(is_eos, axis=1) - is_eos == 0) & (captions != 1)
+    if not use_eos:
+        keep &= ~is_eos
+    lengths = keep.sum(1)
+    tokens = np.zeros((len(captions), max(int(lengths.max()) if len(captions) else 0, 1)), dtype=np.int64)
+    rows, cols = np.nonzero(keep)
+    tokens[rows, (np.cumsum(keep, axis=1) - 1)[rows, cols]] = captions[rows, cols]
+    return tokens, lengths
+
+
+def check_word_ids(max_word, source):
+    """n-gram codes hold word + 1 in CODE_BITS bits, larger word ids would collide silently"""
+    if max_word + 1 >= 2 ** CODE_BITS:
+        raise ValueError('%s has word id %d, CIDEr-D n-gram codes (CODE_BITS %d) hold word ids up to %d'
+                         % (source, max_word, CODE_BITS, 2 ** CODE_BITS - 2))
+
+
+def ngram_codes(tokens, lengths, n):
+    """
+    Every n-gram of the captions packed into one uint64 (word + 1 per CODE_BITS bits, so n-grams of different
+    orders never collide), returns the caption each one belongs to and the codes
+    """
+    width = tokens.shape[1] - n + 1
+    if width <= 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint64)
+    codes = np.zeros((len(tokens), width), dtype=np.uint64)
+    for k in range(n):
+        codes = (codes << np.uint64(CODE_BITS)) | (tokens[:, k:k + width] + 1).astype(np.uint64)
+    caps, starts = np.nonzero(np.arange(width)[None, :] + n <= lengths[:, None])
+    return caps, codes[caps, starts]
+
+
+class CiderD(object):
+    """
+    CIDEr-D on token id arrays, n-grams are hashed to integers and all captions of a batch are scored at once
+    Document frequencies come from a *_train_ciderdf.pkl file (n-grams of array_to_str strings),
+    scores are those of pycocoevalcap's Cider(df=...) on the array_to_str strings of the same captions
+    """
+
+    def __init__(self, df, n=4, sigma=6.0, cache_videos=0):
+        if n * CODE_BITS > 64:
+            raise ValueError('CIDEr-D n-gram codes (CODE_BITS %d) fit n-grams up to %d words, not %d'
+                             % (CODE_BITS, 64 // CODE_BITS, n))
+        self.n = n
+        self.sigma = sigma
+        # with cache_videos > 0 the reference vectors of that many videos are kept, see ReferenceCache
+        self.cache = ReferenceCache(self, cache_videos) if cache_videos > 0 else None
+
+        pkl_file = cPickle.load(open(df, 'rb'))
+        self.ref_len = np.log(float(pkl_file['ref_len']))
+        document_frequency = pkl_file['document_frequency']
+        codes = np.zeros(len(document_frequency), dtype=np.uint64)
+        values = np.zeros(len(document_frequency), dtype=np.float64)
+        max_word = 0
+        for ii, (ngram, freq) in enumerate(document_frequency.items()):
+            code = 0
+            for word in ngram:
+                max_word = max(max_word, int(word))
+                code = (code << CODE_BITS) | (int(word) + 1)
+            codes[ii] = code
+            values[ii] = freq
+        check_word_ids(max_word, df)
+        order = np.argsort(codes)
+        self.df_codes = codes[order]
+        self.df_values = values[order]
+        logger.info('Loaded document frequencies of %d n-grams from %s', len(self.df_codes), df)
+
+    def _idf(self, codes):
+        pos = np.minimum(np.searchsorted(self.df_codes, codes), max(len(self.df_codes) - 1, 0))
+        found = self.df_codes[pos] == codes if len(self.df_codes) else np.zeros(len(codes), dtype=bool)
+        # give word count 1 if it doesn't appear in reference corpus
+        return self.ref_len - np.log(np.maximum(1.0, np.where(found, self.df_values[pos], 0.0)))
+
+    def vectors(self, captions, use_eos=0):
+        """
+        tf-idf vectors of the captions as (caption, order, code, value) entries,
+        with the norm of every caption and order (num_captions, n) and the caption lengths counted as CIDEr-D does
+        """
+        tokens, lengths = caption_tokens(captions, use_eos)
+        check_word_ids(int(tokens.max()), 'the captions')
+        caps, orders, codes = [], [], []
+        for n in range(1, self.n + 1):
+            cur_caps, cur_codes = ngram_codes(tokens, lengths, n)
+            caps.append(cur_caps)
+            codes.append(cur_codes)
+            orders.append(np.full(len(cur_caps), n - 1, dtype=np.int64))
+        caps, orders, codes = np.concatenate(caps), np.concatenate(orders), np.concatenate(codes)
+
+        # term frequencies: count the repeats of each (caption, code)
+        order = np.lexsort((codes, caps))
+        caps, orders, codes = caps[order], orders[order], codes[order]
+        first = np.ones(len(caps), dtype=bool)
+        first[1:] = (caps[1:] != caps[:-1]) | (codes[1:] != codes[:-1])
+        starts = np.nonzero(first)[0]
+        term_freq = np.diff(np.append(starts, len(caps)))
+        caps, orders, codes = caps[starts], orders[starts], codes[starts]
+
+        values = term_freq * self._idf(codes)
+        norms = np.sqrt(np.bincount(caps * self.n + orders, weights=values ** 2,
+                                    minlength=len(lengths) * self.n)).reshape(len(lengths), self.n)
+        # CIDEr-D measures the length in bigrams
+        return (caps, orders, codes, values), norms, np.maximum(lengths - 1, 0)
+
+    def reference_vectors(self, gts, use_eos=0):
+        """vectors() of the reference captions, split into one (entries, norms, lengths) tuple per video"""
+        num_refs = np.array([len(refs) for refs in gts], dtype=np.int64)
+        width = max(refs.shape[1] for refs in gts)
+        refs = np.concatenate([np.pad(refs, ((0, 0), (0, width - refs.shape[1])), 'constant') for refs in gts])
+        (caps, orders, codes, values), norms, lengths = self.vectors(refs, use_eos)
+
+        ref_end = np.cumsum(num_refs)
+        bounds = np.searchsorted(caps, np.concatenate([[0], ref_end]))
+        out = []
+        for ii in range(len(gts)):
+            start, end = ref_end[ii] - num_refs[ii], ref_end[ii]
+            cur = slice(bounds[ii], bounds[ii + 1])
+            entries = ((caps[cur] - start).astype(np.int32), orders[cur].astype(np.int8), codes[cur], values[cur])
+            out.append((entries, norms[start:end], lengths[start:end]))
+        return out
+
+    def compute_scores(self, res, gts, gts_index=None, use_eos=0, video_ids=None):
+        """
+        res: token ids of the captions to score (num_captions, seq_length)
+        gts: the reference captions of every video, a list of (num_refs, seq_length) arrays
+        gts_index: the video of each caption (default: caption i is of video i)
+        video_ids: the ids of the videos of gts, to look their reference vectors up in the cache
+        returns the mean score and the score of every caption, like pycocoevalcap's Cider.compute_score
+        """
+        res = np.asarray(res)
+        num_res = len(res)
+        gts_index = np.arange(num_res) if gts_index is None else np.asarray(gts_index, dtype=np.int64)
+        if num_res == 0:
+            return 0.0, np.zeros(0)
+
+        if self.cache is not None and video_ids is not None:
+            videos = self.cache.get(video_ids, gts, use_eos)
+        else:
+            videos = self.reference_vectors(gts, use_eos)
+        num_refs = np.array([len(lengths) for _, _, lengths in videos], dtype=np.int64)
+        ref_start = np.concatenate([[0], np.cumsum(num_refs)[:-1]])
+        ref_video = np.repeat(np.arange(len(videos)), num_refs)
+        r_caps = np.concatenate([entries[0] + start for (entries, _, _), start in zip(videos, ref_start)]).astype(np.int64)
+        r_orders, r_codes, r_values = [np.concatenate([entries[k] for entries, _, _ in videos]) for k in range(1, 4)]
+        r_orders = r_orders.astype(np.int64)
+        r_norms = np.concatenate([norms for _, norms, _ in videos])
+        r_lengths = np.concatenate([lengths for _, _, lengths in videos])
+
+        (h_caps, h_orders, h_codes, h_values), h_norms, h_lengths = self.vectors(res, use_eos)
+
+        # match the n-grams of each caption with those of the references of its video
+        uniq, inverse = np.unique(np.concatenate([h_codes, r_codes]), return_inverse=True)
+        h_keys = gts_index[h_caps] * len(uniq) + inverse[:len(h_codes)]
+        r_keys = ref_video[r_caps] * len(uniq) + inverse[len(h_codes):]
+        r_order = np.argsort(r_keys, kind='stable')
+        r_sorted = r_keys[r_order]
+        lo = np.searchsorted(r_sorted, h_keys, 'left')
+        matches = np.searchsorted(r_sorted, h_keys, 'right') - lo
+        h_entry = np.repeat(np.arange(len(h_keys)), matches)
+        r_entry = r_order[np.repeat(lo - np.cumsum(matches) + matches, matches) + np.arange(matches.sum())]
+
+        # (caption, reference) pairs of every caption with all references of its video
+        pair_counts = num_refs[gts_index]
+        pair_start = np.cumsum(pair_counts) - pair_counts
+        pair_res = np.repeat(np.arange(num_res), pair_counts)
+        pair_ref = ref_start[gts_index[pair_res]] + np.arange(pair_counts.sum()) - pair_start[pair_res]
+
+        # vrama91 : added clipping
+        overlap = np.minimum(h_values[h_entry], r_values[r_entry]) * r_values[r_entry]
+        pair = pair_start[h_caps[h_entry]] + r_caps[r_entry] - ref_start[ref_video[r_caps[r_entry]]]
+        val = np.bincount(pair * self.n + h_orders[h_entry], weights=overlap,
+                          minlength=len(pair_res) * self.n).reshape(len(pair_res), self.n)
+        norm = h_norms[pair_res] * r_norms[pair_ref]
+        val = np.divide(val, norm, out=val, where=norm != 0)
+        # vrama91: added a length based gaussian penalty
+        delta = (h_lengths[pair_res] - r_lengths[pair_ref]).astype(np.float64)
+        val *= np.exp(-(delta ** 2) / (2 * self.sigma ** 2))[:, None]
+
+        # mean of ngram scores, averaged over the references, times 10
+        scores = np.bincount(pair_res, weights=val.mean(1), minlength=num_res) / pair_counts * 10.0
+        return np.mean(scores), scores
+
+    def method(self):
+        return "CIDEr-D"
+
+
+class ReferenceCache(object):
+    """
+    Reference vectors (see CiderD.reference_vectors) of up to max_videos videos keyed by video id,
+    references never change, so every video is cooked once. The least recently used videos are dropped first
+    Filled lazily from the batches, or ahead of time from a label h5 file with precompute
+    """
+
+    def __init__(self, scorer, max_videos):
+        self.scorer = scorer
+        self.max_videos = max_videos
+        self.videos = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _put(self, key, value):
+        self.videos[key] = value
+        while len(self.videos) > self.max_videos:
+            self.videos.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, video_ids, gts, use_eos=0):
+        """Reference vectors of the videos, the ones not cached yet are computed from gts in one go"""
+        keys = [(int(video_id), use_eos) for video_id in video_ids]
+        missing = [ii for ii, key in enumerate(keys) if key not in self.videos]
+        computed = {}
+        if missing:
+            for ii, value in zip(missing, self.scorer.reference_vectors([gts[ii] for ii in missing], use_eos)):
+                computed[keys[ii]] = value
+        self.misses += len(missing)
+        self.hits += len(keys) - len(missing)
+
+        out = []
+        for key in keys:
+            if key in computed:
+                out.append(computed[key])
+            else:
+                self.videos.move_to_end(key)
+                out.append(self.videos[key])
+        for key, value in computed.items():
+            self._put(key, value)
+        return out
+
+    def precompute(self, label_h5, use_eos=0, chunk_size=512):
+        """Cook the references of every video of a label h5 file (as many as fit)"""
+        with h5py.File(label_h5, 'r') as f:
+            videos = [int(v) for v in f['videos'][()]]
+            starts = f['label_start_ix'][()]
+            ends = f['label_end_ix'][()]
+            labels = f['labels'][()]
+        videos = videos[:self.max_videos]
+        for ii in range(0, len(videos), chunk_size):
+            cur = range(ii, min(ii + chunk_size, len(videos)))
+            gts = [labels[starts[jj]:ends[jj]] for jj in cur]
+            for jj, value in zip(cur, self.scorer.reference_vectors(gts, use_eos)):
+                self._put((videos[jj], use_eos), value)
+        logger.info('Cached the reference vectors of %d videos from %s (%.1f MB)', len(videos), label_h5, self.nbytes() / 2. ** 20)
+
+    def nbytes(self):
+        return sum(sum(a.nbytes for a in entries) + norms.nbytes + lengths.nbytes
+                   for entries, norms, lengths in self.videos.values())
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'videos': len(self.videos), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': self.hits / float(total) if total else 0.0, 'mbytes': self.nbytes() / 2. ** 20}
@@ -167,8 +167,9 @@ class CiderScorer(object):
                 val[n] *= np.e**(-(delta**2)/(2*self.sigma**2))
             return val
 
-        # compute log reference length
-        self.ref_len = np.log(float(len(self.crefs)))
+        # compute log reference length, unless it came with the document frequencies
+        if self.ref_len is None:
+            self.ref_len = np.log(float(len(self.crefs)))
 
         scores = []
         for test, refs in zip(self.ctest, self.crefs):
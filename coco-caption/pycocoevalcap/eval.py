@@ -1,10 +1,6 @@
 __author__ = 'tylin'
 from .tokenizer.ptbtokenizer import PTBTokenizer
-from .bleu.bleu import Bleu
-from .meteor.meteor import Meteor
-from .rouge.rouge import Rouge
-from .cider.cider import Cider
-from .spice.spice import Spice
+from .scorers import get_scorer
 
 
 class COCOEvalCap:
@@ -38,11 +34,11 @@ class COCOEvalCap:
         # =================================================
         print('setting up scorers...')
         scorers = [
-            (Bleu(4), ["Bleu_1", "Bleu_2", "Bleu_3", "Bleu_4"]),
-            (Meteor(),"METEOR"),
-            (Rouge(), "ROUGE_L"),
-            (Cider(), "CIDEr"),
-            (Spice(), "SPICE")
+            (get_scorer('Bleu'), ["Bleu_1", "Bleu_2", "Bleu_3", "Bleu_4"]),
+            (get_scorer('METEOR'),"METEOR"),
+            (get_scorer('ROUGE_L'), "ROUGE_L"),
+            (get_scorer('CIDEr'), "CIDEr"),
+            (get_scorer('SPICE'), "SPICE")
         ]
 
         # =================================================
@@ -74,9 +74,14 @@ class Meteor:
         self.lock.release()
         return score
 
-    def __del__(self):
+    def close(self):
         self.lock.acquire()
-        self.meteor_p.stdin.close()
-        self.meteor_p.kill()
-        self.meteor_p.wait()
+        if self.meteor_p is not None:
+            self.meteor_p.stdin.close()
+            self.meteor_p.kill()
+            self.meteor_p.wait()
+            self.meteor_p = None
         self.lock.release()
+
+    def __del__(self):
+        self.close()
@@ -0,0 +1,49 @@
+"""
+Scorers of the caption metrics, built on first use and kept for the life of the process: the METEOR jvm is
+started and the SPICE stanford models are checked once, not on every evaluation. shutdown() stops them
+"""
+import time
+import atexit
+import logging
+import threading
+
+from .bleu.bleu import Bleu
+from .meteor.meteor import Meteor
+from .rouge.rouge import Rouge
+from .cider.cider import Cider
+from .spice.spice import Spice
+
+logger = logging.getLogger(__name__)
+
+FACTORIES = {
+    'Bleu': Bleu,
+    'METEOR': Meteor,
+    'ROUGE_L': Rouge,
+    'CIDEr': Cider,
+    'SPICE': Spice,
+}
+
+_scorers = {}
+_lock = threading.Lock()
+
+
+def get_scorer(name):
+    """The scorer of a metric of FACTORIES, built the first time it is asked for"""
+    with _lock:
+        if name not in _scorers:
+            start = time.time()
+            _scorers[name] = FACTORIES[name]()
+            logger.info('Started the %s scorer in %.2fs', name, time.time() - start)
+        return _scorers[name]
+
+
+def shutdown():
+    """Stop the scorers built so far (the METEOR jvm), they are started again when needed"""
+    with _lock:
+        for scorer in _scorers.values():
+            if hasattr(scorer, 'close'):
+                scorer.close()
+        _scorers.clear()
+
+
+atexit.register(shutdown)
@@ -3,16 +3,122 @@ from __future__ import print_function
 import torch
 import json
 import h5py
+import hashlib
 import os
 import numpy as np
 import random
+import threading
 import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait
 from six.moves import cPickle
 
+from feature_store import PaddedFeatureStore, open_feature_store, open_h5, release_h5
+
 import logging
 from datetime import datetime
 logger = logging.getLogger(__name__)
 
+
+def sample_rows(start_ix, end_ix, seq_per_img, rng):
+	"""
+	Pick seq_per_img rows in [start_ix, end_ix) for each video, flattened to (num_videos * seq_per_img)
+	videos with no more than seq_per_img rows take all of them in order and top up with random repeats,
+	others take a random subset (same distribution as the per-video loop)
+	"""
+	counts = end_ix - start_ix
+	assert (counts > 0).all(), 'No captions!!'
+	q = np.arange(seq_per_img)[None, :]
+	repeats = (rng.random_sample((len(counts), seq_per_img)) * counts[:, None]).astype(np.int64)
+	offsets = np.where(q < counts[:, None], q, repeats)
+	if counts.max() > seq_per_img:
+		# the first seq_per_img positions of a random ordering of each video's rows
+		keys = rng.random_sample((len(counts), counts.max()))
+		keys[np.arange(counts.max())[None, :] >= counts[:, None]] = np.inf
+		subsets = np.argsort(keys, axis=1)[:, :seq_per_img]
+		offsets = np.where(counts[:, None] > seq_per_img, subsets, offsets)
+	return (start_ix[:, None] + offsets).reshape(-1)
+
+
+def file_sha1(path, chunk_size=2 ** 20):
+	sha1 = hashlib.sha1()
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(chunk_size), b''):
+			sha1.update(chunk)
+	return sha1.hexdigest()
+
+
+def concept_pos_weight(label_h5_file, vocab_size, seq_per_img):
+	"""
+	pos_weight (negatives / (1 + positives) per vocab word) of the svo concepts of one training epoch,
+	from the svo labels alone. Each video draws seq_per_img of its n svo rows, so every row counts seq_per_img / n times
+	The per-word counts are cached next to the label h5, keyed by the hash of its content
+	"""
+	cache_file = '%s.concepts_%s.npz' % (os.path.splitext(label_h5_file)[0], file_sha1(label_h5_file))
+	positives = None
+	if os.path.exists(cache_file):
+		try:
+			with np.load(cache_file) as cache:
+				positives, num_videos = cache['positives'], int(cache['num_videos'])
+		except Exception as e:
+			# an unreadable cache is counted again and replaced
+			logger.warning('Could not read concept counts from %s: %s', cache_file, e)
+	if positives is None:
+		t_start = time.time()
+		with h5py.File(label_h5_file, 'r') as label_h5:
+			labels_svo = label_h5['labels_svo'][()]
+			start_ix = label_h5['label_start_ix_svo'][()]
+			end_ix = label_h5['label_end_ix_svo'][()]
+		num_videos = len(start_ix)
+
+		counts = end_ix - start_ix
+		assert (counts > 0).all(), 'No svos!!'
+		# rows of every video, and the weight each of them gets
+		rows = np.repeat(start_ix - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+		row_weights = np.zeros(labels_svo.shape[0])
+		np.add.at(row_weights, rows, np.repeat(1.0 / counts, counts))
+
+		# a word counts once per row, however often the row repeats it
+		words = np.sort(labels_svo, axis=1)
+		words[:, 1:][words[:, 1:] == words[:, :-1]] = 0
+		positives = np.bincount(words.reshape(-1), weights=np.repeat(row_weights, words.shape[1]), minlength=vocab_size)
+		positives[0] = 0  # the padding index
+		# written aside and renamed into place, so a concurrent reader never finds a partial cache
+		tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+		try:
+			with open(tmp_file, 'wb') as f:
+				np.savez(f, positives=positives, num_videos=num_videos)
+			os.replace(tmp_file, cache_file)
+		except (IOError, OSError) as e:
+			logger.warning('Could not cache concept counts to %s: %s', cache_file, e)
+			if os.path.exists(tmp_file):
+				os.remove(tmp_file)
+		logger.info('Counted svo concepts of %d videos in %.3fs', num_videos, time.time() - t_start)
+
+	positives = seq_per_img * positives
+	negatives = seq_per_img * num_videos - positives
+	return torch.from_numpy(negatives / (1 + positives)).float()
+
+
+def bucket_order(index, lengths, batch_size, rng):
+	"""
+	Random order of index in which consecutive batch_size runs hold videos of similar caption length,
+	the runs themselves are visited in random order
+	"""
+	index = np.asarray(index)
+	# random tie-breaks so the grouping differs between epochs
+	order = index[np.argsort(lengths[index] + rng.random_sample(len(index)), kind='stable')]
+	runs = [order[ii:ii + batch_size] for ii in range(0, len(order), batch_size)]
+	rng.shuffle(runs)
+	return [int(idx) for idx in np.concatenate(runs)]
+
+
+def caption_lengths(labels, start_ix, end_ix):
+	"""Longest caption (in tokens) of every video"""
+	lengths = (labels != 0).sum(1)
+	return np.array([lengths[ix1:ix2].max() for ix1, ix2 in zip(start_ix, end_ix)])
+
+
 class DataLoader():
 
 	"""Class to load video features and captions"""
@@ -30,12 +136,30 @@ class DataLoader():
 		self.cocofmt_file = opt.get('cocofmt_file', None)
 		self.bcmrscores_pkl = opt.get('bcmrscores_pkl', None)  # created with https://github.com/mynlp/cst_captioning/blob/master/compute_scores.py
 
+		# build the next batches in background threads (0 = load synchronously in get_batch)
+		self.prefetch = opt.get('prefetch', 0)
+		self.prefetch_workers = opt.get('prefetch_workers', 1)
+		self._executor = None
+		self._thread_prefix = 'prefetch_%x' % id(self)
+		self._pending = deque()
+		self._plan_position = None
+		self.prefetch_stats = {'batches': 0, 'starved': 0, 'wait_time': 0.0}
+		if self.prefetch > 0:
+			self._seed_rng = np.random.RandomState(np.random.randint(2 ** 31 - 1))
+
+		# seconds spent opening/scanning each file, reported once the loader is ready
+		self.startup_times = OrderedDict()
+		t_init = time.time()
+
 		# open the hdf5 info file
 		logger.info('DataLoader loading h5 file: %s', opt['label_h5'])
-		self.label_h5 = h5py.File(opt['label_h5'], 'r')
+		t_start = time.time()
+		self.label_h5_file = opt['label_h5']
+		self.label_h5 = open_h5(self.label_h5_file)
 
-		self.vocab = [i for i in self.label_h5['vocab']]
-		self.videos = [i for i in self.label_h5['videos']]
+		self.vocab = list(self.label_h5['vocab'][()])
+		self.videos = list(self.label_h5['videos'][()])
+		self.startup_times[self.label_h5_file] = time.time() - t_start
 
 		self.ix_to_word = {i: w for i, w in enumerate(self.vocab)}
 		self.num_videos = len(self.videos)
@@ -43,27 +167,43 @@ class DataLoader():
 
 		# load the json file which contains additional information about the
 		# dataset
+		self.feat_mmap = opt.get('feat_mmap', 1)
+		# dtype of the feats/bfeats tensors of a batch, files stored in another precision (see misc/convert_features.py) are cast on load
+		self.feat_dtype = opt.get('feat_dtype', 'float32')
 		feat_h5_files = opt['feat_h5']
 		logger.info('DataLoader loading h5 files: %s', feat_h5_files)
-		self.feat_h5 = []
+		self.feat_stores = []
 		self.feat_dims = []
 		for ii, feat_h5_file in enumerate(feat_h5_files):
-			self.feat_h5.append(h5py.File(feat_h5_files[ii], 'r'))
-			self.feat_dims.append(self.feat_h5[ii][self.videos[0]].shape[0])
+			t_start = time.time()
+			self.feat_stores.append(open_feature_store(feat_h5_files[ii], mmap=self.feat_mmap))
+			self.feat_dims.append(self.feat_stores[ii].sample_shape(int(self.videos[0]))[0])
+			self.startup_times[feat_h5_file] = time.time() - t_start
 
 		self.num_feats = len(feat_h5_files)
 
 		# load the h5 file which contains of regional features
 		bfeat_h5_files = opt['bfeat_h5']
 		logger.info('DataLoader loading bh5 files: %s', bfeat_h5_files)
-		self.bfeat_h5 = []
+		self.bfeat_stores = []
 		self.bfeat_dims = []
 		for ii, bfeat_h5_file in enumerate(bfeat_h5_files):
-			self.bfeat_h5.append(h5py.File(bfeat_h5_files[ii], 'r'))
-			self.bfeat_dims.append(self.bfeat_h5[ii][self.videos[0]].shape[1])
+			t_start = time.time()
+			self.bfeat_stores.append(open_feature_store(bfeat_h5_files[ii], mmap=self.feat_mmap))
+			self.bfeat_dims.append(self.bfeat_stores[ii].sample_shape(int(self.videos[0]))[1])
+			self.startup_times[bfeat_h5_file] = time.time() - t_start
 		self.num_bfeats = len(bfeat_h5_files)
+
+		# padded roi files (misc/pad_boxes.py) carry their box counts, so they are checked to agree once here instead of on every batch
+		self.check_rois = not all(isinstance(store, PaddedFeatureStore) for store in self.bfeat_stores)
+		if not self.check_rois:
+			video_ids = [int(v) for v in self.videos]
+			counts = [store.box_counts(video_ids) for store in self.bfeat_stores]
+			assert all((nb == counts[0]).all() for nb in counts), 'Wrong rois detected!'
 		
-		self.fr_size = h5py.File(opt['fr_size_h5'], 'r')
+		# frame sizes are not needed to build batches, the file is only opened on first access of self.fr_size
+		self.fr_size_h5 = opt.get('fr_size_h5', None)
+		self._fr_size = None
 
 		# load in the sequence data
 		if 'labels' in self.label_h5.keys():
@@ -73,6 +213,7 @@ class DataLoader():
 			# load the pointers in full to RAM (should be small enough)
 			self.label_start_ix = self.label_h5['label_start_ix']
 			self.label_end_ix = self.label_h5['label_end_ix']
+			self.labels = self.label_h5['labels']
 			assert(self.label_start_ix.shape[0] == self.label_end_ix.shape[0])
 			self.has_label = True
 
@@ -81,10 +222,29 @@ class DataLoader():
 
 			self.label_start_ix_svo = self.label_h5['label_start_ix_svo']
 			self.label_end_ix_svo = self.label_h5['label_end_ix_svo']
+			self.labels_svo = self.label_h5['labels_svo']
 			assert(self.label_start_ix_svo.shape[0] == self.label_end_ix_svo.shape[0])
+
+			# copy the labels and pointers out of the h5 file once so batches are sampled with numpy gathers
+			self.labels_in_memory = opt.get('labels_in_memory', 0)
+			if self.labels_in_memory:
+				t_start = time.time()
+				self.label_start_ix = self.label_start_ix[()]
+				self.label_end_ix = self.label_end_ix[()]
+				self.labels = self.labels[()]
+				self.label_start_ix_svo = self.label_start_ix_svo[()]
+				self.label_end_ix_svo = self.label_end_ix_svo[()]
+				self.labels_svo = self.labels_svo[()]
+				self.startup_times[self.label_h5_file] += time.time() - t_start
+
+			# group videos of similar caption length into the same batches when shuffling
+			self.bucket_by_length = opt.get('bucket_by_length', 0)
+			if self.bucket_by_length:
+				self.caption_lengths = caption_lengths(self.labels[()], self.label_start_ix[()], self.label_end_ix[()])
 			
 		else:
 			self.has_label = False
+			self.bucket_by_length = 0
 
 		if self.bcmrscores_pkl is not None:
 			eval_metric = opt.get('eval_metric', 'CIDEr')
@@ -94,128 +254,248 @@ class DataLoader():
 				eval_metric = 'cider'
 			self.bcmrscores = self.bcmrscores[eval_metric]
 		
+		# reuse a ring of preallocated batch buffers (0 = allocate new tensors for every batch),
+		# a batch returned by get_batch stays valid until buffer_pool - 1 more batches have been requested
+		self.buffer_pool = opt.get('buffer_pool', 0)
+		if self.buffer_pool > 0 and self.buffer_pool < self.prefetch + 2:
+			logger.warning('buffer_pool %d is too small for prefetch %d, using %d buffers', self.buffer_pool, self.prefetch, self.prefetch + 2)
+			self.buffer_pool = self.prefetch + 2
+		self.pin_memory = opt.get('pin_memory', 1) and self.buffer_pool > 0 and torch.cuda.is_available()
+		self.buffer_stats = {'allocs': 0, 'bytes': 0}
+		self._buffers = [self._new_batch_buffers() for _ in range(self.buffer_pool)]
+		self._next_buffer = 0
+
 		if self.mode == 'train' or self.mode == 'val':
 			self.shuffle_videos()
 
+		logger.info('DataLoader (%s) ready in %.2fs: %s', self.mode, time.time() - t_init,
+					', '.join('%s %.2fs' % (os.path.basename(f), t) for f, t in self.startup_times.items()))
+
 	def __del__(self):
-		for f in self.feat_h5:
-			f.close()
-		self.label_h5.close()
+		try:
+			self.close()
+		finally:
+			for f in self.feat_stores + self.bfeat_stores:
+				f.close()
+			if self._fr_size is not None:
+				release_h5(self.fr_size_h5)
+			release_h5(self.label_h5_file)
+
+	@property
+	def fr_size(self):
+		if self._fr_size is None:
+			self._fr_size = open_h5(self.fr_size_h5)
+		return self._fr_size
 
 	def get_batch(self):
-		video_batch = []
-		bb_batch = []
-		for dim in self.feat_dims:
-			feat = torch.FloatTensor(
-				self.batch_size, self.num_chunks, dim).zero_()
-			video_batch.append(feat)
-		for dim in self.bfeat_dims:
-			bfeat = torch.FloatTensor(
-				self.batch_size, self.num_boxes, dim).zero_()
-			bb_batch.append(bfeat)
+		if self.prefetch > 0:
+			return self._get_prefetched_batch()
+
+		idxs, (self.index, self.iterator, self.epoch) = self._plan_batch(self.index, self.iterator, self.epoch)
+		return self._load_batch(idxs, np.random, self._get_batch_buffers())
 
+	def _plan_batch(self, index, iterator, epoch):
+		"""Pick the videos of the next batch starting from the given position,
+		returns them along with the position (index order, iterator, epoch) after the batch"""
+		idxs = []
+		for ii in range(self.batch_size):
+			idxs.append(index[iterator])
+			iterator += 1
+			if iterator >= self.num_videos:
+				logger.info('===> Finished loading epoch %d', epoch)
+				iterator = 0
+				epoch += 1
+				if self.mode == 'train' or self.mode == 'val':
+					# shuffle a copy, batches already planned keep the order they were planned with
+					index = self._shuffled(index)
+		return idxs, (index, iterator, epoch)
+
+	def _get_prefetched_batch(self):
+		if self._executor is None:
+			self._executor = ThreadPoolExecutor(max_workers=self.prefetch_workers,
+												thread_name_prefix=self._thread_prefix)
+		if not self._pending:
+			self._plan_position = (self.index, self.iterator, self.epoch)
+		self._fill_prefetch_queue()
+
+		future, position = self._pending.popleft()
+		self.prefetch_stats['batches'] += 1
+		if not future.done():
+			# the training loop caught up with the workers
+			self.prefetch_stats['starved'] += 1
+			t_wait = time.time()
+			data = future.result()
+			self.prefetch_stats['wait_time'] += time.time() - t_wait
+		else:
+			data = future.result()
+
+		epoch = self.epoch
+		self.index, self.iterator, self.epoch = position
+		if self.epoch > epoch:
+			stats = self.get_prefetch_stats()
+			logger.info('Prefetch stats: %d batches, starved %d (%.1f%%), waited %.2fs',
+						stats['batches'], stats['starved'], 100.0 * stats['starved_frac'], stats['wait_time'])
+		self._fill_prefetch_queue()
+		return data
+
+	def _fill_prefetch_queue(self):
+		while len(self._pending) < self.prefetch:
+			idxs, self._plan_position = self._plan_batch(*self._plan_position)
+			# each batch gets its own generator, so caption sampling doesn't depend on worker scheduling
+			rng = np.random.RandomState(self._seed_rng.randint(2 ** 31 - 1))
+			# buffers are handed out in planning order, so a ring larger than the queue never reuses one still in use
+			future = self._executor.submit(self._load_batch, idxs, rng, self._get_batch_buffers())
+			self._pending.append((future, self._plan_position))
+
+	def _drop_prefetched(self):
+		"""Discard batches built ahead of a position change, their buffers are handed out again"""
+		# a job already running can't be cancelled, it has to be done with its buffers before they are reused
+		wait([future for future, _ in self._pending if not future.cancel()])
+		if self.buffer_pool > 0:
+			# the refill starts right after the last batch returned, which stays valid
+			self._next_buffer = (self._next_buffer - len(self._pending)) % self.buffer_pool
+		self._pending.clear()
+
+	def get_prefetch_stats(self):
+		stats = dict(self.prefetch_stats)
+		stats['starved_frac'] = stats['starved'] / float(max(1, stats['batches']))
+		return stats
+
+	def close(self):
+		if self._executor is not None:
+			self._drop_prefetched()
+			# the queued jobs keep the loader alive, so the last of them may drop it and run close() on a worker,
+			# which can't join itself. It finishes on its own, the jobs are done already
+			in_worker = threading.current_thread().name.startswith(self._thread_prefix + '_')
+			self._executor.shutdown(wait=not in_worker)
+			self._executor = None
+
+	def _new_batch_buffers(self):
+		"""Allocate the tensors a batch is assembled into, page-locked when they are reused"""
+		def new(size, dtype):
+			tensor = torch.zeros(size, dtype=dtype, pin_memory=self.pin_memory)
+			self.buffer_stats['allocs'] += 1
+			self.buffer_stats['bytes'] += tensor.numel() * tensor.element_size()
+			return tensor
+
+		buffers = {}
+		buffers['feats'] = [new((self.batch_size, self.num_chunks, dim), getattr(torch, self.feat_dtype)) for dim in self.feat_dims]
+		buffers['bfeats'] = [new((self.batch_size, self.num_boxes, dim), getattr(torch, self.feat_dtype)) for dim in self.bfeat_dims]
 		if self.has_label:
-			label_batch = torch.LongTensor(
-				self.batch_size * self.seq_per_img,
-				self.seq_length).zero_()
-			mask_batch = torch.FloatTensor(
-				self.batch_size * self.seq_per_img,
-				self.seq_length).zero_()
-			label_svo_batch = torch.LongTensor(
-				self.batch_size * self.seq_per_img,
-				self.svo_length).zero_()
-			mask_svo_batch = torch.FloatTensor(
-				self.batch_size * self.seq_per_img,
-				self.svo_length).zero_()
+			buffers['labels'] = new((self.batch_size * self.seq_per_img, self.seq_length), torch.long)
+			buffers['masks'] = new((self.batch_size * self.seq_per_img, self.seq_length), torch.float)
+			buffers['labels_svo'] = new((self.batch_size * self.seq_per_img, self.svo_length), torch.long)
+			buffers['masks_svo'] = new((self.batch_size * self.seq_per_img, self.svo_length), torch.float)
+		return buffers
+
+	def _get_batch_buffers(self):
+		if self.buffer_pool > 0:
+			buffers = self._buffers[self._next_buffer]
+			self._next_buffer = (self._next_buffer + 1) % self.buffer_pool
+			return buffers
+		return self._new_batch_buffers()
+
+	def get_buffer_stats(self):
+		return dict(self.buffer_stats)
+
+	def _load_batch(self, idxs, rng, buffers):
+		# every element of the buffers is overwritten below, so reused buffers need no zeroing
+		video_batch = buffers['feats']
+		bb_batch = buffers['bfeats']
+		if self.has_label:
+			label_batch = buffers['labels']
+			mask_batch = buffers['masks']
+			label_svo_batch = buffers['labels_svo']
+			mask_svo_batch = buffers['masks_svo']
 
 		videoids_batch = []
 		gts = []
 		bcmrscores = np.zeros((self.batch_size, self.seq_per_img)) if self.bcmrscores_pkl is not None else None
 		
-		for ii in range(self.batch_size):
-			idx = self.index[self.iterator]
-			video_id = int(self.videos[idx])
+		video_ids = [int(self.videos[idx]) for idx in idxs]
+		for jj in range(self.num_feats):
+			# read straight into the first chunk of the batch tensor, the features are the same for every chunk
+			self.feat_stores[jj].read_batch(video_ids, out=video_batch[jj].numpy()[:, 0])
+			if self.num_chunks > 1:
+				video_batch[jj][:, 1:] = video_batch[jj][:, :1]
+
+		bb_counts = []
+		for jj in range(self.num_bfeats):
+			_, cur_nb = self.bfeat_stores[jj].read_boxes(video_ids, self.num_boxes, out=bb_batch[jj].numpy())
+			missing = torch.from_numpy(np.nonzero(cur_nb == 0)[0])
+			if len(missing) > 0:
+				bb_batch[jj][missing] = torch.rand(len(missing), self.num_boxes, self.bfeat_dims[jj]).to(bb_batch[jj].dtype)
+			bb_counts.append(cur_nb)
+		if self.check_rois:
+			assert all((nb == bb_counts[0]).all() for nb in bb_counts), 'Wrong rois detected!'
+
+		if self.has_label and self.labels_in_memory:
+			# sample the caption and svo rows of the whole batch at once
+			idxs_arr = np.array(idxs)
+			rows = sample_rows(self.label_start_ix[idxs_arr], self.label_end_ix[idxs_arr], self.seq_per_img, rng)
+			label_batch[:] = torch.from_numpy(self.labels[rows])
+			rows_svo = sample_rows(self.label_start_ix_svo[idxs_arr], self.label_end_ix_svo[idxs_arr], self.seq_per_img, rng)
+			label_svo_batch[:] = torch.from_numpy(self.labels_svo[rows_svo])
+
+		for ii, idx in enumerate(idxs):
+			video_id = video_ids[ii]
 			videoids_batch.append(video_id)
 
-			for jj in range(self.num_feats):
-				video_batch[jj][ii] = torch.from_numpy(
-					np.array(self.feat_h5[jj][str(video_id)]))
-
-			bb_check = []
-			for jj in range(self.num_bfeats):
-				cur_bfeat = np.array(self.bfeat_h5[jj][str(video_id)])
-				cur_nb = cur_bfeat.shape[0]
-				if cur_nb > 0:        
-					bb_check.append(cur_nb)
-					cur_idx = [a % cur_nb for a in range(self.num_boxes)]
-					bb_batch[jj][ii] = torch.from_numpy(cur_bfeat[cur_idx,:])
-				else:
-					bb_check.append(0)
-					bb_batch[jj][ii] = torch.rand(self.num_boxes, self.bfeat_dims[jj])
-			assert min(bb_check) == max(bb_check), 'Wrong rois detected!'
 			if self.has_label:
-				# fetch the sequence labels
-				ix1 = self.label_start_ix[idx]
-				ix2 = self.label_end_ix[idx]
-				ncap = int(ix2 - ix1)  # number of captions available for this image
-				assert ncap > 0, 'No captions!!'
-
-				seq = torch.LongTensor(
-					self.seq_per_img, self.seq_length).zero_()
-				seq_all = torch.from_numpy(
-					np.array(self.label_h5['labels'][ix1:ix2]))
-				if ncap <= self.seq_per_img:
-					seq[:ncap] = seq_all[:ncap]
-					for q in range(ncap, self.seq_per_img):
-						ixl = np.random.randint(ncap)
-						seq[q] = seq_all[ixl]
-				else:
-					randpos = torch.randperm(ncap)
-					for q in range(self.seq_per_img):
-						ixl = randpos[q]
-						seq[q] = seq_all[ixl]
-
-				il = ii * self.seq_per_img
-				label_batch[il:il + self.seq_per_img] = seq
-
-				# fetch the sequence svo labels
-				ix1_svo = self.label_start_ix_svo[idx]
-				ix2_svo = self.label_end_ix_svo[idx]
-				nsvo = int(ix2_svo - ix1_svo)  # number of captions available for this image
-				assert nsvo > 0, 'No svos!!'
-
-				seq_svo = torch.LongTensor(
-					self.seq_per_img, self.svo_length).zero_()
-				seq_all_svo = torch.from_numpy(
-					np.array(self.label_h5['labels_svo'][ix1_svo:ix2_svo]))
-				if nsvo <= self.seq_per_img:
-					seq_svo[:nsvo] = seq_all_svo[:nsvo]
-					for q in range(nsvo, self.seq_per_img):
-						ixl = np.random.randint(nsvo)
-						seq_svo[q] = seq_all_svo[ixl]
-				else:
-					randpos = torch.randperm(nsvo)
-					for q in range(self.seq_per_img):
-						ixl = randpos[q]
-						seq_svo[q] = seq_all_svo[ixl]
-
-				label_svo_batch[il:il + self.seq_per_img] = seq_svo
+				if not self.labels_in_memory:
+					# fetch the sequence labels
+					ix1 = self.label_start_ix[idx]
+					ix2 = self.label_end_ix[idx]
+					ncap = int(ix2 - ix1)  # number of captions available for this image
+					assert ncap > 0, 'No captions!!'
+
+					seq = torch.LongTensor(
+						self.seq_per_img, self.seq_length).zero_()
+					seq_all = torch.from_numpy(
+						np.array(self.labels[ix1:ix2]))
+					if ncap <= self.seq_per_img:
+						seq[:ncap] = seq_all[:ncap]
+						for q in range(ncap, self.seq_per_img):
+							ixl = rng.randint(ncap)
+							seq[q] = seq_all[ixl]
+					else:
+						randpos = rng.permutation(ncap)
+						for q in range(self.seq_per_img):
+							ixl = randpos[q]
+							seq[q] = seq_all[ixl]
+
+					il = ii * self.seq_per_img
+					label_batch[il:il + self.seq_per_img] = seq
+
+					# fetch the sequence svo labels
+					ix1_svo = self.label_start_ix_svo[idx]
+					ix2_svo = self.label_end_ix_svo[idx]
+					nsvo = int(ix2_svo - ix1_svo)  # number of captions available for this image
+					assert nsvo > 0, 'No svos!!'
+
+					seq_svo = torch.LongTensor(
+						self.seq_per_img, self.svo_length).zero_()
+					seq_all_svo = torch.from_numpy(
+						np.array(self.labels_svo[ix1_svo:ix2_svo]))
+					if nsvo <= self.seq_per_img:
+						seq_svo[:nsvo] = seq_all_svo[:nsvo]
+						for q in range(nsvo, self.seq_per_img):
+							ixl = rng.randint(nsvo)
+							seq_svo[q] = seq_all_svo[ixl]
+					else:
+						randpos = rng.permutation(nsvo)
+						for q in range(self.seq_per_img):
+							ixl = randpos[q]
+							seq_svo[q] = seq_all_svo[ixl]
+
+					label_svo_batch[il:il + self.seq_per_img] = seq_svo
 				# Used for reward evaluation
-				gts.append(
-					self.label_h5['labels'][
-						self.label_start_ix[idx]: self.label_end_ix[idx]])
+				gts.append(self.labels[self.label_start_ix[idx]: self.label_end_ix[idx]])
 				# pre-computed cider scores, 
 				# assuming now that videos order are same (which is the sorted videos order)
 				if self.bcmrscores_pkl is not None:
 					bcmrscores[ii] = self.bcmrscores[idx]
-					
-			self.iterator += 1
-			if self.iterator >= self.num_videos:
-				logger.info('===> Finished loading epoch %d', self.epoch)
-				self.iterator = 0
-				self.epoch += 1
-				if self.mode == 'train' or self.mode == 'val':
-					self.shuffle_videos()
+
 		data = {}
 		data['feats'] = video_batch
 		data['bfeats'] = bb_batch
@@ -223,13 +503,11 @@ class DataLoader():
 
 		if self.has_label:
 			# + 1 here to count the <eos> token, because the <eos> token is set to 0
-			nonzeros = np.array(list(map(lambda x: (x != 0).sum() + 1, label_batch)))
-			for ix, row in enumerate(mask_batch):
-				row[:nonzeros[ix]] = 1
+			nonzeros = (label_batch != 0).sum(1) + 1
+			mask_batch.copy_(torch.arange(self.seq_length).unsqueeze(0) < nonzeros.unsqueeze(1))
 
-			nonzeros = np.array(list(map(lambda x: (x != 0).sum() + 1, label_svo_batch)))
-			for ix, row in enumerate(mask_svo_batch):
-				row[:nonzeros[ix]] = 1
+			nonzeros = (label_svo_batch != 0).sum(1) + 1
+			mask_svo_batch.copy_(torch.arange(self.svo_length).unsqueeze(0) < nonzeros.unsqueeze(1))
 
 			data['labels_svo'] = label_svo_batch
 			data['labels'] = label_batch
@@ -240,12 +518,14 @@ class DataLoader():
 		return data
 
 	def reset(self):
+		self._drop_prefetched()
 		self.iterator = 0
 
 	def get_current_index(self):
 		return self.iterator
 
 	def set_current_index(self, index):
+		self._drop_prefetched()
 		self.iterator = index
 
 	def get_vocab(self):
@@ -285,10 +565,18 @@ class DataLoader():
 		return self.epoch
 
 	def set_current_epoch(self, epoch):
+		self._drop_prefetched()
 		self.epoch = epoch
 
 	def shuffle_videos(self):
-		np.random.shuffle(self.index)
+		self.index = self._shuffled(self.index)
+
+	def _shuffled(self, index):
+		if self.bucket_by_length:
+			return bucket_order(index, self.caption_lengths, self.batch_size, np.random)
+		index = list(index)
+		np.random.shuffle(index)
+		return index
 
 	def get_cocofmt_file(self):
 		return self.cocofmt_file
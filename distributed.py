@@ -0,0 +1,79 @@
+import os
+import datetime
+
+import torch
+import torch.distributed as dist
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def init(backend='', timeout=120):
+    """
+    Join the process group of a torchrun launch (WORLD_SIZE > 1 in the environment), the backend defaults to
+    nccl with cuda and gloo otherwise. A collective aborts after timeout minutes, the other ranks spend rank 0's
+    validation in one. Returns (rank, local_rank, world_size), (0, 0, 1) when not launched distributed
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size == 1:
+        return 0, 0, 1
+    if not backend:
+        backend = 'nccl' if torch.cuda.is_available() else 'gloo'
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if backend == 'nccl':
+        torch.cuda.set_device(local_rank)
+    dist.init_process_group(backend, init_method='env://', timeout=datetime.timedelta(minutes=timeout))
+    return dist.get_rank(), local_rank, dist.get_world_size()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main():
+    return get_rank() == 0
+
+
+def _device():
+    # nccl only reduces cuda tensors
+    if dist.get_backend() == 'nccl':
+        return torch.device('cuda', torch.cuda.current_device())
+    return torch.device('cpu')
+
+
+def all_reduce(values, average=True):
+    """A list of numbers summed (or averaged) over the ranks, every rank has to call it"""
+    if not is_distributed():
+        return list(values)
+    tensor = torch.tensor(values, dtype=torch.float64, device=_device())
+    dist.all_reduce(tensor)
+    if average:
+        tensor /= get_world_size()
+    return tensor.tolist()
+
+
+def broadcast(obj, src=0):
+    """src's (picklable) obj on every rank"""
+    if not is_distributed():
+        return obj
+    objs = [obj]
+    dist.broadcast_object_list(objs, src=src)
+    return objs[0]
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def close():
+    if is_distributed():
+        dist.destroy_process_group()
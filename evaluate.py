@@ -6,10 +6,15 @@ import logging
 from datetime import datetime
 
 from dataloader import DataLoader
+from feature_store import half_path
+from video_dataset import VideoDataLoader
 from model import GeneralModel, GeneralModelDecoupled, CrossEntropyCriterion
 from train import test
+from step_profiler import StepProfiler
 
+import utils
 import opts
+from pycocoevalcap.scorers import shutdown as shutdown_scorers
 
 logger = logging.getLogger(__name__)
 
@@ -53,6 +58,7 @@ if __name__ == '__main__':
             indent=4))
 
     start = datetime.now()
+    device = utils.setup_device(opt)
 
     test_opt = {'label_h5': opt.test_label_h5,
                 'batch_size': opt.test_batch_size,
@@ -62,13 +68,21 @@ if __name__ == '__main__':
                 'cocofmt_file': opt.test_cocofmt_file,
                 'seq_per_img': opt.test_seq_per_img,
                 'num_chunks': opt.num_chunks,
+                'prefetch': opt.prefetch,
+                'prefetch_workers': opt.prefetch_workers,
+                'feat_mmap': opt.feat_mmap,
+                'labels_in_memory': opt.labels_in_memory,
+                'buffer_pool': opt.buffer_pool,
+                'num_workers': opt.num_workers,
+                'feat_dtype': opt.feat_dtype,
                 'mode': 'test'
                 }
 
-    test_loader = DataLoader(test_opt)
+    loader_class = VideoDataLoader if opt.num_workers > 0 else DataLoader
+    test_loader = loader_class(test_opt)
 
     logger.info('Loading model: %s', opt.model_file)
-    checkpoint = torch.load(opt.model_file)
+    checkpoint = torch.load(opt.model_file, map_location=device)
     checkpoint_opt = checkpoint['opt']
 
     opt.model_type = checkpoint_opt.model_type
@@ -96,14 +110,29 @@ if __name__ == '__main__':
 
     xe_criterion = CrossEntropyCriterion()
 
-    if torch.cuda.is_available():
-        model.cuda()
-        xe_criterion.cuda()
+    model.to(device)
+    xe_criterion.to(device)
 
     logger.info('Start testing...')
-    test(model, xe_criterion, test_loader, opt)
+    profiler = StepProfiler(opt.profile_steps, os.path.join(opt.results_dir, opt.model_id), opt.dataset + '_profile_eval')
+    results = test(model, xe_criterion, test_loader, opt, profiler=profiler)
     logger.info('Time: %s', datetime.now() - start)
 
+    if opt.compare_fp16:
+        # same checkpoint on the float16 copies of the feature files, to see what the precision costs
+        fp16_opt = dict(test_opt)
+        fp16_opt['feat_h5'] = [half_path(f) for f in test_opt['feat_h5']]
+        fp16_opt['bfeat_h5'] = [half_path(f) for f in test_opt['bfeat_h5']]
+        result_file = opt.result_file
+        opt.result_file = os.path.splitext(result_file)[0] + '_fp16.json'
+        logger.info('Start testing on float16 features...')
+        fp16_results = test(model, xe_criterion, loader_class(fp16_opt), opt)
+        opt.result_file = result_file
+        for metric, score in results['scores'].items():
+            if metric in fp16_results['scores']:
+                logger.info('%s: float32 %.4f, float16 %.4f, delta %+.4f', metric, score,
+                            fp16_results['scores'][metric], fp16_results['scores'][metric] - score)
+
     if opt.grounder_type in ['niuc', 'nioc', 'iuc', 'ioc']:
         opt.result_file = os.path.join(opt.results_dir, opt.model_id, opt.dataset + '_gtconcepts.json')
         model.gt_concepts_while_testing = 1
@@ -111,4 +140,6 @@ if __name__ == '__main__':
         start = datetime.now()
 
         test(model, xe_criterion, test_loader, opt)
-        logger.info('Testing time: %s', datetime.now() - start)
\ No newline at end of file
+        logger.info('Testing time: %s', datetime.now() - start)
+
+    shutdown_scorers()
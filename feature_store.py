@@ -0,0 +1,309 @@
+import os
+import threading
+
+import h5py
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+PACKED_LAYOUT = 'packed'
+PADDED_LAYOUT = 'padded'
+
+# read-only h5 handles shared by every loader of a process: (pid, realpath) -> [h5py.File, refcount]
+# keyed by pid as well so worker processes forked after a file was opened get their own handle
+_h5_files = {}
+_h5_lock = threading.Lock()
+
+
+def open_h5(path):
+    """Shared read-only handle of an h5 file, give it back with release_h5"""
+    key = (os.getpid(), os.path.realpath(path))
+    with _h5_lock:
+        if key not in _h5_files:
+            _h5_files[key] = [h5py.File(path, 'r'), 0]
+        _h5_files[key][1] += 1
+        return _h5_files[key][0]
+
+
+def release_h5(path):
+    key = (os.getpid(), os.path.realpath(path))
+    with _h5_lock:
+        entry = _h5_files.get(key)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] == 0:
+            entry[0].close()
+            del _h5_files[key]
+
+
+def open_feature_store(path, mmap=True):
+    """Open a feature file with the backend matching how it was written"""
+    h5 = open_h5(path)
+    layout = h5.attrs.get('layout', None)
+    if layout == PACKED_LAYOUT:
+        return PackedFeatureStore(path, h5, mmap=mmap)
+    if layout == PADDED_LAYOUT:
+        return PaddedFeatureStore(path, h5, mmap=mmap)
+    return H5FeatureStore(path, h5)
+
+
+class H5FeatureStore(object):
+    """
+    Features stored as one h5 dataset per video, keyed by str(video_id)
+    """
+
+    def __init__(self, path, h5):
+        self.path = path
+        self.h5 = h5
+
+    def videos(self):
+        return sorted(int(v) for v in self.h5.keys())
+
+    def sample_shape(self, video_id):
+        return self.h5[str(video_id)].shape
+
+    def read(self, video_id):
+        return np.array(self.h5[str(video_id)])
+
+    def read_batch(self, video_ids, out=None):
+        """Features of fixed shape per video, stacked to (len(video_ids), ...), optionally read straight into out"""
+        if out is None:
+            return np.stack([self.read(video_id) for video_id in video_ids])
+        for ii, video_id in enumerate(video_ids):
+            self.h5[str(video_id)].read_direct(out[ii])
+        return out
+
+    def read_boxes(self, video_ids, num_boxes, out=None):
+        """
+        Variable number of rows (boxes) per video, cycled to num_boxes rows each
+        returns the (len(video_ids), num_boxes, dim) array and the number of boxes each video really has,
+        videos without boxes are left as zeros
+        """
+        if out is None:
+            dim = self.sample_shape(video_ids[0])[1]
+            out = np.zeros((len(video_ids), num_boxes, dim), dtype=np.float32)
+        counts = np.zeros(len(video_ids), dtype=np.int64)
+        for ii, video_id in enumerate(video_ids):
+            cur = self.read(video_id)
+            counts[ii] = cur.shape[0]
+            if counts[ii] > 0:
+                out[ii] = cur[np.arange(num_boxes) % counts[ii]]
+            else:
+                out[ii] = 0
+        return out, counts
+
+    def close(self):
+        release_h5(self.path)
+
+
+class PackedFeatureStore(object):
+    """
+    Features of all videos packed into one contiguous 'data' dataset,
+    rows offsets[i]:offsets[i+1] belong to videos[i]
+    A batch is fetched with a single fancy-indexed read, or straight from a np.memmap of the file
+    when 'data' is stored contiguously and uncompressed
+    """
+
+    def __init__(self, path, h5, mmap=True):
+        self.path = path
+        self.h5 = h5
+        self.data = h5['data']
+        self.offsets = h5['offsets'][()]
+        self.row_of = {int(v): ii for ii, v in enumerate(h5['videos'][()])}
+        self.mmap = self._open_mmap() if mmap else None
+
+    def _open_mmap(self):
+        if self.data.chunks is None and self.data.compression is None:
+            offset = self.data.id.get_offset()
+            if offset is not None:
+                return np.memmap(self.path, dtype=self.data.dtype, mode='r', offset=offset, shape=self.data.shape)
+        return None
+
+    def videos(self):
+        return list(self.row_of)
+
+    def _positions(self, video_ids):
+        return np.array([self.row_of[int(video_id)] for video_id in video_ids], dtype=np.int64)
+
+    def _take(self, rows, out=None):
+        if self.mmap is not None:
+            if out is not None and out.dtype != self.mmap.dtype:
+                # np.take only writes its own dtype, cast on the copy
+                out[...] = np.take(self.mmap, rows, axis=0)
+                return out
+            return np.take(self.mmap, rows, axis=0, out=out)
+        # h5py needs increasing, unique indices for fancy reads
+        uniq, inverse = np.unique(rows, return_inverse=True)
+        if out is None:
+            return self.data[uniq][inverse]
+        out[...] = self.data[uniq][inverse]
+        return out
+
+    def sample_shape(self, video_id):
+        pos = self.row_of[int(video_id)]
+        nrows = self.offsets[pos + 1] - self.offsets[pos]
+        if self.h5.attrs['ragged']:
+            return (nrows,) + self.data.shape[1:]
+        return self.data.shape[1:]
+
+    def read(self, video_id):
+        pos = self.row_of[int(video_id)]
+        return np.array(self.data[self.offsets[pos]:self.offsets[pos + 1]])
+
+    def read_batch(self, video_ids, out=None):
+        return self._take(self.offsets[self._positions(video_ids)], out=out)
+
+    def read_boxes(self, video_ids, num_boxes, out=None):
+        pos = self._positions(video_ids)
+        starts = self.offsets[pos]
+        counts = self.offsets[pos + 1] - starts
+        rows = starts[:, None] + np.arange(num_boxes)[None, :] % np.maximum(counts, 1)[:, None]
+        rows = np.minimum(rows, self.data.shape[0] - 1)  # videos without boxes may sit at the very end
+        shape = (len(video_ids), num_boxes) + self.data.shape[1:]
+        if out is None:
+            out = self._take(rows.reshape(-1)).reshape(shape)
+        else:
+            self._take(rows.reshape(-1), out=out.reshape((-1,) + self.data.shape[1:]))
+        out[counts == 0] = 0
+        return out, counts
+
+    def close(self):
+        self.mmap = None
+        release_h5(self.path)
+
+
+class PaddedFeatureStore(PackedFeatureStore):
+    """
+    Rows of every video cycled to a fixed number of boxes and stored as one (num_videos, num_boxes, dim) 'data' array,
+    'counts' holds the number of boxes each video really has (videos without boxes are zeros)
+    A batch of rois is a single gather over the first axis
+    """
+
+    def __init__(self, path, h5, mmap=True):
+        self.path = path
+        self.h5 = h5
+        self.data = h5['data']
+        self.counts = h5['counts'][()]
+        self.num_boxes = self.data.shape[1]
+        self.row_of = {int(v): ii for ii, v in enumerate(h5['videos'][()])}
+        self.mmap = self._open_mmap() if mmap else None
+
+    def box_counts(self, video_ids):
+        return self.counts[self._positions(video_ids)]
+
+    def sample_shape(self, video_id):
+        return (self.counts[self.row_of[int(video_id)]],) + self.data.shape[2:]
+
+    def read(self, video_id):
+        pos = self.row_of[int(video_id)]
+        return np.array(self.data[pos, :min(self.counts[pos], self.num_boxes)])
+
+    def read_batch(self, video_ids, out=None):
+        return self._take(self._positions(video_ids), out=out)
+
+    def read_boxes(self, video_ids, num_boxes, out=None):
+        if num_boxes > self.num_boxes:
+            raise ValueError('%s is padded to %d boxes, %d requested' % (self.path, self.num_boxes, num_boxes))
+        pos = self._positions(video_ids)
+        if num_boxes == self.num_boxes:
+            out = self._take(pos, out=out)
+        elif out is None:
+            out = self._take(pos)[:, :num_boxes]
+        else:
+            out[...] = self._take(pos)[:, :num_boxes]
+        return out, self.counts[pos]
+
+
+def pack_features(in_path, out_path):
+    """
+    Rewrite a per-video feature h5 file as one contiguous array plus a video -> row offset table
+    1-D per-video features become one row each, 2-D ones (e.g. ROIs) keep their rows
+    """
+    with h5py.File(in_path, 'r') as fi:
+        videos = sorted(fi.keys(), key=int)
+        first = fi[videos[0]]
+        ragged = len(first.shape) > 1
+        counts = np.array([fi[v].shape[0] if ragged else 1 for v in videos], dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        row_shape = first.shape[1:] if ragged else first.shape
+
+        logger.info('Packing %d videos (%d rows of %s) from %s into %s', len(videos), offsets[-1], row_shape, in_path, out_path)
+        with h5py.File(out_path, 'w') as fo:
+            fo.attrs['layout'] = PACKED_LAYOUT
+            fo.attrs['ragged'] = ragged
+            fo.create_dataset('videos', data=np.array([int(v) for v in videos], dtype=np.int64))
+            fo.create_dataset('offsets', data=offsets)
+            data = fo.create_dataset('data', shape=(int(offsets[-1]),) + tuple(row_shape), dtype=first.dtype)
+            for ii, v in enumerate(videos):
+                if counts[ii] > 0:
+                    data[offsets[ii]:offsets[ii + 1]] = fi[v][()]
+
+
+def pad_boxes(in_paths, out_paths, num_boxes, chunk_size=256):
+    """
+    Rewrite per-video roi files (e.g. *_roi_feat.h5 and *_roi_box.h5) as PaddedFeatureStore files,
+    rows cycled to num_boxes exactly as read_boxes does. The files describe the same boxes,
+    so every video must have the same number of rows in all of them, this is checked here once
+    """
+    stores = [open_feature_store(path, mmap=False) for path in in_paths]
+    try:
+        videos = stores[0].videos()
+        counts = [np.array([store.sample_shape(v)[0] for v in videos], dtype=np.int64) for store in stores]
+        for path, cur in zip(in_paths[1:], counts[1:]):
+            wrong = np.nonzero(cur != counts[0])[0]
+            if len(wrong) > 0:
+                raise ValueError('Wrong rois detected! %s and %s disagree on the number of boxes of %d videos, e.g. %s'
+                                 % (in_paths[0], path, len(wrong), [videos[ii] for ii in wrong[:5]]))
+
+        for store, in_path, out_path in zip(stores, in_paths, out_paths):
+            row_shape = store.sample_shape(videos[0])[1:]
+            logger.info('Padding %d videos of %s to %d boxes into %s', len(videos), in_path, num_boxes, out_path)
+            with h5py.File(out_path, 'w') as fo:
+                fo.attrs['layout'] = PADDED_LAYOUT
+                fo.create_dataset('videos', data=np.array(videos, dtype=np.int64))
+                fo.create_dataset('counts', data=counts[0])
+                data = fo.create_dataset('data', shape=(len(videos), num_boxes) + tuple(row_shape),
+                                         dtype=store.read(videos[0]).dtype)
+                for ii in range(0, len(videos), chunk_size):
+                    data[ii:ii + chunk_size] = store.read_boxes(videos[ii:ii + chunk_size], num_boxes)[0]
+    finally:
+        for store in stores:
+            store.close()
+
+
+def half_path(path):
+    """Where convert_features writes the float16 copy of a feature file by default"""
+    return os.path.splitext(path)[0] + '_fp16.h5'
+
+
+def convert_features(in_path, out_path, dtype=np.float16):
+    """
+    Copy a feature file (per-video or packed) with its float datasets stored as dtype
+    returns the largest absolute and relative error the cast introduced
+    """
+    dtype = np.dtype(dtype)
+    errors = {'max_abs': 0.0, 'max_rel': 0.0}
+
+    def cast(name, src, dst_group):
+        values = src[()]
+        if values.dtype.kind != 'f':
+            dst_group.create_dataset(name, data=values)
+            return
+        converted = values.astype(dtype)
+        if not np.isfinite(converted[np.isfinite(values)]).all():
+            raise ValueError('%s/%s has values out of the %s range' % (in_path, name, dtype))
+        diff = np.abs(converted.astype(values.dtype) - values)
+        if diff.size > 0:
+            errors['max_abs'] = max(errors['max_abs'], float(diff.max()))
+            errors['max_rel'] = max(errors['max_rel'], float((diff / np.maximum(np.abs(values), 1e-6)).max()))
+        dst_group.create_dataset(name, data=converted)
+
+    logger.info('Converting %s to %s as %s', in_path, out_path, dtype)
+    with h5py.File(in_path, 'r') as fi, h5py.File(out_path, 'w') as fo:
+        for key, value in fi.attrs.items():
+            fo.attrs[key] = value
+        for name in fi.keys():
+            cast(name, fi[name], fo)
+    return errors
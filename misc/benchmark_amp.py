@@ -0,0 +1,119 @@
+"""
+Benchmark float32 against --amp (float16 on cuda, bfloat16 on cpu) for the lstm and transformer captioners on a
+randomly initialised model: training steps (forward, backward and optimizer step) and beam search decoding per second,
+the difference of the losses and the share of beam search captions that come out the same.
+Other arguments are passed on to opts (e.g. --grounder_type iuc --decouple 1)
+The validation CIDEr parity of a trained model is checked with evaluate.py --amp 0 / --amp 1
+
+python misc/benchmark_amp.py --batch_size 32 --seq_per_img 20 --device cuda
+"""
+import os
+import sys
+import time
+import argparse
+
+import torch
+from torch.nn.utils import clip_grad_norm_
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import opts
+from model import GeneralModel, GeneralModelDecoupled, CrossEntropyCriterion
+
+
+def build_model(opt, device):
+    torch.manual_seed(opt.seed)
+    model = GeneralModelDecoupled(opt) if opt.decouple else GeneralModel(opt)
+    return model.to(device)
+
+
+def make_batch(opt, batch_size, seq_per_img, num_boxes, device):
+    feats = [torch.rand(batch_size, opt.num_chunks, dim, device=device) for dim in opt.feat_dims]
+    bfeats = [torch.rand(batch_size, num_boxes, dim, device=device) for dim in opt.bfeat_dims]
+    labels = torch.randint(3, opt.vocab_size, (batch_size * seq_per_img, opt.seq_length), device=device)
+    labels[:, 0] = 1
+    labels[:, -4:] = 0
+    masks = (labels != 0).float()
+    masks[:, -4] = 1  # <eos>
+    concepts = torch.randint(3, opt.vocab_size, (batch_size * seq_per_img, opt.svo_length), device=device)
+    return feats, bfeats, labels, masks, concepts
+
+
+def synchronize():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def train_steps(model, batch, opt, device, repeats):
+    """Seconds per training step, and the loss of the first step"""
+    feats, bfeats, labels, masks, concepts = batch
+    criterion = CrossEntropyCriterion()
+    optimizer = torch.optim.Adam(model.parameters(), lr=opt.learning_rate)
+    scaler = torch.cuda.amp.GradScaler(enabled=bool(opt.amp) and device.type == 'cuda')
+    model.train()
+    losses = []
+    synchronize()
+    start = time.time()
+    for _ in range(repeats):
+        optimizer.zero_grad()
+        torch.manual_seed(opt.seed)  # the same dropout in both precisions
+        out = model(feats, bfeats, labels, concepts)
+        loss = criterion(out[0], labels[:, 1:], masks[:, 1:])
+        scaler.scale(loss).backward()
+        scaler.unscale_(optimizer)
+        clip_grad_norm_(model.parameters(), opt.grad_clip)
+        scaler.step(optimizer)
+        scaler.update()
+        losses.append(loss.item())
+    synchronize()
+    return (time.time() - start) / repeats, losses[0]
+
+
+def decode(model, batch, beam_size, repeats):
+    """Seconds per beam search of the batch, and its captions"""
+    feats, bfeats, _, _, concepts = batch
+    model.eval()
+    with torch.no_grad():
+        seq = model.sample(feats, bfeats, concepts, {'beam_size': beam_size})[0]
+        synchronize()
+        start = time.time()
+        for _ in range(repeats):
+            model.sample(feats, bfeats, concepts, {'beam_size': beam_size})
+        synchronize()
+    return (time.time() - start) / repeats, seq
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--captioners', type=str, nargs='+', default=['lstm', 'transformer'])
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--seq_per_img', type=int, default=20)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--vocab_size', type=int, default=10000)
+    parser.add_argument('--num_boxes', type=int, default=10)
+    args, rest = parser.parse_known_args()
+    # training needs a grounder, without one the features are not expanded to the captions
+    sys.argv = sys.argv[:1] + ['--grounder_type', 'niuc'] + rest
+    opt = opts.parse_opts()
+    opt.train_seq_per_img = args.seq_per_img
+    opt.vocab_size = args.vocab_size
+    opt.seq_length = 30
+    opt.svo_length = opt.num_concepts
+    opt.feat_dims = [1536, 4096, 20]
+    opt.bfeat_dims = [1024, 4]
+    device = torch.device(opt.device or ('cuda' if torch.cuda.is_available() else 'cpu'))
+    batch = make_batch(opt, args.batch_size, args.seq_per_img, args.num_boxes, device)
+
+    for captioner in args.captioners:
+        opt.captioner_type = captioner
+        results = {}
+        for amp in [0, 1]:
+            opt.amp = amp
+            step_time, loss = train_steps(build_model(opt, device), batch, opt, device, args.repeats)
+            decode_time, seq = decode(build_model(opt, device), batch, opt.beam_size, args.repeats)
+            results[amp] = (step_time, loss, decode_time, seq)
+        same = (results[0][3] == results[1][3]).all(1).float().mean().item()
+        print('%-11s train %6.1f -> %6.1f steps/s (x%.2f)  decode %6.1f -> %6.1f batches/s (x%.2f)  '
+              'loss %.4f / %.4f  same captions %.1f%%' % (
+                  captioner, 1 / results[0][0], 1 / results[1][0], results[0][0] / results[1][0],
+                  1 / results[0][2], 1 / results[1][2], results[0][2] / results[1][2],
+                  results[0][1], results[1][1], 100 * same))
@@ -0,0 +1,74 @@
+"""
+Benchmark the per step attention of the rnn captioner on a randomly initialised model: the visual features projected
+on every step (as the decode loops used to) against projected once per caption (model.additive_attention), for a
+range of attended slots (e.g. 3 features, + 10 boxes, + 10 boxes and the concepts). Other arguments are passed on to opts
+
+python misc/benchmark_attention.py --slots 3 13 23 --batch_size 32 --steps 30 --device cuda
+"""
+import os
+import sys
+import time
+import argparse
+
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import opts
+from model import GeneralModel, additive_attention
+
+
+def attend_per_step(model, encoded_features, hidden):
+    hid_cont = hidden.unsqueeze(1).expand(encoded_features.size(0), encoded_features.size(1), hidden.size(1))
+    alpha = model.att_layer(torch.tanh(model.v2a_layer(encoded_features) + model.h2a_layer(hid_cont)))
+    alpha = F.softmax(alpha, dim=1).transpose(1, 2)
+    return torch.matmul(alpha, encoded_features).squeeze(1)
+
+
+def run(model, encoded_features, hiddens, hoisted, repeats):
+    def decode():
+        att_keys = model.v2a_layer(encoded_features) if hoisted else None
+        for hidden in hiddens:
+            if hoisted:
+                out = additive_attention(att_keys, model.h2a_layer(hidden), model.att_layer, encoded_features)
+            else:
+                out = attend_per_step(model, encoded_features, hidden)
+        return out
+
+    with torch.no_grad():
+        out = decode()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.time()
+        for _ in range(repeats):
+            decode()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+    return (time.time() - start) / repeats / len(hiddens), out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--slots', type=int, nargs='+', default=[3, 13, 23], help='numbers of attended slots to time')
+    parser.add_argument('--batch_size', type=int, default=32, help='captions decoded together (batch * beams)')
+    parser.add_argument('--steps', type=int, default=30, help='decoding steps per caption')
+    parser.add_argument('--repeats', type=int, default=10)
+    args, rest = parser.parse_known_args()
+    sys.argv = sys.argv[:1] + ['--captioner_type', 'lstm'] + rest
+    opt = opts.parse_opts()
+    opt.vocab_size = 100
+    opt.seq_length = args.steps
+    opt.svo_length = opt.num_concepts
+    opt.feat_dims = [1536, 4096, 20]
+    opt.bfeat_dims = [1024, 4]
+    device = torch.device(opt.device or ('cuda' if torch.cuda.is_available() else 'cpu'))
+
+    torch.manual_seed(opt.seed)
+    model = GeneralModel(opt).to(device).eval()
+    for slots in args.slots:
+        encoded_features = torch.rand(args.batch_size, slots, model.v2a_layer.in_features, device=device)
+        hiddens = [torch.rand(args.batch_size, opt.captioner_size, device=device) for _ in range(args.steps)]
+        per_step, out = run(model, encoded_features, hiddens, False, args.repeats)
+        hoisted, out_hoisted = run(model, encoded_features, hiddens, True, args.repeats)
+        print('slots %3d  %8.3f ms/step projected per step  %8.3f ms/step hoisted  (x%.2f)  max diff %.1e' % (
+            slots, per_step * 1000, hoisted * 1000, per_step / hoisted, (out - out_hoisted).abs().max().item()))
@@ -0,0 +1,152 @@
+"""
+Benchmark DataLoader.get_batch throughput on synthetic MSR-VTT sized data
+
+python misc/benchmark_dataloader.py --num_videos 6513 --num_batches 200
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import h5py
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dataloader import DataLoader
+from feature_store import pack_features, pad_boxes, convert_features, half_path
+
+
+def make_synthetic_dataset(out_dir, num_videos=6513, feat_dims=(1536, 4096, 20), roi_dim=1024, max_rois=20,
+                           captions_per_video=20, seq_length=30, svo_length=3, vocab_size=10000, seed=123):
+    """Write label, feature and roi h5 files shaped like the MSR-VTT ones"""
+    rng = np.random.RandomState(seed)
+    videos = np.arange(num_videos)
+
+    paths = {'label_h5': os.path.join(out_dir, 'label.h5'),
+             'feat_h5': [os.path.join(out_dir, 'feat_%d.h5' % ii) for ii in range(len(feat_dims))],
+             'bfeat_h5': [os.path.join(out_dir, 'roi_feat.h5'), os.path.join(out_dir, 'roi_box.h5')],
+             'fr_size_h5': os.path.join(out_dir, 'fr_size.h5')}
+
+    num_caps = rng.randint(captions_per_video // 2, captions_per_video * 2, size=num_videos)
+    ends = np.cumsum(num_caps)
+    starts = ends - num_caps
+    lengths = rng.randint(5, seq_length, size=ends[-1])
+    labels = rng.randint(3, vocab_size, size=(ends[-1], seq_length))
+    labels[np.arange(seq_length)[None, :] >= lengths[:, None]] = 0
+    labels[:, 0] = 1
+    labels_svo = labels[:, 1:svo_length + 1]
+
+    with h5py.File(paths['label_h5'], 'w') as f:
+        f.create_dataset('videos', data=np.array([str(v).encode() for v in videos]))
+        f.create_dataset('vocab', data=np.array([('w%d' % w).encode() for w in range(vocab_size)]))
+        f.create_dataset('labels', data=labels)
+        f.create_dataset('label_start_ix', data=starts)
+        f.create_dataset('label_end_ix', data=ends)
+        f.create_dataset('labels_svo', data=labels_svo)
+        f.create_dataset('label_start_ix_svo', data=starts)
+        f.create_dataset('label_end_ix_svo', data=ends)
+
+    for path, dim in zip(paths['feat_h5'], feat_dims):
+        with h5py.File(path, 'w') as f:
+            for v in videos:
+                f.create_dataset(str(v), data=rng.rand(dim).astype(np.float32))
+
+    with h5py.File(paths['bfeat_h5'][0], 'w') as ff, h5py.File(paths['bfeat_h5'][1], 'w') as fb:
+        for v in videos:
+            nb = rng.randint(1, max_rois + 1)
+            ff.create_dataset(str(v), data=rng.rand(nb, roi_dim).astype(np.float32))
+            fb.create_dataset(str(v), data=rng.rand(nb, 4).astype(np.float32))
+
+    with h5py.File(paths['fr_size_h5'], 'w') as f:
+        for v in videos:
+            f.create_dataset(str(v), data=np.array([240, 320, 3]))
+
+    return paths
+
+
+def with_suffix(path, suffix):
+    return path.replace('.h5', suffix + '.h5')
+
+
+def prepare_packed(paths):
+    packed = dict(paths)
+    for key in ['feat_h5', 'bfeat_h5']:
+        packed[key] = [with_suffix(p, '_packed') for p in paths[key]]
+        for src, dst in zip(paths[key], packed[key]):
+            if not os.path.exists(dst):
+                pack_features(src, dst)
+    return packed
+
+
+def prepare_padded(paths, num_boxes=10):
+    padded = prepare_packed(paths)
+    padded['bfeat_h5'] = [with_suffix(p, '_padded') for p in paths['bfeat_h5']]
+    if not all(os.path.exists(p) for p in padded['bfeat_h5']):
+        pad_boxes(paths['bfeat_h5'], padded['bfeat_h5'], num_boxes)
+    return padded
+
+
+def prepare_packed_fp16(paths):
+    half = prepare_packed(paths)
+    for key in ['feat_h5', 'bfeat_h5']:
+        for src in half[key]:
+            if not os.path.exists(half_path(src)):
+                convert_features(src, half_path(src))
+        half[key] = [half_path(p) for p in half[key]]
+    return half
+
+
+# name -> (function preparing the input files, extra DataLoader options)
+MODES = {
+    'h5': (lambda paths: paths, {}),
+    'packed': (prepare_packed, {'feat_mmap': 0}),
+    'packed_mmap': (prepare_packed, {'feat_mmap': 1}),
+    'labels_in_memory': (prepare_packed, {'feat_mmap': 1, 'labels_in_memory': 1}),
+    'buffer_pool': (prepare_packed, {'feat_mmap': 1, 'labels_in_memory': 1, 'buffer_pool': 4}),
+    'padded_rois': (prepare_padded, {'feat_mmap': 1, 'labels_in_memory': 1, 'buffer_pool': 4}),
+    'fp16_files': (prepare_packed_fp16, {'feat_mmap': 1, 'labels_in_memory': 1, 'buffer_pool': 4}),
+    'fp16_batches': (prepare_packed_fp16, {'feat_mmap': 1, 'labels_in_memory': 1, 'buffer_pool': 4, 'feat_dtype': 'float16'}),
+}
+
+
+def benchmark(paths, loader_opt, num_batches, warmup=5):
+    opt = dict(paths)
+    opt.update(loader_opt)
+    loader = DataLoader(opt)
+    for _ in range(warmup):
+        loader.get_batch()
+    start = time.time()
+    for _ in range(num_batches):
+        loader.get_batch()
+    elapsed = time.time() - start
+    stats = loader.get_buffer_stats()
+    loader.close()
+    total = warmup + num_batches
+    return num_batches / elapsed, stats['allocs'] / float(total), stats['bytes'] / float(total) / 2 ** 20
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', type=str, default=None, help='where to write/reuse the synthetic data (default: temp dir)')
+    parser.add_argument('--num_videos', type=int, default=6513)
+    parser.add_argument('--num_batches', type=int, default=200)
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--seq_per_img', type=int, default=20)
+    parser.add_argument('--modes', type=str, nargs='+', default=list(MODES.keys()), choices=list(MODES.keys()))
+    args = parser.parse_args()
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='saat_bench_')
+    os.makedirs(data_dir, exist_ok=True)
+    print('Writing synthetic data (%d videos) to %s' % (args.num_videos, data_dir))
+    paths = make_synthetic_dataset(data_dir, num_videos=args.num_videos)
+
+    base_opt = {'batch_size': args.batch_size, 'seq_per_img': args.seq_per_img, 'mode': 'train'}
+    results = {}
+    for mode in args.modes:
+        prepare, mode_opt = MODES[mode]
+        loader_opt = dict(base_opt)
+        loader_opt.update(mode_opt)
+        results[mode], allocs, mbytes = benchmark(prepare(paths), loader_opt, args.num_batches)
+        print('%-18s %8.1f batches/s  (x%.2f vs h5)  %6.2f buffer allocs/batch  %8.2f MB allocated/batch' % (
+            mode, results[mode], results[mode] / results.get('h5', results[mode]), allocs, mbytes))
@@ -0,0 +1,72 @@
+"""
+Benchmark transformer beam search latency with and without the key/value cache on a randomly initialised model,
+for a range of caption lengths. Other arguments are passed on to opts (e.g. --grounder_type iuc --decouple 1)
+
+python misc/benchmark_decoding.py --lengths 10 20 30 50 --batch_size 32 --device cuda
+"""
+import os
+import sys
+import time
+import argparse
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import opts
+from model import GeneralModel, GeneralModelDecoupled
+
+
+def build_model(opt, caption_length, device):
+    opt.seq_length = caption_length
+    torch.manual_seed(opt.seed)
+    model = GeneralModelDecoupled(opt) if opt.decouple else GeneralModel(opt)
+    return model.to(device).eval()
+
+
+def make_batch(opt, batch_size, num_boxes, device):
+    feats = [torch.rand(batch_size, opt.num_chunks, dim, device=device) for dim in opt.feat_dims]
+    bfeats = [torch.rand(batch_size, num_boxes, dim, device=device) for dim in opt.bfeat_dims]
+    concepts = torch.randint(3, opt.vocab_size, (batch_size, opt.svo_length), device=device)
+    return feats, bfeats, concepts
+
+
+def run(model, batch, beam_size, repeats):
+    with torch.no_grad():
+        out = model.sample(*batch, opt={'beam_size': beam_size})
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.time()
+        for _ in range(repeats):
+            model.sample(*batch, opt={'beam_size': beam_size})
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+    return (time.time() - start) / repeats, out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lengths', type=int, nargs='+', default=[10, 20, 30, 50], help='caption lengths (seq_length) to time')
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--vocab_size', type=int, default=10000)
+    parser.add_argument('--num_boxes', type=int, default=10)
+    args, rest = parser.parse_known_args()
+    sys.argv = sys.argv[:1] + ['--captioner_type', 'transformer'] + rest
+    opt = opts.parse_opts()
+    opt.vocab_size = args.vocab_size
+    opt.svo_length = opt.num_concepts
+    opt.feat_dims = [1536, 4096, 20]
+    opt.bfeat_dims = [1024, 4]
+    device = torch.device(opt.device or ('cuda' if torch.cuda.is_available() else 'cpu'))
+
+    batch = make_batch(opt, args.batch_size, args.num_boxes, device)
+    for caption_length in args.lengths:
+        times = {}
+        outs = {}
+        for kv_cache in [0, 1]:
+            opt.kv_cache = kv_cache
+            model = build_model(opt, caption_length, device)
+            times[kv_cache], outs[kv_cache] = run(model, batch, opt.beam_size, args.repeats)
+        same = torch.equal(outs[0][0], outs[1][0])
+        print('length %3d  %8.1f ms/batch full prefix  %8.1f ms/batch cached  (x%.2f)  same captions: %s' % (
+            caption_length, times[0] * 1000, times[1] * 1000, times[0] / times[1], same))
@@ -0,0 +1,114 @@
+"""
+Benchmark a training step (forward and backward) with the grounder run on seq_per_img copies of the features
+and once per video (--encode_per_video), on a randomly initialised model: time, memory saved for backward
+(and peak cuda memory) and the difference of the losses with dropout off. Other arguments are passed on to opts,
+the grounder defaults to niuc
+
+python misc/benchmark_encoding.py --grounder_type niuc --seq_per_img 20 --batch_size 32 --device cuda
+"""
+import os
+import sys
+import time
+import argparse
+
+import torch
+import torch.nn as nn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import opts
+from model import GeneralModel, GeneralModelDecoupled, CrossEntropyCriterion
+
+
+def build_model(opt, device):
+    torch.manual_seed(opt.seed)
+    model = GeneralModelDecoupled(opt) if opt.decouple else GeneralModel(opt)
+    return model.to(device).train()
+
+
+def make_batch(opt, batch_size, seq_per_img, num_boxes, device):
+    feats = [torch.rand(batch_size, opt.num_chunks, dim, device=device) for dim in opt.feat_dims]
+    bfeats = [torch.rand(batch_size, num_boxes, dim, device=device) for dim in opt.bfeat_dims]
+    labels = torch.randint(3, opt.vocab_size, (batch_size * seq_per_img, opt.seq_length), device=device)
+    labels[:, 0] = 1
+    labels[:, -4:] = 0
+    masks = (labels != 0).float()
+    masks[:, -4] = 1  # <eos>
+    concepts = torch.randint(3, opt.vocab_size, (batch_size * seq_per_img, opt.svo_length), device=device)
+    return feats, bfeats, labels, masks, concepts
+
+
+def no_dropout(model):
+    for module in model.modules():
+        if isinstance(module, nn.Dropout):
+            module.p = 0.0
+        elif isinstance(module, nn.MultiheadAttention):
+            module.dropout = 0.0
+
+
+def train_step(model, criterion, batch):
+    feats, bfeats, labels, masks, concepts = batch
+    saved = [0]
+
+    def pack(tensor):
+        saved[0] += tensor.numel() * tensor.element_size()
+        return tensor
+
+    model.zero_grad()
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        out = model(feats, bfeats, labels, concepts)
+        loss = criterion(out[0], labels[:, 1:], masks[:, 1:])
+        if out[3] is not None:  # the grounder's concept probabilities, a stand-in for the concept loss
+            loss = loss + out[3].mean()
+    loss.backward()
+    return loss, saved[0]
+
+
+def run(model, criterion, batch, repeats):
+    train_step(model, criterion, batch)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.time()
+    for _ in range(repeats):
+        loss, saved = train_step(model, criterion, batch)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    peak = torch.cuda.max_memory_allocated() if torch.cuda.is_available() else 0
+    return (time.time() - start) / repeats, saved, peak
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--seq_per_img', type=int, default=20)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--vocab_size', type=int, default=10000)
+    parser.add_argument('--num_boxes', type=int, default=10)
+    args, rest = parser.parse_known_args()
+    # the features are expanded to the captions by the grounder, without one there is nothing to compare
+    sys.argv = sys.argv[:1] + ['--grounder_type', 'niuc'] + rest
+    opt = opts.parse_opts()
+    if opt.grounder_type in ['None', 'none']:
+        parser.error('--grounder_type %s: the benchmark compares grounding per caption and per video, '
+                     'it needs a grounder (niuc, iuc, nioc or ioc)' % opt.grounder_type)
+    opt.train_seq_per_img = args.seq_per_img
+    opt.vocab_size = args.vocab_size
+    opt.seq_length = 30
+    opt.svo_length = opt.num_concepts
+    opt.feat_dims = [1536, 4096, 20]
+    opt.bfeat_dims = [1024, 4]
+    device = torch.device(opt.device or ('cuda' if torch.cuda.is_available() else 'cpu'))
+
+    batch = make_batch(opt, args.batch_size, args.seq_per_img, args.num_boxes, device)
+    criterion = CrossEntropyCriterion()
+    losses = {}
+    for encode_per_video in [0, 1]:
+        opt.encode_per_video = encode_per_video
+        model = build_model(opt, device)
+        elapsed, saved, peak = run(model, criterion, batch, args.repeats)
+        no_dropout(model)
+        torch.manual_seed(opt.seed)
+        losses[encode_per_video] = train_step(model, criterion, batch)[0].item()
+        print('encode_per_video %d  %8.1f ms/step  %8.1f MB saved for backward  %8.1f MB peak cuda' % (
+            encode_per_video, elapsed * 1000, saved / 2 ** 20, peak / 2 ** 20))
+    print('loss without dropout %.6f / %.6f' % (losses[0], losses[1]))
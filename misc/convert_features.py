@@ -0,0 +1,26 @@
+"""
+Store feature h5 files (per-video or packed) in float16, next to the originals as <name>_fp16.h5,
+the DataLoader reads them as float32 again unless --feat_dtype float16 is given
+
+python misc/convert_features.py datasets/msrvtt/features/msrvtt_train_irv2_mp1.h5 datasets/msrvtt/features/msrvtt_roi_feat.h5
+"""
+import os
+import sys
+import argparse
+import logging
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from feature_store import convert_features, half_path
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('in_h5', type=str, nargs='+', help='feature h5 files to convert')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s:%(levelname)s: %(message)s')
+    for in_h5 in args.in_h5:
+        out_h5 = half_path(in_h5)
+        errors = convert_features(in_h5, out_h5)
+        print('%s -> %s: %.1f MB -> %.1f MB, max abs error %.3g, max rel error %.3g' % (
+            in_h5, out_h5, os.path.getsize(in_h5) / 2. ** 20, os.path.getsize(out_h5) / 2. ** 20,
+            errors['max_abs'], errors['max_rel']))
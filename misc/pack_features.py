@@ -0,0 +1,22 @@
+"""
+Pack per-video feature h5 files into one contiguous array with a video -> row offset table,
+the DataLoader picks the packed reader automatically when given the output file
+
+python misc/pack_features.py datasets/msrvtt/features/msrvtt_train_irv2_mp1.h5 datasets/msrvtt/features/msrvtt_train_irv2_mp1_packed.h5
+"""
+import os
+import sys
+import argparse
+import logging
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from feature_store import pack_features
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('in_h5', type=str, help='per-video feature h5 file')
+    parser.add_argument('out_h5', type=str, help='packed h5 file to write')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s:%(levelname)s: %(message)s')
+    pack_features(args.in_h5, args.out_h5)
@@ -0,0 +1,23 @@
+"""
+Cycle the rois of every video to a fixed number of boxes and store them as one (num_videos, num_boxes, dim) array
+plus the number of real boxes per video, written next to the inputs as <name>_padded.h5.
+All roi files of a dataset are converted together, the boxes of every video are checked to agree between them
+
+python misc/pad_boxes.py --num_boxes 10 datasets/msrvtt/features/msrvtt_roi_feat.h5 datasets/msrvtt/features/msrvtt_roi_box.h5
+"""
+import os
+import sys
+import argparse
+import logging
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from feature_store import pad_boxes
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('in_h5', type=str, nargs='+', help='roi h5 files (per-video or packed)')
+    parser.add_argument('--num_boxes', type=int, default=10, help='boxes per video, at least the num_boxes used for training')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s:%(levelname)s: %(message)s')
+    pad_boxes(args.in_h5, [os.path.splitext(p)[0] + '_padded.h5' for p in args.in_h5], args.num_boxes)
@@ -2,9 +2,132 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
+from torch.autograd.profiler import record_function
 import numpy as np
 import math
 
+from stage_timer import NULL_TIMER
+
+def subsequent_mask(size, device):
+    """Causal mask for nn.Transformer decoders (-inf above the diagonal), as generate_square_subsequent_mask builds it"""
+    return torch.triu(torch.full((size, size), float('-inf'), device=device), diagonal=1)
+
+
+def additive_attention(keys, query, att_layer, values):
+    """
+    Attention of the rnn captioners: keys (batch, slots, att_size) are the projected values, computed once per caption,
+    query (batch, att_size) the projected hidden state of this step, broadcast over the slots
+    returns the attended values (batch, channels)
+    """
+    alpha = att_layer(torch.tanh(keys + query.unsqueeze(1)))  # (batch, slots, 1)
+    alpha = F.softmax(alpha, dim=1).transpose(1, 2)  # (batch, 1, slots)
+    return torch.matmul(alpha, values).squeeze(1)
+
+
+def beam_search(step, batch_size, beam_size, caption_length, bos_index, device):
+    """
+    Beam search over all videos of a batch at once, the beams of video k are rows k * beam_size ... (k + 1) * beam_size - 1
+    step(it, token_idx, parent) feeds the words it (batch_size * beam_size,) and returns the logprobs of the next word,
+    parent is the row every beam was forked from, to reorder the decoder state with (see decode_step)
+    Beams keep expanding after <eos>, every beam ending in <eos> (or reaching the length limit) is a finished caption,
+    the finished caption with the lowest perplexity is returned
+    """
+    num_beams = batch_size * beam_size
+    first_beams = torch.arange(batch_size, device=device).unsqueeze(1) * beam_size
+
+    beam_seq = torch.zeros((num_beams, caption_length), dtype=torch.long, device=device)
+    beam_seq_logprobs = torch.zeros((num_beams, caption_length), device=device)
+    # running sum of logprobs for each beam
+    beam_logprobs_sum = torch.zeros((batch_size, beam_size), device=device)
+
+    seq = torch.zeros((batch_size, caption_length), dtype=torch.long, device=device)
+    seqLogprobs = torch.zeros((batch_size, caption_length), device=device)
+    best_ppl = torch.full((batch_size,), float('inf'), device=device)
+    found = torch.zeros(batch_size, dtype=torch.bool, device=device)
+
+    it = torch.full((num_beams,), bos_index, dtype=torch.long, device=device)
+    logprobs = step(it, 0, None)
+    for token_idx in range(1, caption_length - 1):
+        logprobsf = logprobs.float().view(batch_size, beam_size, -1)
+        vocab_size = logprobsf.size(2)
+        candidate_logprobs = beam_logprobs_sum.unsqueeze(2) + logprobsf
+        if token_idx == 1:  # at first time step only the first beam is active
+            candidate_logprobs[:, 1:] = float('-inf')
+        beam_logprobs_sum, candidates = candidate_logprobs.view(batch_size, -1).topk(beam_size, 1)
+
+        # fork beam q into the new beams and append word c to them
+        parent = (first_beams + candidates // vocab_size).view(-1)
+        it = (candidates % vocab_size).view(-1)
+        beam_seq = beam_seq[parent]
+        beam_seq_logprobs = beam_seq_logprobs[parent]
+        beam_seq[:, token_idx - 1] = it
+        beam_seq_logprobs[:, token_idx - 1] = logprobsf.view(batch_size, -1).gather(1, candidates).view(-1)  # the raw logprob here
+
+        # keep the finished beam of lowest perplexity, on ties the one finished first
+        if token_idx > 1:
+            ppl = torch.exp(-beam_logprobs_sum / (token_idx - 1))
+        else:
+            ppl = torch.full_like(beam_logprobs_sum, 10000)
+        done = (it == 0).view(batch_size, beam_size)
+        if token_idx == caption_length - 2:  # we reached the end
+            done[:] = True
+        step_ppl, step_beam = ppl.masked_fill(~done, float('inf')).min(1)
+        better = done.any(1) & ((step_ppl < best_ppl) | ~found)
+        if better.any():
+            rows = (first_beams.squeeze(1) + step_beam)[better]
+            seq[better] = beam_seq[rows]
+            seqLogprobs[better] = beam_seq_logprobs[rows]
+            best_ppl[better] = step_ppl[better]
+            found |= better
+        if token_idx == caption_length - 2:
+            break
+
+        # logprobs only decrease along a beam, so once no continuation of the best beam can get
+        # a lower perplexity within the length limit, the result is final
+        best_sum = beam_logprobs_sum.max(1)[0]
+        bound = torch.min(torch.exp(-best_sum / token_idx), torch.exp(-best_sum / (caption_length - 3)))
+        if (found & (best_ppl <= bound)).all():
+            break
+
+        logprobs = step(it, token_idx, parent)
+
+    return seq.cpu(), seqLogprobs.cpu()
+
+
+def sample_sequences(step, num_rows, caption_length, bos_index, device, sample_max=1, temperature=1.0):
+    """
+    Greedy (sample_max 1) or multinomial decoding of num_rows captions at once with a decode_step function,
+    returns the words and their logprobs (num_rows, caption_length), zero after each row's <eos>
+    decoding stops as soon as every row has produced <eos>
+    """
+    seq = []
+    seqLogprobs = []
+    unfinished = torch.ones(num_rows, dtype=torch.bool, device=device)
+
+    it = torch.full((num_rows,), bos_index, dtype=torch.long, device=device)
+    logprobs = step(it, 0, None)
+    for token_idx in range(1, caption_length - 1):
+        if sample_max:
+            it = logprobs.argmax(1)
+        else:
+            it = torch.multinomial(torch.exp(logprobs.detach() / temperature), 1).squeeze(1)
+        sampleLogprobs = logprobs.gather(1, it.unsqueeze(1)).squeeze(1)
+
+        # the <eos> word itself is kept, nothing after it
+        seq.append(it * unfinished.long())
+        seqLogprobs.append(sampleLogprobs * unfinished.float())
+        unfinished = unfinished & (it != 0)
+        if not unfinished.any():
+            break
+
+        logprobs = step(it, token_idx, None)
+
+    seq = torch.stack(seq, 1)
+    seqLogprobs = torch.stack(seqLogprobs, 1)
+    padding = caption_length - seq.size(1)
+    return F.pad(seq, (0, padding)), F.pad(seqLogprobs, (0, padding))
+
+
 def to_contiguous(tensor):
     if tensor.is_contiguous():
         return tensor
@@ -12,19 +135,24 @@ def to_contiguous(tensor):
         return tensor.contiguous()
 
 
+def reward_mask(seq):
+    """The tokens of sampled captions RewardCriterion learns from, their words and the <eos>"""
+    mask = (seq > 0).float()
+    # add one to the right to count for the <eos> token
+    return torch.cat([mask.new(mask.size(0), 1).fill_(1), mask[:, :-1]], 1)
+
+
 class RewardCriterion(nn.Module):
     def __init__(self):
         super(RewardCriterion, self).__init__()
 
-    def forward(self, seq, logprobs, reward):
+    def forward(self, seq, logprobs, reward, num_tokens=None):
+        """num_tokens: the tokens of the whole batch when seq is a micro-batch of it, its own tokens by default"""
         logprobs = to_contiguous(logprobs).view(-1)
         reward = to_contiguous(reward).view(-1)
-        mask = (seq > 0).float()
-        # add one to the right to count for the <eos> token
-        mask = to_contiguous(torch.cat(
-            [mask.new(mask.size(0), 1).fill_(1), mask[:, :-1]], 1)).view(-1)
+        mask = to_contiguous(reward_mask(seq)).view(-1)
         output = - logprobs * reward * Variable(mask)
-        output = torch.sum(output) / torch.sum(mask)
+        output = torch.sum(output) / (torch.sum(mask) if num_tokens is None else num_tokens)
 
         return output
 
@@ -47,7 +175,7 @@ class CrossEntropyCriterion(nn.Module):
         if bcmrscores is not None:
             weights = bcmrscores.view(-1).unsqueeze(1).repeat(1, seq_len).view(-1, 1)
         else:
-            weights = torch.ones(output.shape).cuda() 
+            weights = torch.ones_like(output)
         output = torch.sum(output*weights) / torch.sum(mask)
 
         return output
@@ -90,18 +218,8 @@ class FeatExpander(nn.Module):
 
     def forward(self, x):
         if self.n == 1:
-            out = x
-        else:
-            if len(x.shape) == 2:
-                out = Variable(x.data.new(self.n * x.size(0), x.size(1)), volatile=x.volatile)
-                for i in range(x.size(0)):
-                    out[i * self.n:(i + 1) * self.n] = x[i].expand(self.n, x.size(1))
-            elif len(x.shape) == 3:
-                out = Variable(x.data.new(self.n * x.size(0), x.size(1), x.size(2)), volatile=x.volatile)
-                for i in range(x.size(0)):
-                    out[i * self.n:(i + 1) * self.n] = x[i].expand(self.n, x.size(1), x.size(2))
-
-        return out
+            return x
+        return x.repeat_interleave(self.n, dim=0)
 
     def set_n(self, x):
         self.n = x
@@ -167,11 +285,68 @@ class PositionalEncoding(nn.Module):
         pe = pe.unsqueeze(0).transpose(0, 1)
         self.register_buffer('pe', pe)
 
-    def forward(self, x):
-        x = x + self.pe[:x.size(0), :]
+    def forward(self, x, start=0):
+        x = x + self.pe[start:start + x.size(0), :]
         return self.dropout(x)
 
 
+class IncrementalDecoder(object):
+    """
+    Runs an nn.TransformerDecoder one target position at a time. The self-attention keys/values of every layer
+    and the projected memory are cached, so a step only processes the newest token
+    step t gives the last position of decoder(tgt[:t + 1], memory, tgt_mask=subsequent_mask(t + 1))
+    """
+
+    def __init__(self, decoder, memory):
+        self.decoder = decoder
+        self.memory_kv = [(self._in_proj(layer.multihead_attn, memory, 1), self._in_proj(layer.multihead_attn, memory, 2))
+                          for layer in decoder.layers]
+        self.self_kv = [None for _ in decoder.layers]
+
+    @staticmethod
+    def _in_proj(attn, x, i):
+        """i-th (0: query, 1: key, 2: value) input projection of an nn.MultiheadAttention"""
+        rows = slice(i * attn.embed_dim, (i + 1) * attn.embed_dim)
+        return F.linear(x, attn.in_proj_weight[rows], None if attn.in_proj_bias is None else attn.in_proj_bias[rows])
+
+    @staticmethod
+    def _attend(attn, q, k, v):
+        """attention of q (1, batch, channels) over k, v (time, batch, channels)"""
+        batch_size = q.size(1)
+        head_dim = attn.embed_dim // attn.num_heads
+        q = q.reshape(1, batch_size * attn.num_heads, head_dim).transpose(0, 1)
+        k = k.reshape(k.size(0), batch_size * attn.num_heads, head_dim).transpose(0, 1)
+        v = v.reshape(v.size(0), batch_size * attn.num_heads, head_dim).transpose(0, 1)
+        weights = F.softmax(torch.bmm(q, k.transpose(1, 2)) / math.sqrt(head_dim), dim=-1)
+        weights = F.dropout(weights, p=attn.dropout, training=attn.training)
+        out = torch.bmm(weights, v).transpose(0, 1).reshape(1, batch_size, attn.embed_dim)
+        return attn.out_proj(out)
+
+    def step(self, x):
+        """x is the embedded newest token (1, batch, channels), returns the decoder output at its position"""
+        for ii, layer in enumerate(self.decoder.layers):
+            attn = layer.self_attn
+            k, v = self._in_proj(attn, x, 1), self._in_proj(attn, x, 2)
+            if self.self_kv[ii] is not None:
+                k = torch.cat([self.self_kv[ii][0], k])
+                v = torch.cat([self.self_kv[ii][1], v])
+            self.self_kv[ii] = (k, v)
+            x = layer.norm1(x + layer.dropout1(self._attend(attn, self._in_proj(attn, x, 0), k, v)))
+
+            attn = layer.multihead_attn
+            x = layer.norm2(x + layer.dropout2(self._attend(attn, self._in_proj(attn, x, 0), *self.memory_kv[ii])))
+
+            activation = getattr(layer, 'activation', F.relu)
+            x = layer.norm3(x + layer.dropout3(layer.linear2(layer.dropout(activation(layer.linear1(x))))))
+        if self.decoder.norm is not None:
+            x = self.decoder.norm(x)
+        return x
+
+    def reorder(self, rows):
+        """Keep the cached tokens of the given batch rows, e.g. to fork beams"""
+        self.self_kv = [(k[:, rows], v[:, rows]) for k, v in self.self_kv]
+
+
 class GeneralModel(nn.Module):
     """
     A general model which does it all
@@ -195,9 +370,13 @@ class GeneralModel(nn.Module):
         self.caption_length = opt.seq_length
         self.seq_per_img = opt.train_seq_per_img
         self.model_type = opt.model_type
+        self.kv_cache = opt.kv_cache
+        self.encode_per_video = opt.encode_per_video
+        self.amp = opt.amp
         self.bos_index = 1  # index of the <bos> token
         self.ss_prob = 0
         self.mixer_from = 0
+        self.timer = NULL_TIMER
         self.attention_record = list()
 
         self.feat_expander = FeatExpander(self.seq_per_img)
@@ -262,7 +441,7 @@ class GeneralModel(nn.Module):
             self.encoders = list()
             for _ in range(self.num_concepts):
                 self.encoders.append(nn.Sequential(nn.Linear(self.visual_encoding_size, self.visual_encoding_size), nn.ReLU(), nn.Dropout(self.drop_prob_lm)))
-            self.encoders = nn.ModuleList(self.encoders).cuda()
+            self.encoders = nn.ModuleList(self.encoders)
         elif self.grounder_type in ['iuc', 'ioc']:
             self.concept_pos_encoder = PositionalEncoding(self.textual_encoding_size, dropout=self.drop_prob_lm, max_len=self.num_concepts+1)
             # iterative
@@ -304,10 +483,33 @@ class GeneralModel(nn.Module):
         """
         self.mixer_from = t
 
+    def attention_query(self, state):
+        """The hidden state the attention of the next step looks from (batch, captioner_size)"""
+        if self.captioner_layers > 1:
+            return state[0][-1]
+        elif self.captioner_type in ['gru']:
+            return state[0]
+        else:
+            return state[0][0]
+
+    def autocast(self):
+        """Mixed precision of --amp, float16 on cuda and bfloat16 on cpu. Log-probabilities are kept in float32"""
+        device_type = self.device.type
+        return torch.autocast(device_type, dtype=torch.float16 if device_type == 'cuda' else torch.bfloat16,
+                              enabled=bool(self.amp))
+
+    def set_timer(self, timer):
+        """StageTimer of the training loop, forward() times its grounder and captioner stages with it"""
+        self.timer = timer
+
     def set_seq_per_img(self, x):
         self.seq_per_img = x
         self.feat_expander.set_n(x)
 
+    @property
+    def device(self):
+        return next(self.parameters()).device
+
     def init_weights(self):
         initrange = 0.1
         self.embed.weight.data.uniform_(-initrange, initrange)
@@ -346,7 +548,7 @@ class GeneralModel(nn.Module):
         # encode the features to concept-vocab size and sigmoid
         scores = self.logit(feats_).squeeze(1)
 
-        concept_probs = F.sigmoid(scores)
+        concept_probs = F.sigmoid(scores.float())
         top_v, top_i = torch.topk(concept_probs, k=self.num_concepts)  # get the top preds
         mask = top_v > .5  # mask threshold
         top_emb = self.embed(top_i)
@@ -384,7 +586,7 @@ class GeneralModel(nn.Module):
             hidden = self.encoders[i](att_feat)
 
             # encode to logits and apply softmax to get word probabilities
-            out = F.log_softmax(self.logit(hidden), dim=-1)
+            out = F.log_softmax(self.logit(hidden).float(), dim=-1)
             pred_outs.append(out)
             # argmax the subject
             it = F.softmax(self.logit(hidden), dim=-1).argmax(-1)
@@ -405,7 +607,7 @@ class GeneralModel(nn.Module):
             gt_concepts = gt_concepts[:, :-1]
             concept_embeddings = self.embed(gt_concepts)
             concept_embeddings = concept_embeddings.permute(1, 0, 2)  # change to (time, batch, channel)
-            tgt_mask = nn.Transformer.generate_square_subsequent_mask(None, self.num_concepts).cuda()
+            tgt_mask = subsequent_mask(self.num_concepts, self.device)
             tgt_key_padding_mask = (gt_concepts == 0)  # create padding mask
             if self.concept_pos_encoder is not None:
                 concept_embeddings = self.concept_pos_encoder(concept_embeddings)
@@ -413,28 +615,36 @@ class GeneralModel(nn.Module):
             out = out.permute(1, 0, 2)  # change back to (batch, concepts, channels)
 
             concept_idxs = F.softmax(self.logit(out), dim=-1).argmax(-1)
-            concept_probs = F.log_softmax(self.logit(out), dim=-1)
-            concept_probs_sigmoid = F.sigmoid(self.logit(out))
+            concept_probs = F.log_softmax(self.logit(out).float(), dim=-1)
+            concept_probs_sigmoid = F.sigmoid(self.logit(out).float())
 
         else:  # auto-regressive prediction at inference
 
-            concept_probs = torch.zeros((feats.size(1), self.num_concepts, self.vocab_size)).cuda()
-            concept_probs_sigmoid = torch.zeros((feats.size(1), self.num_concepts, self.vocab_size)).cuda()
-            concept_idxs = torch.zeros((feats.size(1), self.num_concepts), dtype=torch.long).cuda()
+            concept_probs = torch.zeros((feats.size(1), self.num_concepts, self.vocab_size), device=self.device)
+            concept_probs_sigmoid = torch.zeros((feats.size(1), self.num_concepts, self.vocab_size), device=self.device)
+            concept_idxs = torch.zeros((feats.size(1), self.num_concepts), dtype=torch.long, device=self.device)
             concept_idxs = F.pad(concept_idxs, (1, 0, 0, 0), "constant", self.bos_index)
 
+            if self.kv_cache:
+                cache = IncrementalDecoder(self.concept_decoder, feats)
             for i in range(1, self.num_concepts+1):
-                decoder_input = self.embed(concept_idxs[:, :i])
+                if self.kv_cache:  # only feed the newest concept
+                    decoder_input = self.embed(concept_idxs[:, i - 1:i]).permute(1, 0, 2)
+                    if self.concept_pos_encoder is not None:
+                        decoder_input = self.concept_pos_encoder(decoder_input, i - 1)  # add positional encoding
+                    decoder_output = cache.step(decoder_input)
+                else:
+                    decoder_input = self.embed(concept_idxs[:, :i])
 
-                tgt_mask = nn.Transformer.generate_square_subsequent_mask(None, i).cuda()
-                decoder_input = decoder_input.permute(1, 0, 2)
-                if self.concept_pos_encoder is not None:
-                    decoder_input = self.concept_pos_encoder(decoder_input)  # add positional encoding
-                decoder_output = self.concept_decoder(decoder_input, feats, tgt_mask=tgt_mask)
+                    tgt_mask = subsequent_mask(i, self.device)
+                    decoder_input = decoder_input.permute(1, 0, 2)
+                    if self.concept_pos_encoder is not None:
+                        decoder_input = self.concept_pos_encoder(decoder_input)  # add positional encoding
+                    decoder_output = self.concept_decoder(decoder_input, feats, tgt_mask=tgt_mask)
 
                 concept_idxs[:, i] = F.softmax(self.logit(decoder_output[-1]), dim=-1).argmax(-1)
-                concept_probs[:, i - 1] = F.log_softmax(self.logit(decoder_output[-1]), dim=-1)
-                concept_probs_sigmoid[:, i - 1] = F.sigmoid(self.logit(decoder_output[-1]))
+                concept_probs[:, i - 1] = F.log_softmax(self.logit(decoder_output[-1]).float(), dim=-1)
+                concept_probs_sigmoid[:, i - 1] = F.sigmoid(self.logit(decoder_output[-1]).float())
 
             concept_idxs = concept_idxs[:, 1:]  # remove '<bos>'
 
@@ -449,7 +659,7 @@ class GeneralModel(nn.Module):
         caption_embeddings = self.embed(gt_caption)  # emb indexs -> embeddings
         caption_embeddings = caption_embeddings.permute(1, 0, 2)  # change to (time, batch, channel)
         caption_embeddings = self.pos_encoder(caption_embeddings)  # add positional encoding
-        tgt_mask = nn.Transformer.generate_square_subsequent_mask(None, gt_caption.size(-1)).cuda()  # create sequence mask
+        tgt_mask = subsequent_mask(gt_caption.size(-1), self.device)  # create sequence mask
         tgt_key_padding_mask = (gt_caption == 0)  # create padding mask
 
         # Run the decoder
@@ -459,7 +669,7 @@ class GeneralModel(nn.Module):
                                    tgt_key_padding_mask=tgt_key_padding_mask)
 
         out = out[:-1].permute(1, 0, 2)  # remove the last token and change back to (batch, concepts, channels)
-        caption_probs = F.log_softmax(self.logit(self.dropout(out)), dim=-1)  # calc word probs
+        caption_probs = F.log_softmax(self.logit(self.dropout(out)).float(), dim=-1)  # calc word probs
         caption_seq = F.softmax(self.logit(out), dim=-1).argmax(-1)  # get best word indexs
 
         caption_seq = gt_caption[:, 1:]  # get gt caption (minus the BOS token)
@@ -479,6 +689,8 @@ class GeneralModel(nn.Module):
         # -- the <eos> token is not used for training
         start_i = -1 if self.model_type == 'standard' else 0
         end_i = gt_caption.size(1) - 1
+        # the visual side of the attention doesn't change while decoding
+        att_keys = self.v2a_layer(encoded_features)
 
         for token_idx in range(start_i, end_i):
             if token_idx == -1:  # initially set xt as global feats
@@ -520,16 +732,8 @@ class GeneralModel(nn.Module):
                 xt = self.embed(it)
 
                 # calculate attention over visual features based on visual feats
-                if self.captioner_layers > 1:
-                    hid_cont = state[0][-1].unsqueeze(0).transpose(0, 1).expand(batch_size, encoded_features.shape[1], state[0].shape[2])  # (bs * seq_per_img, 1, 512)
-                elif self.captioner_type in ['gru']:
-                    hid_cont = state.transpose(0, 1).expand(batch_size, encoded_features.shape[1], state.shape[2])  # (bs * seq_per_img, 1, 512)
-                else:
-                    hid_cont = state[0].transpose(0, 1).expand(batch_size, encoded_features.shape[1], state[0].shape[2])  # (bs * seq_per_img, 1, 512)
-
-                alpha = self.att_layer(torch.tanh(self.v2a_layer(encoded_features) + self.h2a_layer(hid_cont)))  # (bs * seq_per_img, 2, 1)
-                alpha = F.softmax(alpha, dim=1).transpose(1, 2)  # (bs * seq_per_img, 1, 2)
-                att_encoded_features = torch.matmul(alpha, encoded_features).squeeze(1)
+                att_encoded_features = additive_attention(att_keys, self.h2a_layer(self.attention_query(state)),
+                                                          self.att_layer, encoded_features)
 
             # generate next word
             if self.model_type == 'standard':
@@ -537,11 +741,12 @@ class GeneralModel(nn.Module):
             else:
                 if self.model_type == 'manet':
                     encoded_features = self.manet(att_encoded_features, state[0])
+                    att_keys = self.v2a_layer(encoded_features)
                 output, state = self.core(torch.cat([xt, att_encoded_features], 1), state)
 
             # generate the word softmax
             if token_idx >= 0:
-                output = F.log_softmax(self.logit(self.dropout(output)), dim=1)
+                output = F.log_softmax(self.logit(self.dropout(output)).float(), dim=1)
                 outputs.append(output)
 
         # only returns outputs of seq input
@@ -580,7 +785,11 @@ class GeneralModel(nn.Module):
         concept_probs = None
         concept_seq = None
         if self.grounder_type in ['niuc', 'nioc', 'iuc', 'ioc']:
-            if expand:
+            # with encode_per_video the grounder runs once per video and its outputs are repeated for the captions,
+            # unless it is teacher forced with the concepts of each caption
+            per_video = expand and self.encode_per_video and not (
+                self.training and gt_concepts is not None and self.grounder_type in ['nioc', 'iuc', 'ioc'])
+            if expand and not per_video:
                 encoded_features = self.feat_expander(encoded_features)
             if self.grounder_type in ['niuc']:
                 concept_probs, concept_seq = self.non_iterative_grounder(encoded_features)
@@ -590,6 +799,9 @@ class GeneralModel(nn.Module):
                 concept_probs, concept_seq = self.iterative_grounder(encoded_features, gt_concepts)
             else:
                 raise NotImplementedError
+            if per_video:
+                encoded_features, concept_probs, concept_seq = [
+                    self.feat_expander(x) for x in (encoded_features, concept_probs, concept_seq)]
 
             try:
                 if gt_concepts is not None and ((self.gt_concepts_while_training and self.training) or self.gt_concepts_while_testing):  # use gt concepts for cap gen
@@ -607,12 +819,15 @@ class GeneralModel(nn.Module):
 
     def forward(self, feats, bfeats, gt_caption, gt_concepts):
 
-        encoded_features, concept_probs, concept_seq = self.feature_filtering(feats, bfeats, gt_concepts, expand=True)
+        # the record_function ranges name the stages in --profile_steps traces
+        with self.autocast(), self.timer.stage('grounder'), record_function('grounder'):
+            encoded_features, concept_probs, concept_seq = self.feature_filtering(feats, bfeats, gt_concepts, expand=True)
 
-        if self.captioner_type in ['transformer']:  # Captioner - Transformer
-            caption_probs, caption_seq = self.captioner_transformer(encoded_features, gt_caption)
-        else:  # Captioner - RNN
-            caption_probs, caption_seq = self.captioner_rnn(encoded_features, gt_caption)
+        with self.autocast(), self.timer.stage('captioner'), record_function('captioner'):
+            if self.captioner_type in ['transformer']:  # Captioner - Transformer
+                caption_probs, caption_seq = self.captioner_transformer(encoded_features, gt_caption)
+            else:  # Captioner - RNN
+                caption_probs, caption_seq = self.captioner_rnn(encoded_features, gt_caption)
 
         # output size is: B x L x V (where L is truncated lengths
         # which are different for different batch)
@@ -624,166 +839,102 @@ class GeneralModel(nn.Module):
                    None, None, None
 
     def sample(self, feats, bfeats, gt_concepts, opt={}):
+        """
+        beam_size > 1: beam search, otherwise greedy (sample_max 1) or multinomial sampling at the given temperature,
+        with expand_feat 1 seq_per_img captions are sampled per video
+        """
         beam_size = opt.get('beam_size', 1)
 
-        encoded_features, concept_probs, concept_seq = self.feature_filtering(feats, bfeats, gt_concepts)
+        with self.autocast(), record_function('grounder'):
+            encoded_features, concept_probs, concept_seq = self.feature_filtering(feats, bfeats, gt_concepts)
 
         if beam_size > 1:
-            return ((*self.sample_beam(encoded_features, opt)), concept_probs, concept_seq)
+            with self.autocast(), record_function('sample_beam'):
+                return (*self.sample_beam(encoded_features, opt), concept_probs, concept_seq)
         else:
-            return NotImplementedError
+            with self.autocast(), record_function('sample_max_or_multinomial'):
+                return (*self.sample_max_or_multinomial(encoded_features, opt), concept_probs, concept_seq)
+
+    def sample_max_or_multinomial(self, encoded_features, opt={}):
+        sample_max = opt.get('sample_max', 1)
+        n = self.seq_per_img if opt.get('expand_feat', 0) else 1
+        batch_size = encoded_features.size(0)
+
+        # greedy captions of a video are all the same, decode once and repeat them
+        num_samples = 1 if sample_max else n
+        step = self.decode_step(encoded_features, num_samples)
+        seq, seqLogprobs = sample_sequences(step, batch_size * num_samples, self.caption_length, self.bos_index,
+                                            self.device, sample_max=sample_max, temperature=opt.get('temperature', 1.0))
+        if num_samples < n:
+            seq, seqLogprobs = seq.repeat_interleave(n, 0), seqLogprobs.repeat_interleave(n, 0)
+        return seq, seqLogprobs
 
     def sample_beam(self, encoded_features, opt={}):
         """
         modified from https://github.com/ruotianluo/self-critical.pytorch
+        all videos of the batch are decoded together, see beam_search
         """
         beam_size = opt.get('beam_size', 5)
+        step = self.decode_step(encoded_features, beam_size)
+        return beam_search(step, encoded_features.size(0), beam_size, self.caption_length, self.bos_index, self.device)
 
+    def decode_step(self, encoded_features, n=1):
+        """
+        Step function of the captioner over n rows per video (the rows of a video next to each other):
+        step(it, token_idx, parent) feeds the words it and returns the logprobs of the next word,
+        parent (None: keep the rows) picks the row of the previous step each row continues from
+        """
         batch_size = encoded_features.size(0)
 
-        seq = torch.LongTensor(self.caption_length, batch_size).zero_()
-        seqLogprobs = torch.FloatTensor(self.caption_length, batch_size)
-        # lets process every image independently for now, for simplicity
-
-        self.done_beams = [[] for _ in range(batch_size)]
-        state = []  # will be empty list for transformer decoder
-        for k in range(batch_size):
-            if self.captioner_type in ['rnn', 'lstm', 'gru']:
-                state = self.init_hidden(beam_size)
-            encoded_features_k = encoded_features[k].expand(beam_size, encoded_features.size(1), self.visual_encoding_size)
-
-            beam_seq = torch.LongTensor(self.caption_length, beam_size).zero_()
-            beam_seq_logprobs = torch.FloatTensor(self.caption_length, beam_size).zero_()
-            # running sum of logprobs for each beam
-            beam_logprobs_sum = torch.zeros(beam_size)
-
-            # -- if <image feature> is input at the first step, use index -1
-            start_i = -1 if self.model_type == 'standard' else 0
-            end_i = self.caption_length - 1
-
-            its = torch.LongTensor(self.caption_length, beam_size).zero_().cuda()  #TODO TRAN ONLY
-            for token_idx in range(start_i, end_i):
-                if token_idx == 0:  # input <bos>
-                    it = encoded_features.data.new(beam_size).long().fill_(self.bos_index)  # [1,1,1,1,1]
-                    its[token_idx] = it  #TODO TRAN ONLY
-
-                    # xt = self.embed(Variable(it, requires_grad=False))  # TODO RNN ONLY
-                else:
-                    """perform a beam merge. that is,
-                    for every previous beam we now many new possibilities to branch out
-                    we need to resort our beams to maintain the loop invariant of keeping
-                    the top beam_size most likely sequences."""
-                    logprobsf = logprobs.float()  # lets go to CPU for more efficiency in indexing operations
-                    # sorted array of logprobs along each previous beam (last
-                    # true = descending)
-                    ys, ix = torch.sort(logprobsf, 1, True)
-                    candidates = []
-                    cols = min(beam_size, ys.size(1))
-                    rows = beam_size
-                    if token_idx == 1:  # at first time step only the first beam is active
-                        rows = 1
-                    for c in range(cols):
-                        for q in range(rows):
-                            # compute logprob of expanding beam q with word in
-                            # (sorted) position c
-                            local_logprob = ys[q, c]
-                            candidate_logprob = beam_logprobs_sum[q] + local_logprob
-                            candidates.append(
-                                {'c': ix.data[q, c], 'q': q, 'p': candidate_logprob.item(), 'r': local_logprob.item()})
-                    candidates = sorted(candidates, key=lambda x: -x['p'])
-
-                    # construct new
-                    new_state = [_.clone() for _ in state] ###########TODO RNN ONLY
-                    if token_idx > 1:
-                        # well need these as reference when we fork beams
-                        # around
-                        beam_seq_prev = beam_seq[:token_idx - 1].clone()
-                        beam_seq_logprobs_prev = beam_seq_logprobs[:token_idx - 1].clone()
-
-                    for vix in range(beam_size):
-                        v = candidates[vix]
-                        # fork beam index q into index vix
-                        if token_idx > 1:
-                            beam_seq[:token_idx - 1, vix] = beam_seq_prev[:, v['q']]
-                            beam_seq_logprobs[:token_idx - 1, vix] = beam_seq_logprobs_prev[:, v['q']]
-
-                        # rearrange recurrent states	# TODO BLOCK RNN ONLY
-                        for state_ix in range(len(new_state)):
-                            # copy over state in previous beam q to new beam at
-                            # vix
-                            new_state[state_ix][
-                                0, vix] = state[state_ix][
-                                0, v['q']]  # dimension one is time step
-
-                        # append new end terminal at the end of this beam
-                        # c'th word is the continuation
-                        beam_seq[token_idx - 1, vix] = v['c']
-                        beam_seq_logprobs[token_idx - 1, vix] = v['r']  # the raw logprob here
-                        # the new (sum) logprob along this beam
-                        beam_logprobs_sum[vix] = v['p']
-
-                        if v['c'] == 0 or token_idx == self.caption_length - 2:
-                            # END token special case here, or we reached the end.
-                            # add the beam to a set of done beams
-                            if token_idx > 1:
-                                ppl = np.exp(-beam_logprobs_sum[vix] / (token_idx - 1))
-                            else:
-                                ppl = 10000
-                            self.done_beams[k].append({'seq': beam_seq[:, vix].clone(),
-                                                       'logps': beam_seq_logprobs[:, vix].clone(),
-                                                       'p': beam_logprobs_sum[vix],
-                                                       'ppl': ppl
-                                                       })
-
-                    # encode as vectors
-                    it = Variable(beam_seq[token_idx - 1].cuda())
-                    its[token_idx] = it  # TODO TRAN ONLY
-
-                if self.captioner_type in ['transformer']:
-                    encoded_features_k = encoded_features_k.permute(1, 0, 2)  # change to (time, batch, channel)
-                    decoder_input = self.embed(its[:token_idx+1])
-                    tgt_mask = nn.Transformer.generate_square_subsequent_mask(None, token_idx + 1).cuda()
-
-                    decoder_input = self.pos_encoder(decoder_input)  # add positional encoding
-                    decoder_output = self.caption_decoder(decoder_input, encoded_features_k, tgt_mask=tgt_mask)
-
-                    output = decoder_output[-1]
+        # (batch * n, feats, channels)
+        encoded_features = encoded_features.unsqueeze(1).expand(-1, n, -1, -1).reshape(
+            batch_size * n, encoded_features.size(1), encoded_features.size(2))
+        state = None
+        its = None  # words fed to the transformer decoder so far, (time, batch * n)
+        if self.captioner_type in ['transformer']:
+            memory = encoded_features.permute(1, 0, 2)  # change to (time, batch, channel)
+            if self.kv_cache:
+                cache = IncrementalDecoder(self.caption_decoder, memory)
+        else:
+            state = self.init_hidden(batch_size * n)
+            att_keys = self.v2a_layer(encoded_features)
+
+        def step(it, token_idx, parent):
+            nonlocal encoded_features, att_keys, state, its
+            if self.captioner_type in ['transformer'] and self.kv_cache:
+                if parent is not None:
+                    cache.reorder(parent)
+                decoder_input = self.pos_encoder(self.embed(it).unsqueeze(0), token_idx)  # add positional encoding
+                output = cache.step(decoder_input)[0]
+            elif self.captioner_type in ['transformer']:
+                if token_idx == 0:
+                    its = it.unsqueeze(0)
                 else:
-                    # set the new input word
-                    xt = self.embed(it)
-
-                    # calculate attention over visual features based on visual feats
-                    if self.captioner_layers > 1:
-                        hid_cont = state[0][-1].unsqueeze(0).transpose(0, 1).expand(beam_size, encoded_features_k.shape[1], state[0].shape[2])
-                    elif self.captioner_type in ['gru']:
-                        hid_cont = state.transpose(0, 1).expand(beam_size, encoded_features_k.shape[1], state.shape[2])
-                    else:
-                        hid_cont = state[0].transpose(0, 1).expand(beam_size, encoded_features_k.shape[1], state[0].shape[2])
-
-                    alpha = self.att_layer(torch.tanh(self.v2a_layer(encoded_features_k) + self.h2a_layer(hid_cont)))
-                    alpha = F.softmax(alpha, dim=1).transpose(1, 2)
-                    att_encoded_features = torch.matmul(alpha, encoded_features_k).squeeze(1)
-
-                    if token_idx >= 1:
-                        state = new_state
-                        if self.captioner_type in ['gru']:
-                            state = new_state[0].unsqueeze(0)
-                    if self.model_type == 'standard':
-                        output, state = self.core(xt, state)
-                    else:
-                        if self.model_type == 'manet':
-                            encoded_features_k = self.manet(att_encoded_features, state[0])
-                        output, state = self.core(torch.cat([xt, att_encoded_features], 1), state)
+                    its = torch.cat([its if parent is None else its[:, parent], it.unsqueeze(0)])
+                decoder_input = self.pos_encoder(self.embed(its))  # add positional encoding
+                tgt_mask = subsequent_mask(token_idx + 1, self.device)
+                output = self.caption_decoder(decoder_input, memory, tgt_mask=tgt_mask)[-1]
+            else:
+                # set the new input word
+                xt = self.embed(it)
 
-                logprobs = F.log_softmax(self.logit(output), dim=1)
+                # calculate attention over visual features based on visual feats
+                att_encoded_features = additive_attention(att_keys, self.h2a_layer(self.attention_query(state)),
+                                                          self.att_layer, encoded_features)
 
-            self.done_beams[k] = sorted(self.done_beams[k], key=lambda x: x['ppl'])
+                if parent is not None:  # fork the recurrent states along with the beams
+                    state = tuple(_[:, parent] for _ in state) if isinstance(state, tuple) else state[:, parent]
+                if self.model_type == 'standard':
+                    output, state = self.core(xt, state)
+                else:
+                    if self.model_type == 'manet':
+                        encoded_features = self.manet(att_encoded_features, state[0])
+                        att_keys = self.v2a_layer(encoded_features)
+                    output, state = self.core(torch.cat([xt, att_encoded_features], 1), state)
 
-            # the first beam has highest cumulative score
-            seq[:, k] = self.done_beams[k][0]['seq']
-            seqLogprobs[:, k] = self.done_beams[k][0]['logps']
+            return F.log_softmax(self.logit(output).float(), dim=1)
 
-        return seq.transpose(0, 1), seqLogprobs.transpose(0, 1)
+        return step
 
 
 class GeneralModelDecoupled(nn.Module):
@@ -810,9 +961,13 @@ class GeneralModelDecoupled(nn.Module):
         self.caption_length = opt.seq_length
         self.seq_per_img = opt.train_seq_per_img
         self.model_type = opt.model_type
+        self.kv_cache = opt.kv_cache
+        self.encode_per_video = opt.encode_per_video
+        self.amp = opt.amp
         self.bos_index = 1  # index of the <bos> token
         self.ss_prob = 0
         self.mixer_from = 0
+        self.timer = NULL_TIMER
         self.attention_record = list()
 
         self.feat_expander = FeatExpander(self.seq_per_img)
@@ -877,7 +1032,7 @@ class GeneralModelDecoupled(nn.Module):
             self.encoders = list()
             for _ in range(self.num_concepts):
                 self.encoders.append(nn.Sequential(nn.Linear(self.visual_encoding_size, self.visual_encoding_size), nn.ReLU(), nn.Dropout(self.drop_prob_lm)))
-            self.encoders = nn.ModuleList(self.encoders).cuda()
+            self.encoders = nn.ModuleList(self.encoders)
         elif self.grounder_type in ['iuc', 'ioc']:
             self.concept_pos_encoder = PositionalEncoding(self.textual_encoding_size, dropout=self.drop_prob_lm, max_len=self.num_concepts+1)
             # iterative
@@ -929,10 +1084,33 @@ class GeneralModelDecoupled(nn.Module):
         """
         self.mixer_from = t
 
+    def attention_query(self, state):
+        """The hidden state the attention of the next step looks from (batch, captioner_size)"""
+        if self.captioner_layers > 1:
+            return state[0][-1]
+        elif self.captioner_type in ['gru']:
+            return state[0]
+        else:
+            return state[0][0]
+
+    def autocast(self):
+        """Mixed precision of --amp, float16 on cuda and bfloat16 on cpu. Log-probabilities are kept in float32"""
+        device_type = self.device.type
+        return torch.autocast(device_type, dtype=torch.float16 if device_type == 'cuda' else torch.bfloat16,
+                              enabled=bool(self.amp))
+
+    def set_timer(self, timer):
+        """StageTimer of the training loop, forward() times its grounder and captioner stages with it"""
+        self.timer = timer
+
     def set_seq_per_img(self, x):
         self.seq_per_img = x
         self.feat_expander.set_n(x)
 
+    @property
+    def device(self):
+        return next(self.parameters()).device
+
     def init_weights(self):
         initrange = 0.1
         self.embed.weight.data.uniform_(-initrange, initrange)
@@ -971,7 +1149,7 @@ class GeneralModelDecoupled(nn.Module):
         # encode the features to concept-vocab size and sigmoid
         scores = self.logit(feats_).squeeze(1)
 
-        concept_probs = F.sigmoid(scores)
+        concept_probs = F.sigmoid(scores.float())
         top_v, top_i = torch.topk(concept_probs, k=self.num_concepts)  # get the top preds
         mask = top_v > .5  # mask threshold
         top_emb = self.embed(top_i)
@@ -1009,7 +1187,7 @@ class GeneralModelDecoupled(nn.Module):
             hidden = self.encoders[i](att_feat)
 
             # encode to logits and apply softmax to get word probabilities
-            out = F.log_softmax(self.logit(hidden), dim=-1)
+            out = F.log_softmax(self.logit(hidden).float(), dim=-1)
             pred_outs.append(out)
             # argmax the subject
             it = F.softmax(self.logit(hidden), dim=-1).argmax(-1)
@@ -1030,7 +1208,7 @@ class GeneralModelDecoupled(nn.Module):
             gt_concepts = gt_concepts[:, :-1]
             concept_embeddings = self.embed(gt_concepts)
             concept_embeddings = concept_embeddings.permute(1, 0, 2)  # change to (time, batch, channel)
-            tgt_mask = nn.Transformer.generate_square_subsequent_mask(None, self.num_concepts).cuda()
+            tgt_mask = subsequent_mask(self.num_concepts, self.device)
             tgt_key_padding_mask = (gt_concepts == 0)  # create padding mask
             if self.concept_pos_encoder is not None:
                 concept_embeddings = self.concept_pos_encoder(concept_embeddings)
@@ -1039,28 +1217,36 @@ class GeneralModelDecoupled(nn.Module):
             out = out.permute(1, 0, 2)  # change back to (batch, concepts, channels)
 
             concept_idxs = F.softmax(self.logit(out), dim=-1).argmax(-1)
-            concept_probs = F.log_softmax(self.logit(out), dim=-1)
-            concept_probs_sigmoid = F.sigmoid(self.logit(out))
+            concept_probs = F.log_softmax(self.logit(out).float(), dim=-1)
+            concept_probs_sigmoid = F.sigmoid(self.logit(out).float())
 
         else:  # auto-regressive prediction at inference
 
-            concept_probs = torch.zeros((feats.size(1), self.num_concepts, self.vocab_size)).cuda()
-            concept_probs_sigmoid = torch.zeros((feats.size(1), self.num_concepts, self.vocab_size)).cuda()
-            concept_idxs = torch.zeros((feats.size(1), self.num_concepts), dtype=torch.long).cuda()
+            concept_probs = torch.zeros((feats.size(1), self.num_concepts, self.vocab_size), device=self.device)
+            concept_probs_sigmoid = torch.zeros((feats.size(1), self.num_concepts, self.vocab_size), device=self.device)
+            concept_idxs = torch.zeros((feats.size(1), self.num_concepts), dtype=torch.long, device=self.device)
             concept_idxs = F.pad(concept_idxs, (1, 0, 0, 0), "constant", self.bos_index)
 
+            if self.kv_cache:
+                cache = IncrementalDecoder(self.concept_decoder, feats)
             for i in range(1, self.num_concepts+1):
-                decoder_input = self.embed(concept_idxs[:, :i])
+                if self.kv_cache:  # only feed the newest concept
+                    decoder_input = self.embed(concept_idxs[:, i - 1:i]).permute(1, 0, 2)
+                    if self.concept_pos_encoder is not None:
+                        decoder_input = self.concept_pos_encoder(decoder_input, i - 1)  # add positional encoding
+                    decoder_output = cache.step(decoder_input)
+                else:
+                    decoder_input = self.embed(concept_idxs[:, :i])
 
-                tgt_mask = nn.Transformer.generate_square_subsequent_mask(None, i).cuda()
-                decoder_input = decoder_input.permute(1, 0, 2)
-                if self.concept_pos_encoder is not None:
-                    decoder_input = self.concept_pos_encoder(decoder_input)  # add positional encoding
-                decoder_output = self.concept_decoder(decoder_input, feats, tgt_mask=tgt_mask)
+                    tgt_mask = subsequent_mask(i, self.device)
+                    decoder_input = decoder_input.permute(1, 0, 2)
+                    if self.concept_pos_encoder is not None:
+                        decoder_input = self.concept_pos_encoder(decoder_input)  # add positional encoding
+                    decoder_output = self.concept_decoder(decoder_input, feats, tgt_mask=tgt_mask)
 
                 concept_idxs[:, i] = F.softmax(self.logit(decoder_output[-1]), dim=-1).argmax(-1)
-                concept_probs[:, i - 1] = F.log_softmax(self.logit(decoder_output[-1]), dim=-1)
-                concept_probs_sigmoid[:, i - 1] = F.sigmoid(self.logit(decoder_output[-1]))
+                concept_probs[:, i - 1] = F.log_softmax(self.logit(decoder_output[-1]).float(), dim=-1)
+                concept_probs_sigmoid[:, i - 1] = F.sigmoid(self.logit(decoder_output[-1]).float())
 
             concept_idxs = concept_idxs[:, 1:]  # remove '<bos>'
 
@@ -1080,7 +1266,7 @@ class GeneralModelDecoupled(nn.Module):
         caption_embeddings = self.embed(gt_caption)  # emb indexs -> embeddings
         caption_embeddings = caption_embeddings.permute(1, 0, 2)  # change to (time, batch, channel)
         caption_embeddings = self.pos_encoder(caption_embeddings)  # add positional encoding
-        tgt_mask = nn.Transformer.generate_square_subsequent_mask(None, gt_caption.size(-1)).cuda()  # create sequence mask
+        tgt_mask = subsequent_mask(gt_caption.size(-1), self.device)  # create sequence mask
         tgt_key_padding_mask = (gt_caption == 0)  # create padding mask
 
         # Run the decoder
@@ -1099,7 +1285,7 @@ class GeneralModelDecoupled(nn.Module):
                                        tgt_key_padding_mask=tgt_key_padding_mask)
 
         out = out[:-1].permute(1, 0, 2)  # remove the last token and change back to (batch, concepts, channels)
-        caption_probs = F.log_softmax(self.logit(self.dropout(out)), dim=-1)  # calc word probs
+        caption_probs = F.log_softmax(self.logit(self.dropout(out)).float(), dim=-1)  # calc word probs
         caption_seq = F.softmax(self.logit(out), dim=-1).argmax(-1)  # get best word indexs
 
         caption_seq = gt_caption[:, 1:]  # get gt caption (minus the BOS token)
@@ -1123,6 +1309,12 @@ class GeneralModelDecoupled(nn.Module):
         # -- the <eos> token is not used for training
         start_i = -1 if self.model_type == 'standard' else 0
         end_i = gt_caption.size(1) - 1
+        # the visual side (and the concept side of the text attention) doesn't change while decoding
+        if self.decouple:
+            att_keys = self.v2a_layer(encoded_features[0])
+            text_keys = self.t2a_layer(encoded_features[1])
+        else:
+            att_keys = self.v2a_layer(encoded_features)
 
         for token_idx in range(start_i, end_i):
             if token_idx == -1:  # initially set xt as global feats
@@ -1163,47 +1355,19 @@ class GeneralModelDecoupled(nn.Module):
                 if it.data.sum() == 0:
                     break
 
-                if self.decouple:
-                    xt = torch.cat((encoded_features[1], self.embed(it).unsqueeze(1)), 1)  # concat the concepts and prev word
-                else:
-                    # set the new input word
-                    xt = self.embed(it)
+                # set the new input word
+                word = self.embed(it)
 
                 # calculate attention over visual features based on visual feats
+                hidden = self.attention_query(state)
                 if self.decouple:
-                    if self.captioner_layers > 1:
-                        hid_cont_t = state[0][-1].unsqueeze(0).transpose(0, 1).expand(batch_size, self.num_concepts + 1, state[0].shape[2])  # (bs * seq_per_img, 1, 512)
-                    elif self.captioner_type in ['gru']:
-                        hid_cont_t = state.transpose(0, 1).expand(batch_size, self.num_concepts + 1, state.shape[2])  # (bs * seq_per_img, 1, 512)
-                    else:
-                        hid_cont_t = state[0].transpose(0, 1).expand(batch_size, self.num_concepts + 1, state[0].shape[2])  # (bs * seq_per_img, 1, 512)
-
-                    if self.captioner_layers > 1:
-                        hid_cont_v = state[0][-1].unsqueeze(0).transpose(0, 1).expand(batch_size, encoded_features[0].shape[1], state[0].shape[2])  # (bs * seq_per_img, 1, 512)
-                    elif self.captioner_type in ['gru']:
-                        hid_cont_v = state.transpose(0, 1).expand(batch_size, encoded_features[0].shape[1], state.shape[2])  # (bs * seq_per_img, 1, 512)
-                    else:
-                        hid_cont_v = state[0].transpose(0, 1).expand(batch_size, encoded_features[0].shape[1], state[0].shape[2])  # (bs * seq_per_img, 1, 512)
-                else:
-                    if self.captioner_layers > 1:
-                        hid_cont_v = state[0][-1].unsqueeze(0).transpose(0, 1).expand(batch_size, encoded_features.shape[1], state[0].shape[2])  # (bs * seq_per_img, 1, 512)
-                    elif self.captioner_type in ['gru']:
-                        hid_cont_v = state.transpose(0, 1).expand(batch_size, encoded_features.shape[1], state.shape[2])  # (bs * seq_per_img, 1, 512)
-                    else:
-                        hid_cont_v = state[0].transpose(0, 1).expand(batch_size, encoded_features.shape[1], state[0].shape[2])  # (bs * seq_per_img, 1, 512)
-
-                if self.decouple:
-                    alpha = self.tatt_layer(torch.tanh(self.t2a_layer(xt) + self.ht2a_layer(hid_cont_t)))  # (bs * seq_per_img, 2, 1)
-                    alpha = F.softmax(alpha, dim=1).transpose(1, 2)  # (bs * seq_per_img, 1, 2)
-                    xt = torch.matmul(alpha, xt).squeeze(1)
-
-                    alpha = self.vatt_layer(torch.tanh(self.v2a_layer(encoded_features[0]) + self.hv2a_layer(hid_cont_v)))  # (bs * seq_per_img, 2, 1)
-                    alpha = F.softmax(alpha, dim=1).transpose(1, 2)  # (bs * seq_per_img, 1, 2)
-                    xtv = torch.matmul(alpha, encoded_features[0]).squeeze(1)
+                    xt = torch.cat((encoded_features[1], word.unsqueeze(1)), 1)  # concat the concepts and prev word
+                    keys = torch.cat((text_keys, self.t2a_layer(word).unsqueeze(1)), 1)
+                    xt = additive_attention(keys, self.ht2a_layer(hidden), self.tatt_layer, xt)
+                    xtv = additive_attention(att_keys, self.hv2a_layer(hidden), self.vatt_layer, encoded_features[0])
                 else:
-                    alpha = self.vatt_layer(torch.tanh(self.v2a_layer(encoded_features) + self.hv2a_layer(hid_cont_v)))  # (bs * seq_per_img, 2, 1)
-                    alpha = F.softmax(alpha, dim=1).transpose(1, 2)  # (bs * seq_per_img, 1, 2)
-                    att_encoded_features = torch.matmul(alpha, encoded_features).squeeze(1)
+                    xt = word
+                    att_encoded_features = additive_attention(att_keys, self.hv2a_layer(hidden), self.vatt_layer, encoded_features)
 
             # generate next word
             if self.model_type == 'standard':
@@ -1212,15 +1376,17 @@ class GeneralModelDecoupled(nn.Module):
                 if self.decouple:
                     if self.model_type == 'manet':
                         encoded_features[0] = self.manet(encoded_features[0], state[0])
+                        att_keys = self.v2a_layer(encoded_features[0])
                     output, state = self.core(torch.cat([xt, xtv], 1), state)
                 else:
                     if self.model_type == 'manet':
                         encoded_features = self.manet(att_encoded_features, state[0])
+                        att_keys = self.v2a_layer(encoded_features)
                     output, state = self.core(torch.cat([xt, att_encoded_features], 1), state)
 
             # generate the word softmax
             if token_idx >= 0:
-                output = F.log_softmax(self.logit(self.dropout(output)), dim=1)
+                output = F.log_softmax(self.logit(self.dropout(output)).float(), dim=1)
                 outputs.append(output)
 
         # only returns outputs of seq input
@@ -1259,7 +1425,11 @@ class GeneralModelDecoupled(nn.Module):
         concept_probs = None
         concept_seq = None
         if self.grounder_type in ['niuc', 'nioc', 'iuc', 'ioc']:
-            if expand:
+            # with encode_per_video the grounder runs once per video and its outputs are repeated for the captions,
+            # unless it is teacher forced with the concepts of each caption
+            per_video = expand and self.encode_per_video and not (
+                self.training and gt_concepts is not None and self.grounder_type in ['nioc', 'iuc', 'ioc'])
+            if expand and not per_video:
                 encoded_features = self.feat_expander(encoded_features)
             if self.grounder_type in ['niuc']:
                 concept_probs, concept_seq = self.non_iterative_grounder(encoded_features)
@@ -1269,6 +1439,9 @@ class GeneralModelDecoupled(nn.Module):
                 concept_probs, concept_seq = self.iterative_grounder(encoded_features, gt_concepts)
             else:
                 raise NotImplementedError
+            if per_video:
+                encoded_features, concept_probs, concept_seq = [
+                    self.feat_expander(x) for x in (encoded_features, concept_probs, concept_seq)]
 
             if self.decouple:
                 if gt_concepts is not None and ((self.gt_concepts_while_training and self.training) or self.gt_concepts_while_testing):  # use gt concepts for cap gen
@@ -1293,12 +1466,15 @@ class GeneralModelDecoupled(nn.Module):
 
     def forward(self, feats, bfeats, gt_caption, gt_concepts):
 
-        encoded_features, concept_probs, concept_seq = self.feature_filtering(feats, bfeats, gt_concepts, expand=True)
+        # the record_function ranges name the stages in --profile_steps traces
+        with self.autocast(), self.timer.stage('grounder'), record_function('grounder'):
+            encoded_features, concept_probs, concept_seq = self.feature_filtering(feats, bfeats, gt_concepts, expand=True)
 
-        if self.captioner_type in ['transformer']:  # Captioner - Transformer
-            caption_probs, caption_seq = self.captioner_transformer(encoded_features, gt_caption)
-        else:  # Captioner - RNN
-            caption_probs, caption_seq = self.captioner_rnn(encoded_features, gt_caption)
+        with self.autocast(), self.timer.stage('captioner'), record_function('captioner'):
+            if self.captioner_type in ['transformer']:  # Captioner - Transformer
+                caption_probs, caption_seq = self.captioner_transformer(encoded_features, gt_caption)
+            else:  # Captioner - RNN
+                caption_probs, caption_seq = self.captioner_rnn(encoded_features, gt_caption)
 
         # output size is: B x L x V (where L is truncated lengths
         # which are different for different batch)
@@ -1310,215 +1486,140 @@ class GeneralModelDecoupled(nn.Module):
                    None, None, None
 
     def sample(self, feats, bfeats, gt_concepts, opt={}):
+        """
+        beam_size > 1: beam search, otherwise greedy (sample_max 1) or multinomial sampling at the given temperature,
+        with expand_feat 1 seq_per_img captions are sampled per video
+        """
         beam_size = opt.get('beam_size', 1)
 
-        encoded_features, concept_probs, concept_seq = self.feature_filtering(feats, bfeats, gt_concepts)
+        with self.autocast(), record_function('grounder'):
+            encoded_features, concept_probs, concept_seq = self.feature_filtering(feats, bfeats, gt_concepts)
 
         if beam_size > 1:
-            return ((*self.sample_beam(encoded_features, opt)), concept_probs, concept_seq)
+            with self.autocast(), record_function('sample_beam'):
+                return (*self.sample_beam(encoded_features, opt), concept_probs, concept_seq)
         else:
-            return NotImplementedError
+            with self.autocast(), record_function('sample_max_or_multinomial'):
+                return (*self.sample_max_or_multinomial(encoded_features, opt), concept_probs, concept_seq)
+
+    def sample_max_or_multinomial(self, encoded_features, opt={}):
+        sample_max = opt.get('sample_max', 1)
+        n = self.seq_per_img if opt.get('expand_feat', 0) else 1
+        batch_size = encoded_features[0].size(0) if self.decouple else encoded_features.size(0)
+
+        # greedy captions of a video are all the same, decode once and repeat them
+        num_samples = 1 if sample_max else n
+        step = self.decode_step(encoded_features, num_samples)
+        seq, seqLogprobs = sample_sequences(step, batch_size * num_samples, self.caption_length, self.bos_index,
+                                            self.device, sample_max=sample_max, temperature=opt.get('temperature', 1.0))
+        if num_samples < n:
+            seq, seqLogprobs = seq.repeat_interleave(n, 0), seqLogprobs.repeat_interleave(n, 0)
+        return seq, seqLogprobs
 
     def sample_beam(self, encoded_features, opt={}):
         """
         modified from https://github.com/ruotianluo/self-critical.pytorch
+        all videos of the batch are decoded together, see beam_search
         """
         beam_size = opt.get('beam_size', 5)
+        batch_size = encoded_features[0].size(0) if self.decouple else encoded_features.size(0)
+        step = self.decode_step(encoded_features, beam_size)
+        return beam_search(step, batch_size, beam_size, self.caption_length, self.bos_index, self.device)
+
+    def decode_step(self, encoded_features, n=1):
+        """
+        Step function of the captioner over n rows per video (the rows of a video next to each other):
+        step(it, token_idx, parent) feeds the words it and returns the logprobs of the next word,
+        parent (None: keep the rows) picks the row of the previous step each row continues from
+        """
+        def expand(feats):
+            # (batch * n, feats, channels)
+            return feats.unsqueeze(1).expand(-1, n, -1, -1).reshape(feats.size(0) * n, feats.size(1), feats.size(2))
 
         if self.decouple:
             batch_size = encoded_features[0].size(0)
+            visual_features = expand(encoded_features[0])
+            concept_features = expand(encoded_features[1])
         else:
             batch_size = encoded_features.size(0)
-
-        seq = torch.LongTensor(self.caption_length, batch_size).zero_()
-        seqLogprobs = torch.FloatTensor(self.caption_length, batch_size)
-        # lets process every image independently for now, for simplicity
-
-        self.done_beams = [[] for _ in range(batch_size)]
-        state = []  # will be empty list for transformer decoder
-        for k in range(batch_size):
-            if self.captioner_type in ['rnn', 'lstm', 'gru']:
-                state = self.init_hidden(beam_size)
+            encoded_features = expand(encoded_features)
+        state = None
+        its = None  # words fed to the transformer decoder so far, (time, batch * n)
+        if self.captioner_type in ['transformer']:
+            # change to (time, batch, channel)
             if self.decouple:
-                visual_features_k = encoded_features[0][k].expand(beam_size, encoded_features[0].size(1), self.visual_encoding_size)
-                concept_features_k = encoded_features[1][k].expand(beam_size, encoded_features[1].size(1), self.textual_encoding_size)
+                visual_memory = visual_features.permute(1, 0, 2)
+                concept_memory = concept_features.permute(1, 0, 2)
+                if self.kv_cache:
+                    caches = [IncrementalDecoder(self.caption_decoder_text, concept_memory),
+                              IncrementalDecoder(self.caption_decoder, visual_memory)]
             else:
-                encoded_features_k = encoded_features[k].expand(beam_size, encoded_features.size(1), self.visual_encoding_size)
-
-            beam_seq = torch.LongTensor(self.caption_length, beam_size).zero_()
-            beam_seq_logprobs = torch.FloatTensor(self.caption_length, beam_size).zero_()
-            # running sum of logprobs for each beam
-            beam_logprobs_sum = torch.zeros(beam_size)
-
-            # -- if <image feature> is input at the first step, use index -1
-            start_i = -1 if self.model_type == 'standard' else 0
-            end_i = self.caption_length - 1
-
-            its = torch.LongTensor(self.caption_length, beam_size).zero_().cuda()  #TODO TRAN ONLY
-            for token_idx in range(start_i, end_i):
-                if token_idx == 0:  # input <bos>
-                    if self.decouple:
-                        it = encoded_features[0].data.new(beam_size).long().fill_(self.bos_index)  # [1,1,1,1,1]
-                    else:
-                        it = encoded_features.data.new(beam_size).long().fill_(self.bos_index)  # [1,1,1,1,1]
-                    its[token_idx] = it  #TODO TRAN ONLY
-
-                    # xt = self.embed(Variable(it, requires_grad=False))  # TODO RNN ONLY
+                memory = encoded_features.permute(1, 0, 2)
+                if self.kv_cache:
+                    caches = [IncrementalDecoder(self.caption_decoder, memory)]
+        else:
+            state = self.init_hidden(batch_size * n)
+            if self.decouple:
+                att_keys = self.v2a_layer(visual_features)
+                text_keys = self.t2a_layer(concept_features)
+            else:
+                att_keys = self.v2a_layer(encoded_features)
+
+        def step(it, token_idx, parent):
+            nonlocal encoded_features, visual_features, att_keys, state, its
+            if self.captioner_type in ['transformer'] and self.kv_cache:
+                if parent is not None:
+                    for cache in caches:
+                        cache.reorder(parent)
+                decoder_output = self.pos_encoder(self.embed(it).unsqueeze(0), token_idx)  # add positional encoding
+                for ii, cache in enumerate(caches):
+                    if ii > 0:
+                        decoder_output = self.pos_encoder(decoder_output, token_idx)  # add positional encoding
+                    decoder_output = cache.step(decoder_output)
+                output = decoder_output[0]
+            elif self.captioner_type in ['transformer']:
+                if token_idx == 0:
+                    its = it.unsqueeze(0)
                 else:
-                    """perform a beam merge. that is,
-                    for every previous beam we now many new possibilities to branch out
-                    we need to resort our beams to maintain the loop invariant of keeping
-                    the top beam_size most likely sequences."""
-                    logprobsf = logprobs.float()  # lets go to CPU for more efficiency in indexing operations
-                    # sorted array of logprobs along each previous beam (last
-                    # true = descending)
-                    ys, ix = torch.sort(logprobsf, 1, True)
-                    candidates = []
-                    cols = min(beam_size, ys.size(1))
-                    rows = beam_size
-                    if token_idx == 1:  # at first time step only the first beam is active
-                        rows = 1
-                    for c in range(cols):
-                        for q in range(rows):
-                            # compute logprob of expanding beam q with word in
-                            # (sorted) position c
-                            local_logprob = ys[q, c]
-                            candidate_logprob = beam_logprobs_sum[q] + local_logprob
-                            candidates.append(
-                                {'c': ix.data[q, c], 'q': q, 'p': candidate_logprob.item(), 'r': local_logprob.item()})
-                    candidates = sorted(candidates, key=lambda x: -x['p'])
-
-                    # construct new
-                    new_state = [_.clone() for _ in state] ###########TODO RNN ONLY
-                    if token_idx > 1:
-                        # well need these as reference when we fork beams
-                        # around
-                        beam_seq_prev = beam_seq[:token_idx - 1].clone()
-                        beam_seq_logprobs_prev = beam_seq_logprobs[:token_idx - 1].clone()
-
-                    for vix in range(beam_size):
-                        v = candidates[vix]
-                        # fork beam index q into index vix
-                        if token_idx > 1:
-                            beam_seq[:token_idx - 1, vix] = beam_seq_prev[:, v['q']]
-                            beam_seq_logprobs[:token_idx - 1, vix] = beam_seq_logprobs_prev[:, v['q']]
-
-                        # rearrange recurrent states	# TODO BLOCK RNN ONLY
-                        for state_ix in range(len(new_state)):
-                            # copy over state in previous beam q to new beam at
-                            # vix
-                            new_state[state_ix][
-                                0, vix] = state[state_ix][
-                                0, v['q']]  # dimension one is time step
-
-                        # append new end terminal at the end of this beam
-                        # c'th word is the continuation
-                        beam_seq[token_idx - 1, vix] = v['c']
-                        beam_seq_logprobs[token_idx - 1, vix] = v['r']  # the raw logprob here
-                        # the new (sum) logprob along this beam
-                        beam_logprobs_sum[vix] = v['p']
-
-                        if v['c'] == 0 or token_idx == self.caption_length - 2:
-                            # END token special case here, or we reached the end.
-                            # add the beam to a set of done beams
-                            if token_idx > 1:
-                                ppl = np.exp(-beam_logprobs_sum[vix] / (token_idx - 1))
-                            else:
-                                ppl = 10000
-                            self.done_beams[k].append({'seq': beam_seq[:, vix].clone(),
-                                                       'logps': beam_seq_logprobs[:, vix].clone(),
-                                                       'p': beam_logprobs_sum[vix],
-                                                       'ppl': ppl
-                                                       })
-
-                    # encode as vectors
-                    it = Variable(beam_seq[token_idx - 1].cuda())
-                    its[token_idx] = it  # TODO TRAN ONLY
-
-                if self.captioner_type in ['transformer']:
-                    if self.decouple:
-                        visual_features_k = visual_features_k.permute(1, 0, 2)  # change to (time, batch, channel)
-                        concept_features_k = concept_features_k.permute(1, 0, 2)  # change to (time, batch, channel)
-                        decoder_input = self.embed(its[:token_idx+1])
-                        tgt_mask = nn.Transformer.generate_square_subsequent_mask(None, token_idx + 1).cuda()
-
-                        decoder_input = self.pos_encoder(decoder_input)  # add positional encoding
-                        decoder_output_text = self.caption_decoder_text(decoder_input, concept_features_k, tgt_mask=tgt_mask)
-                        decoder_output_text = self.pos_encoder(decoder_output_text)  # add positional encoding
-                        decoder_output = self.caption_decoder(decoder_output_text, visual_features_k, tgt_mask=tgt_mask)
-                    else:
-                        encoded_features_k = encoded_features_k.permute(1, 0, 2)  # change to (time, batch, channel)
-                        decoder_input = self.embed(its[:token_idx+1])
-                        tgt_mask = nn.Transformer.generate_square_subsequent_mask(None, token_idx + 1).cuda()
-
-                        decoder_input = self.pos_encoder(decoder_input)  # add positional encoding
-                        decoder_output = self.caption_decoder(decoder_input, encoded_features_k, tgt_mask=tgt_mask)
-
-                    output = decoder_output[-1]
+                    its = torch.cat([its if parent is None else its[:, parent], it.unsqueeze(0)])
+                decoder_input = self.pos_encoder(self.embed(its))  # add positional encoding
+                tgt_mask = subsequent_mask(token_idx + 1, self.device)
+                if self.decouple:
+                    decoder_output_text = self.caption_decoder_text(decoder_input, concept_memory, tgt_mask=tgt_mask)
+                    decoder_output_text = self.pos_encoder(decoder_output_text)  # add positional encoding
+                    decoder_output = self.caption_decoder(decoder_output_text, visual_memory, tgt_mask=tgt_mask)
                 else:
-                    if self.decouple:
-                        xt = torch.cat((concept_features_k, self.embed(it).unsqueeze(1)), 1)  # concat the concepts and prev word
-                    else:
-                        # set the new input word
-                        xt = self.embed(it)
-
-                    if self.decouple:
-                        if self.captioner_layers > 1:
-                            hid_cont_t = state[0][-1].unsqueeze(0).transpose(0, 1).expand(beam_size, self.num_concepts + 1, state[0].shape[2])  # (bs * seq_per_img, 1, 512)
-                        elif self.captioner_type in ['gru']:
-                            hid_cont_t = state.transpose(0, 1).expand(beam_size, self.num_concepts + 1, state.shape[2])  # (bs * seq_per_img, 1, 512)
-                        else:
-                            hid_cont_t = state[0].transpose(0, 1).expand(beam_size, self.num_concepts + 1, state[0].shape[2])  # (bs * seq_per_img, 1, 512)
-
-                        if self.captioner_layers > 1:
-                            hid_cont_v = state[0][-1].unsqueeze(0).transpose(0, 1).expand(beam_size, visual_features_k.shape[1], state[0].shape[2])  # (bs * seq_per_img, 1, 512)
-                        elif self.captioner_type in ['gru']:
-                            hid_cont_v = state.transpose(0, 1).expand(beam_size, visual_features_k.shape[1], state.shape[2])  # (bs * seq_per_img, 1, 512)
-                        else:
-                            hid_cont_v = state[0].transpose(0, 1).expand(beam_size, visual_features_k.shape[1], state[0].shape[2])  # (bs * seq_per_img, 1, 512)
-                    else:
-                        if self.captioner_layers > 1:
-                            hid_cont_v = state[0][-1].unsqueeze(0).transpose(0, 1).expand(beam_size, encoded_features_k.shape[1], state[0].shape[2])  # (bs * seq_per_img, 1, 512)
-                        elif self.captioner_type in ['gru']:
-                            hid_cont_v = state.transpose(0, 1).expand(beam_size, encoded_features_k.shape[1], state.shape[2])  # (bs * seq_per_img, 1, 512)
-                        else:
-                            hid_cont_v = state[0].transpose(0, 1).expand(beam_size, encoded_features_k.shape[1], state[0].shape[2])  # (bs * seq_per_img, 1, 512)
+                    decoder_output = self.caption_decoder(decoder_input, memory, tgt_mask=tgt_mask)
+                output = decoder_output[-1]
+            else:
+                # set the new input word
+                word = self.embed(it)
+                hidden = self.attention_query(state)
+                if self.decouple:
+                    xt = torch.cat((concept_features, word.unsqueeze(1)), 1)  # concat the concepts and prev word
+                    keys = torch.cat((text_keys, self.t2a_layer(word).unsqueeze(1)), 1)
+                    xt = additive_attention(keys, self.ht2a_layer(hidden), self.tatt_layer, xt)
+                    v_feats = visual_features
+                else:
+                    xt = word
+                    v_feats = encoded_features
 
-                    if self.decouple:
-                        alpha = self.tatt_layer(torch.tanh(self.t2a_layer(xt) + self.ht2a_layer(hid_cont_t)))  # (bs * seq_per_img, 2, 1)
-                        alpha = F.softmax(alpha, dim=1).transpose(1, 2)  # (bs * seq_per_img, 1, 2)
-                        xt = torch.matmul(alpha, xt).squeeze(1)
+                att_v_feats = additive_attention(att_keys, self.hv2a_layer(hidden), self.vatt_layer, v_feats)
 
-                        alpha = self.vatt_layer(torch.tanh(self.v2a_layer(visual_features_k) + self.hv2a_layer(hid_cont_v)))  # (bs * seq_per_img, 2, 1)
-                        alpha = F.softmax(alpha, dim=1).transpose(1, 2)  # (bs * seq_per_img, 1, 2)
-                        xtv = torch.matmul(alpha, visual_features_k).squeeze(1)
-                    else:
-                        alpha = self.vatt_layer(torch.tanh(self.v2a_layer(encoded_features_k) + self.hv2a_layer(hid_cont_v)))  # (bs * seq_per_img, 2, 1)
-                        alpha = F.softmax(alpha, dim=1).transpose(1, 2)  # (bs * seq_per_img, 1, 2)
-                        att_encoded_features_k = torch.matmul(alpha, encoded_features_k).squeeze(1)
-
-                    if token_idx >= 1:
-                        state = new_state
-                        if self.captioner_type in ['gru']:
-                            state = new_state[0].unsqueeze(0)
-                    if self.model_type == 'standard':
-                        output, state = self.core(xt, state)
-                    else:
+                if parent is not None:  # fork the recurrent states along with the beams
+                    state = tuple(_[:, parent] for _ in state) if isinstance(state, tuple) else state[:, parent]
+                if self.model_type == 'standard':
+                    output, state = self.core(xt, state)
+                else:
+                    if self.model_type == 'manet':
                         if self.decouple:
-                            if self.model_type == 'manet':
-                                visual_features_k = self.manet(xtv, state[0])
-                            output, state = self.core(torch.cat([xt, xtv], 1), state)
+                            visual_features = self.manet(att_v_feats, state[0])
+                            att_keys = self.v2a_layer(visual_features)
                         else:
-                            if self.model_type == 'manet':
-                                encoded_features_k = self.manet(att_encoded_features_k, state[0])
-                            output, state = self.core(torch.cat([xt, att_encoded_features_k], 1), state)
-
-                logprobs = F.log_softmax(self.logit(output), dim=1)
-
-            self.done_beams[k] = sorted(self.done_beams[k], key=lambda x: x['ppl'])
+                            encoded_features = self.manet(att_v_feats, state[0])
+                            att_keys = self.v2a_layer(encoded_features)
+                    output, state = self.core(torch.cat([xt, att_v_feats], 1), state)
 
-            # the first beam has highest cumulative score
-            seq[:, k] = self.done_beams[k][0]['seq']
-            seqLogprobs[:, k] = self.done_beams[k][0]['logps']
+            return F.log_softmax(self.logit(output).float(), dim=1)
 
-        return seq.transpose(0, 1), seqLogprobs.transpose(0, 1)
+        return step
@@ -100,6 +100,71 @@ def parse_opts():
         '--train_cached_tokens',
         type=str,
         help='Path to idx document frequencies to cal Cider on training data')
+    parser.add_argument(
+        '--reward_cache_videos',
+        type=int,
+        default=10000,
+        help='number of videos whose reference n-gram vectors the RL CIDEr reward keeps between iterations (0 = recompute every batch)')
+    parser.add_argument(
+        '--reward_cache_precompute',
+        type=int,
+        default=0,
+        choices=[0, 1],
+        help='fill the reference cache from the training label h5 when RL starts instead of batch by batch')
+
+    parser.add_argument(
+        '--prefetch',
+        type=int,
+        default=0,
+        help='number of batches to build ahead in background threads (0 = load each batch when it is requested)')
+    parser.add_argument(
+        '--prefetch_workers',
+        type=int,
+        default=1,
+        help='number of background threads building prefetched batches')
+
+    parser.add_argument(
+        '--feat_mmap',
+        type=int,
+        default=1,
+        help='read packed feature files (see misc/pack_features.py) through np.memmap when they are stored contiguously')
+
+    parser.add_argument(
+        '--labels_in_memory',
+        type=int,
+        default=0,
+        help='copy the caption/svo labels and their pointers into RAM once and sample each batch with vectorized gathers')
+    parser.add_argument(
+        '--buffer_pool',
+        type=int,
+        default=0,
+        help='number of preallocated (pinned) batch buffers reused round-robin, 0 = allocate every batch. A batch is only valid until buffer_pool - 1 more batches are requested')
+    parser.add_argument(
+        '--num_workers',
+        type=int,
+        default=0,
+        help='build batches in this many torch.utils.data.DataLoader worker processes (video_dataset.py), 0 = use the in-process DataLoader')
+    parser.add_argument(
+        '--feat_dtype',
+        type=str,
+        default='float32',
+        choices=['float32', 'float16'],
+        help='precision of the feature tensors of a batch. float16 halves host memory and host to device copies, they are upcast on the device')
+    parser.add_argument(
+        '--bucket_by_length',
+        type=int,
+        default=0,
+        help='shuffle the training videos so each batch holds videos of similar (longest) caption length')
+    parser.add_argument(
+        '--trim_captions',
+        type=int,
+        default=0,
+        help='during cross-entropy training cut the label/mask columns after the longest caption of the batch')
+    parser.add_argument(
+        '--compare_fp16',
+        type=int,
+        default=0,
+        help='evaluate.py: test again on the float16 copies of the feature files (misc/convert_features.py) and log the score delta')
 
     parser.add_argument(
         '--input_features',
@@ -276,6 +341,18 @@ def parse_opts():
         type=float,
         default=0.25,
         help='clip gradients at this value (note should be lower than usual 5 because we normalize grads by both batch and seq_length)')
+    parser.add_argument(
+        '--accum_steps',
+        type=int,
+        default=1,
+        help='accumulate the gradients of this many batches, clipped and applied once (logical batch of accum_steps * batch_size videos)')
+    parser.add_argument(
+        '--micro_batch',
+        type=int,
+        default=0,
+        help='run the forward/backward of a batch in micro-batches of this many videos (each with its seq_per_img captions), '
+             'fewer caption rows in memory at once for the same gradient. RL then samples and scores the captions of the whole '
+             'batch first (without gradients) and learns from them micro-batch by micro-batch. 0 = the whole batch at once')
     parser.add_argument(
         '--drop_prob_lm',
         type=float,
@@ -326,6 +403,36 @@ def parse_opts():
         type=int,
         default=0,  # 30
         help='Start RL training after this epoch')
+    parser.add_argument(
+        '--stage_timing',
+        type=int,
+        default=0,
+        choices=[0, 1],
+        help='time the stages of every training iteration (data, h2d, grounder, captioner, backward, ...) and write '
+             'them per print_log_interval to <dataset>_timing.jsonl next to the history file')
+    parser.add_argument(
+        '--stage_timing_cuda',
+        type=int,
+        default=0,
+        choices=[0, 1],
+        help='with --stage_timing on a GPU, time the stages with CUDA events (device time) instead of the wall clock')
+    parser.add_argument(
+        '--profile_steps',
+        type=str,
+        default='',
+        help='start:count, run torch.profiler over count iterations from iteration start (training iterations in train.py, '
+             'test batches in evaluate.py) and write a chrome trace and the top ops to the results dir')
+    parser.add_argument(
+        '--rl_pipeline_depth',
+        type=int,
+        default=0,
+        help='score the rewards of RL batches in worker processes while the next batches are sampled, '
+             'each batch is learned from this many iterations after it was sampled (0 = score and learn right away)')
+    parser.add_argument(
+        '--reward_workers',
+        type=int,
+        default=2,
+        help='number of reward scoring processes with --rl_pipeline_depth > 0')
     parser.add_argument(
         '--expand_feat',
         type=int,
@@ -386,6 +493,34 @@ def parse_opts():
         type=int,
         default=7,
         help='which gpu to use. -1 = use CPU')
+    parser.add_argument(
+        '--device',
+        type=str,
+        default='',
+        help='torch device to train/evaluate on, e.g. cuda, cuda:1 or cpu (default: cuda when available)')
+    parser.add_argument(
+        '--dist_backend',
+        type=str,
+        default='',
+        choices=['', 'gloo', 'nccl'],
+        help='process group backend when launched with torchrun (e.g. torchrun --nproc_per_node 4 train.py ...), '
+             'default nccl with cuda and gloo otherwise. Every rank trains on its share of the videos with batch_size of its own')
+    parser.add_argument(
+        '--dist_timeout',
+        type=int,
+        default=120,
+        help='minutes a rank waits in a collective before the process group aborts the job. The other ranks wait this long '
+             'for rank 0 to validate (beam search over the val set, language metrics, train set check), so keep it above that')
+    parser.add_argument(
+        '--num_threads',
+        type=int,
+        default=0,
+        help='CPU threads used inside an op (torch.set_num_threads), 0 = torch default')
+    parser.add_argument(
+        '--num_interop_threads',
+        type=int,
+        default=0,
+        help='CPU threads running independent ops in parallel (torch.set_num_interop_threads), 0 = torch default')
     parser.add_argument(
         '--num_chunks',
         type=int,
@@ -429,6 +564,24 @@ def parse_opts():
         type=int,
         default=5,
         help='Beam search size')
+    parser.add_argument(
+        '--kv_cache',
+        type=int,
+        default=1,
+        choices=[0, 1],
+        help='1: transformer decoders cache the keys/values of previous tokens and feed one token per step at inference, 0: re-run the whole prefix every step')
+    parser.add_argument(
+        '--amp',
+        type=int,
+        default=0,
+        choices=[0, 1],
+        help='1: mixed precision (torch >= 1.10), the model runs in float16 on cuda (with loss scaling) and bfloat16 on cpu, log-probabilities and the losses stay float32')
+    parser.add_argument(
+        '--encode_per_video',
+        type=int,
+        default=0,
+        choices=[0, 1],
+        help='1: in training the grounder runs once per video and its outputs are repeated for the seq_per_img captions (the captions of a video then share its dropout), unless it is teacher forced with the concepts of each caption (nioc, iuc, ioc), 0: it runs on seq_per_img copies of the features')
     parser.add_argument(
         '--labda',
         type=float,
@@ -0,0 +1,61 @@
+import time
+import multiprocessing
+
+import logging
+logger = logging.getLogger(__name__)
+
+# the scorer of a worker process, built once by _init_worker
+_scorer = None
+
+
+def _init_worker(make_scorer):
+    global _scorer
+    _scorer = make_scorer()
+
+
+def _score(reward_fn, args, kwargs):
+    start = time.time()
+    out = reward_fn(*args, bcmr_scorer=_scorer, **kwargs)
+    return out, time.time() - start
+
+
+class RewardPool(object):
+    """
+    Scores RL rewards in worker processes, so the training process can keep the model busy meanwhile
+    Every worker builds its own scorer with make_scorer (a picklable callable), Meteor and Spice then run one
+    java process per worker. Jobs are utils.get_self_critical_reward / utils.get_cst_reward calls without the scorer
+    """
+
+    def __init__(self, make_scorer, num_workers=2, start_method='spawn'):
+        # spawn: the workers must not inherit the CUDA context or the prefetch threads of the training process
+        context = multiprocessing.get_context(start_method)
+        self.pool = context.Pool(num_workers, initializer=_init_worker, initargs=(make_scorer,))
+        self.num_workers = num_workers
+        self.reset_stats()
+        logger.info('Scoring rewards in %d worker processes', num_workers)
+
+    def submit(self, reward_fn, *args, **kwargs):
+        """Queue reward_fn(*args, bcmr_scorer=<the worker's scorer>, **kwargs), returns a future (see result)"""
+        return self.pool.apply_async(_score, (reward_fn, args, kwargs))
+
+    def result(self, future):
+        """Wait for a job, counting how long it took in the worker and how long the training process waited for it"""
+        start = time.time()
+        out, score_time = future.get()
+        self.stats['jobs'] += 1
+        self.stats['score_time'] += score_time
+        self.stats['wait_time'] += time.time() - start
+        return out
+
+    def reset_stats(self):
+        self.stats = {'jobs': 0, 'score_time': 0.0, 'wait_time': 0.0}
+
+    def overlap(self):
+        """Share of the scoring time hidden behind the training process's own work"""
+        if self.stats['score_time'] == 0:
+            return 0.0
+        return max(0.0, 1.0 - self.stats['wait_time'] / self.stats['score_time'])
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
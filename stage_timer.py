@@ -0,0 +1,107 @@
+import json
+import time
+from collections import OrderedDict
+
+import torch
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class _NullStage(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class _Stage(object):
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        if self.timer.cuda_events:
+            self.start = torch.cuda.Event(enable_timing=True)
+            self.start.record()
+        else:
+            self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        if self.timer.cuda_events:
+            end = torch.cuda.Event(enable_timing=True)
+            end.record()
+            # resolved in flush, so timing a stage doesn't synchronize the device
+            self.timer.events.append((self.name, self.start, end))
+        else:
+            self.timer.add(self.name, time.time() - self.start)
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class StageTimer(object):
+    """
+    Time spent in named stages (with timer.stage('backward'): ...) and counts (videos, tokens) of the training loop,
+    flush() appends what was gathered since the last flush as one JSON line to path
+    Without a path nothing is measured. With cuda_events (and a GPU) stages are timed with CUDA events,
+    the device time between the start and the end of the stage rather than the time to queue its kernels
+    """
+
+    def __init__(self, path=None, cuda_events=False):
+        self.path = path
+        self.enabled = path is not None
+        self.cuda_events = self.enabled and cuda_events and torch.cuda.is_available()
+        self.reset()
+
+    def reset(self):
+        self.times = OrderedDict()
+        self.calls = {}
+        self.counts = {}
+        self.events = []
+        self.start = time.time()
+
+    def stage(self, name):
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def add(self, name, seconds):
+        self.times[name] = self.times.get(name, 0.0) + seconds
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def count(self, **counts):
+        if self.enabled:
+            for k, v in counts.items():
+                self.counts[k] = self.counts.get(k, 0) + v
+
+    def flush(self, **info):
+        """Write the stages and counts since the last flush with info (iter, epoch, ...) and start over"""
+        if not self.enabled:
+            return
+        if self.events:
+            self.events[-1][2].synchronize()
+            for name, start, end in self.events:
+                self.add(name, start.elapsed_time(end) / 1000.0)
+        wall = time.time() - self.start
+
+        record = OrderedDict(info)
+        record['timing'] = 'cuda_events' if self.cuda_events else 'wall'
+        record['wall_ms'] = 1000.0 * wall
+        record['stages'] = OrderedDict((name, {'ms': 1000.0 * t, 'calls': self.calls[name]})
+                                       for name, t in self.times.items())
+        record['other_ms'] = 1000.0 * max(wall - sum(self.times.values()), 0.0)
+        for k, v in self.counts.items():
+            record[k] = v
+            record[k + '_per_s'] = v / max(wall, 1e-6)
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+        self.reset()
+
+
+NULL_TIMER = StageTimer()
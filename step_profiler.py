@@ -0,0 +1,64 @@
+import os
+
+import torch
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def parse_steps(steps):
+    """'start:count' -> (start, count), '' -> None"""
+    if not steps:
+        return None
+    start, _, count = steps.partition(':')
+    return int(start), int(count or 1)
+
+
+class StepProfiler(object):
+    """
+    Runs torch.profiler (torch >= 1.8.1) over a window of iterations, steps is 'start:count' (--profile_steps):
+    call step() at the start of every iteration. When the window ends (or at close()) a chrome trace and
+    the top ops by time and by memory are written to out_dir as <prefix>_trace.json and <prefix>_ops.txt
+    """
+
+    def __init__(self, steps, out_dir, prefix, row_limit=30):
+        self.window = parse_steps(steps)
+        self.out_dir = out_dir
+        self.prefix = prefix
+        self.row_limit = row_limit
+        self.iteration = -1
+        self.prof = None
+
+    def step(self):
+        if self.window is None:
+            return
+        self.iteration += 1
+        start, count = self.window
+        if self.iteration == start:
+            from torch.profiler import profile, ProfilerActivity
+            activities = [ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(ProfilerActivity.CUDA)
+            self.prof = profile(activities=activities, record_shapes=True, profile_memory=True)
+            self.prof.__enter__()
+            logger.info('Profiling %d iterations from iteration %d', count, start)
+        elif self.iteration == start + count:
+            self.close()
+
+    def close(self):
+        if self.prof is None:
+            return
+        self.prof.__exit__(None, None, None)
+        prof, self.prof = self.prof, None
+
+        trace_file = os.path.join(self.out_dir, self.prefix + '_trace.json')
+        prof.export_chrome_trace(trace_file)
+        sort_by = 'cuda_time_total' if torch.cuda.is_available() else 'cpu_time_total'
+        averages = prof.key_averages(group_by_input_shape=True)
+        by_time = averages.table(sort_by=sort_by, row_limit=self.row_limit)
+        by_memory = averages.table(sort_by='self_cpu_memory_usage', row_limit=self.row_limit)
+        ops_file = os.path.join(self.out_dir, self.prefix + '_ops.txt')
+        with open(ops_file, 'w') as f:
+            f.write('Top ops by %s\n%s\n\nTop ops by self_cpu_memory_usage\n%s\n' % (sort_by, by_time, by_memory))
+        logger.info('Wrote the profile to %s and %s\n%s', trace_file, ops_file,
+                    prof.key_averages().table(sort_by=sort_by, row_limit=15))
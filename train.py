@@ -3,6 +3,7 @@ import torch
 from torch.autograd import Variable
 import torch.optim as optim
 from torch.nn.utils import clip_grad_norm_
+from torch.nn.parallel import DistributedDataParallel
 import os
 import random
 import time
@@ -10,26 +11,32 @@ import math
 import json
 import uuid
 import logging
+import functools
+import contextlib
+from collections import deque
 from datetime import datetime
 from six.moves import cPickle
 import gc
 import numpy as np
 
-from dataloader import DataLoader
-from model import GeneralModel, GeneralModelDecoupled, CrossEntropyCriterion, RewardCriterion
+from dataloader import DataLoader, concept_pos_weight
+from video_dataset import VideoDataLoader
+from model import GeneralModel, GeneralModelDecoupled, CrossEntropyCriterion, RewardCriterion, reward_mask
 
 import utils
 import opts
+import distributed
 
 import sys
 
 sys.path.append('coco-caption')
 sys.path.append('cider')
-from pycocoevalcap.bleu.bleu import Bleu
-from pycocoevalcap.meteor.meteor import Meteor
-from pycocoevalcap.rouge.rouge import Rouge
-from pycocoevalcap.cider.cider import Cider
-from pycocoevalcap.spice.spice import Spice
+from pycocoevalcap.scorers import get_scorer
+from pycocoevalcap.scorers import shutdown as shutdown_scorers
+from ciderd import CiderD
+from reward_pool import RewardPool
+from stage_timer import StageTimer, NULL_TIMER
+from step_profiler import StepProfiler
 
 logger = logging.getLogger(__name__)
 
@@ -50,6 +57,142 @@ def language_eval(predictions, cocofmt_file, opt):
     return lang_stats
 
 
+def make_bcmr_scorer(opt):
+    """The opt.eval_metric scorer that rewards the captions during RL training"""
+    if opt.eval_metric != 'CIDEr':
+        # the other metrics share the scorers of the language evaluation, only the one asked for is started
+        return get_scorer({'Bleu_4': 'Bleu'}.get(opt.eval_metric, opt.eval_metric))
+
+    start = time.time()
+    bcmr_scorer = CiderD(df=opt.train_cached_tokens, cache_videos=opt.reward_cache_videos)
+    if bcmr_scorer.cache is not None and opt.reward_cache_precompute:
+        bcmr_scorer.cache.precompute(opt.train_label_h5, opt.use_eos)
+    logger.info('Started the CIDEr-D reward scorer in %.2fs', time.time() - start)
+    return bcmr_scorer
+
+
+def batch_to_device(data, device):
+    """feats, bfeats, labels, masks, labels_svo and masks_svo of a batch on the device, features as float32"""
+    feats = [feat.to(device, non_blocking=True) for feat in data['feats']]
+    bfeats = [bfeat.to(device, non_blocking=True) for bfeat in data['bfeats']]
+    labels = data['labels'].to(device, non_blocking=True)
+    masks = data['masks'].to(device, non_blocking=True)
+    labels_svo = data['labels_svo'].to(device, non_blocking=True)
+    masks_svo = data['masks_svo'].to(device, non_blocking=True)
+    # half precision batches (--feat_dtype float16) are upcast once on the device
+    feats = [feat.float() for feat in feats]
+    bfeats = [bfeat.float() for bfeat in bfeats]
+    return feats, bfeats, labels, masks, labels_svo, masks_svo
+
+
+def own_batch(batch, data):
+    """
+    A batch (see batch_to_device) that stays valid across later get_batch() calls, which refill the loader's buffers
+    with --buffer_pool: the tensors still sharing memory with data's (batch_to_device doesn't copy on cpu) are copied
+    """
+    buffers = set(tensor.data_ptr() for tensor in data['feats'] + data['bfeats'] +
+                  [data[key] for key in ['labels', 'masks', 'labels_svo', 'masks_svo']])
+
+    def own(tensor):
+        return tensor.clone() if tensor.data_ptr() in buffers else tensor
+
+    feats, bfeats, labels, masks, labels_svo, masks_svo = batch
+    return ([own(feat) for feat in feats], [own(bfeat) for bfeat in bfeats], own(labels), own(masks),
+            own(labels_svo), own(masks_svo))
+
+
+def micro_batches(batch, data, micro_batch, seq_per_img):
+    """
+    Split a batch (see batch_to_device) and its data into micro-batches of micro_batch videos with their caption rows,
+    yields the batch, data (ids, gts, bcmrscores) and slice of the caption rows of each. micro_batch 0: the whole batch
+    """
+    feats, bfeats, labels, masks, labels_svo, masks_svo = batch
+    num_videos = len(data['ids'])
+    if micro_batch <= 0 or micro_batch >= num_videos:
+        yield batch, data, slice(0, labels.size(0))
+        return
+    for start in range(0, num_videos, micro_batch):
+        videos = slice(start, start + micro_batch)
+        rows = slice(start * seq_per_img, min(start + micro_batch, num_videos) * seq_per_img)
+        micro_data = {'ids': data['ids'][videos],
+                      'gts': data['gts'][videos],
+                      'bcmrscores': data['bcmrscores'][videos] if data.get('bcmrscores') is not None else None}
+        yield ([feat[videos] for feat in feats], [bfeat[videos] for bfeat in bfeats], labels[rows], masks[rows],
+               labels_svo[rows], masks_svo[rows]), micro_data, rows
+
+
+def no_sync(model, sync):
+    """DDP's no_sync() (the gradients are only accumulated) unless sync, nothing to do without DDP"""
+    if sync or not isinstance(model, DistributedDataParallel):
+        return contextlib.nullcontext()
+    return model.no_sync()
+
+
+def rl_rollout(model, batch, data, reward_pool, opt, seq_per_img, scb_captions, timer=NULL_TIMER):
+    """
+    Sample the captions of a batch (and the greedy baseline) without gradients and queue their scoring in the
+    reward pool, the pipelined RL step learns from them once the reward is back
+    """
+    # the rollout is learnt from rl_pipeline_depth batches later, data's tensors are only good for their shapes by then
+    batch = own_batch(batch, data)
+    num_tokens = int(data['masks'][:, 1:].sum())
+    feats, bfeats, labels, masks, labels_svo, masks_svo = batch
+    with torch.no_grad():
+        _, model_res, _, _, _, _ = model(feats, bfeats, labels, labels_svo)
+        if opt.use_cst == 1:
+            job = reward_pool.submit(utils.get_cst_reward, model_res.cpu(), data['gts'],
+                                     bcmrscores=data['bcmrscores'],
+                                     expand_feat=opt.expand_feat,
+                                     seq_per_img=seq_per_img,
+                                     scb_captions=scb_captions,
+                                     scb_baseline=opt.scb_baseline,
+                                     use_eos=opt.use_eos,
+                                     use_mixer=opt.use_mixer,
+                                     video_ids=data['ids'])
+        else:
+            model.eval()
+            with timer.stage('sample'):
+                greedy_baseline, _, _, _ = model.sample(feats, bfeats, labels_svo,
+                                                        {'sample_max': 1, 'expand_feat': opt.expand_feat})
+            model.train()
+            job = reward_pool.submit(utils.get_self_critical_reward, model_res.cpu(), greedy_baseline.cpu(), data['gts'],
+                                     expand_feat=opt.expand_feat,
+                                     seq_per_img=seq_per_img,
+                                     use_eos=opt.use_eos,
+                                     video_ids=data['ids'])
+    return {'batch': batch, 'data': data, 'num_tokens': num_tokens, 'model_res': model_res, 'job': job}
+
+
+def rl_reward(model, batch, data, model_res, bcmr_scorer, opt, seq_per_img, scb_captions, timer=NULL_TIMER):
+    """The reward of the captions sampled from a batch, scored in the training process, and the mean scores"""
+    feats, bfeats, labels, masks, labels_svo, masks_svo = batch
+    if opt.use_cst == 0:
+        # greedy decoding baseline in SCST paper
+        model.eval()
+        with torch.no_grad(), timer.stage('sample'):
+            greedy_baseline, _, _, _ = model.sample(feats, bfeats, labels_svo,
+                                                    {'sample_max': 1, 'expand_feat': opt.expand_feat})
+        model.train()
+
+    with timer.stage('reward'):
+        if opt.use_cst == 1:
+            return utils.get_cst_reward(model_res, data['gts'], bcmr_scorer,
+                                        bcmrscores=data['bcmrscores'],
+                                        expand_feat=opt.expand_feat,
+                                        seq_per_img=seq_per_img,
+                                        scb_captions=scb_captions,
+                                        scb_baseline=opt.scb_baseline,
+                                        use_eos=opt.use_eos,
+                                        use_mixer=opt.use_mixer,
+                                        video_ids=data['ids'])
+        # use greedy baseline by default, compute self-critical reward
+        return utils.get_self_critical_reward(model_res, greedy_baseline, data['gts'], bcmr_scorer,
+                                              expand_feat=opt.expand_feat,
+                                              seq_per_img=seq_per_img,
+                                              use_eos=opt.use_eos,
+                                              video_ids=data['ids'])
+
+
 def train(model, criterion, optimizer, train_loader, val_loader, opt, rl_criterion=None):
 
     infos = {'iter': 0,
@@ -62,8 +205,20 @@ def train(model, criterion, optimizer, train_loader, val_loader, opt, rl_criteri
 
     checkpoint_checked = False
     rl_training = False
+    reward_pool = None
+    # RL batches sampled and being scored, oldest first (--rl_pipeline_depth > 0)
+    rollouts = deque()
     seq_per_img = train_loader.get_seq_per_img()
     infos_history = {}
+    # time per stage of the loop, written every print_log_interval iterations (--stage_timing)
+    timer = StageTimer(opt.timing_file if opt.stage_timing else None, opt.stage_timing_cuda)
+    model.set_timer(timer)
+    profiler = StepProfiler(opt.profile_steps, os.path.dirname(opt.model_file), opt.dataset + '_profile_train')
+    device = torch.device(opt.device)
+    # loss scaling of the float16 gradients of --amp on cuda, a pass-through otherwise (bfloat16 doesn't need it)
+    scaler = torch.cuda.amp.GradScaler(enabled=bool(opt.amp) and device.type == 'cuda')
+    # decoded caption tokens vs. the (padded) label slots they occupied, reported every epoch
+    token_stats = {'tokens': 0, 'slots': 0, 'full_slots': 0, 'time': 0.0}
 
     if os.path.exists(opt.start_from):
         if os.path.isdir(opt.start_from):
@@ -74,7 +229,7 @@ def train(model, criterion, optimizer, train_loader, val_loader, opt, rl_criteri
         else:
             start_from_file = opt.start_from
         logger.info('Loading state from: %s', start_from_file)
-        checkpoint = torch.load(start_from_file)
+        checkpoint = torch.load(start_from_file, map_location=device)
         model.load_state_dict(checkpoint['model'])
         infos = checkpoint['infos']
         infos['start_epoch'] = infos['epoch']
@@ -82,55 +237,39 @@ def train(model, criterion, optimizer, train_loader, val_loader, opt, rl_criteri
     else:
         logger.info('No checkpoint found! Training from the scratch')
 
+    # the training forwards go through DDP, which averages the gradients over the ranks on backward.
+    # sampling, validation and the model's setters use the model itself
+    forward_model = model
+    if distributed.is_distributed():
+        # the layers of the other grounder/captioner types and of skipped steps get no gradient,
+        # the only buffers are the constant positional encodings
+        forward_model = DistributedDataParallel(model, device_ids=[device.index] if device.type == 'cuda' else None,
+                                                find_unused_parameters=True, broadcast_buffers=False)
+
     if opt.use_rl == 1 and opt.use_rl_after == 0:
         opt.use_rl_after = infos['epoch']
         opt.use_cst_after = infos['epoch']
         train_loader.set_current_epoch(infos['epoch'])
 
     if opt.grounder_type in ['niuc', 'iuc']:
-        # get class weights
-        one_hot_sums = None
-        totes = 0
-        cur_index = train_loader.get_current_index()
-        train_loader.reset()
-        ep = infos['epoch']
-        while True:
-            data = train_loader.get_batch()
-            labels_svo = data['labels_svo']
-            one_hot = torch.clamp(torch.sum(torch.nn.functional.one_hot(labels_svo, num_classes=model.vocab_size), axis=1), 0, 1)
-            one_hot[:, 0] = 0  # make the padding index 0
-            totes += one_hot.shape[0]
-            if one_hot_sums is None:
-                one_hot_sums = torch.sum(one_hot, axis=0)
-            else:
-                one_hot_sums += torch.sum(one_hot, axis=0)
-
-            if ep < train_loader.get_current_epoch():
-                one_hot_negs = -one_hot_sums+totes
-                pos_weight = one_hot_negs.type(torch.FloatTensor)/(1+one_hot_sums.type(torch.FloatTensor))
-                pos_weight = pos_weight.cuda()
-
-                train_loader.set_current_index(index=cur_index)
-                break
+        # get class weights, rank 0 counts and caches them while the other ranks wait to read the cache
+        if distributed.is_main():
+            pos_weight = concept_pos_weight(opt.train_label_h5, model.vocab_size, seq_per_img).to(device)
+        distributed.barrier()
+        if not distributed.is_main():
+            pos_weight = concept_pos_weight(opt.train_label_h5, model.vocab_size, seq_per_img).to(device)
 
     while True:
+        profiler.step()
         t_start = time.time()
         model.train()
-        data = train_loader.get_batch()
-        feats = data['feats']
-        bfeats = data['bfeats']
-        labels = data['labels']
-        masks = data['masks']
-        labels_svo = data['labels_svo']
-        masks_svo = data['masks_svo']
-
-        if torch.cuda.is_available():
-            feats = [feat.cuda() for feat in feats]
-            bfeats = [bfeat.cuda() for bfeat in bfeats]
-            labels = labels.cuda()
-            masks = masks.cuda()
-            labels_svo = labels_svo.cuda()
-            masks_svo = masks_svo.cuda()
+        with timer.stage('data'):
+            data = train_loader.get_batch()
+        # masks cover each caption up to its <eos>, so this is the longest caption of the batch
+        caption_length = int(data['masks'].sum(1).max())
+        num_tokens = int(data['masks'][:, 1:].sum())
+        with timer.stage('h2d'):
+            feats, bfeats, labels, masks, labels_svo, masks_svo = batch_to_device(data, device)
 
         # implement scheduled sampling
         opt.ss_prob = 0
@@ -144,13 +283,12 @@ def train(model, criterion, optimizer, train_loader, val_loader, opt, rl_criteri
                 'epoch'] >= opt.use_rl_after and not rl_training:
             logger.info('Using RL objective...')
             rl_training = True
-            bcmr_scorer = {
-                'Bleu_4': Bleu(),
-                'CIDEr': Cider(df=opt.train_cached_tokens),
-                'METEOR': Meteor(),
-                'ROUGE_L': Rouge(),
-                'SPICE': Spice()
-                }[opt.eval_metric]
+            if opt.rl_pipeline_depth > 0:
+                # the workers build their own scorers
+                bcmr_scorer = None
+                reward_pool = RewardPool(functools.partial(make_bcmr_scorer, opt), opt.reward_workers)
+            else:
+                bcmr_scorer = make_bcmr_scorer(opt)
 
             #logger.info('loading gt refs: %s', train_loader.cocofmt_file)
             #gt_refs = utils.load_gt_refs(train_loader.cocofmt_file)
@@ -186,88 +324,156 @@ def train(model, criterion, optimizer, train_loader, val_loader, opt, rl_criteri
                 annealing_robust = int(np.ceil((infos['epoch']-opt.use_cst_after+1)/float(opt.cst_increase_every)))
                 scb_captions = min(annealing_robust, seq_per_img-1)
 
-        optimizer.zero_grad()
-        model.set_seq_per_img(seq_per_img)
-
-        if rl_training:
-            # sampling from model distribution
-            # model_res, logprobs = model.sample(
-            #    feats, {'sample_max': 0, 'expand_feat': opt.expand_feat, 'temperature': 1})
-
-            # using mixer
-            pred, model_res, logprobs, pred_svo, res_svo, logprobs_svo = model(feats, bfeats, labels, labels_svo)
+        if opt.trim_captions == 1 and not rl_training:
+            # nothing after the longest caption is decoded or scored, both captioners then stop there.
+            # not while sampling for RL, the sampled captions are only bounded by the label length
+            labels = labels[:, :caption_length]
+            masks = masks[:, :caption_length]
 
-            if opt.use_cst == 0:
-                # greedy decoding baseline in SCST paper
-                greedy_baseline, _, _, _ = model.sample([Variable(f.data, volatile=True) for f in feats], [Variable(f.data, volatile=True) for f in bfeats],
-                                           {'sample_max': 1, 'expand_feat': opt.expand_feat})
-
-            if opt.use_cst == 1:
-                bcmrscores = data['bcmrscores']
-                reward, m_score, g_score = utils.get_cst_reward(model_res, data['gts'], bcmr_scorer,
-                                                                            bcmrscores=bcmrscores,
-                                                                            expand_feat=opt.expand_feat,
-                                                                            seq_per_img=train_loader.get_seq_per_img(),
-                                                                            scb_captions=scb_captions,
-                                                                            scb_baseline=opt.scb_baseline,
-                                                                            use_eos=opt.use_eos,
-                                                                            use_mixer=opt.use_mixer
-                                                                         )
-            else:
-                # use greedy baseline by default, compute self-critical reward
-                reward, m_score, g_score = utils.get_self_critical_reward(model_res, greedy_baseline, data['gts'], bcmr_scorer,
-                                                                          expand_feat=opt.expand_feat,
-                                                                          seq_per_img=train_loader.get_seq_per_img(),
-                                                                          use_eos=opt.use_eos)
-
-            loss = rl_criterion(
-                    model_res,
-                    logprobs,
-                    Variable(
-                        torch.from_numpy(reward).float().cuda(),
-                        requires_grad=False))
-            loss_svo = criterion(pred_svo, labels_svo, torch.ones(labels.shape).cuda())
-            loss = loss + (opt.labda/10.0)*loss_svo
+        model.set_seq_per_img(seq_per_img)
+        # the gradients of the accum_steps batches of a logical batch add up, the optimizer steps after the last one
+        accum_index = infos['iter'] % opt.accum_steps
+        if accum_index == 0:
+            optimizer.zero_grad()
+
+        # captions sampled from the whole batch before learning from them (pipelined, or split into micro-batches)
+        model_res, sampled = None, None
+        if rl_training and reward_pool is not None:
+            # pipelined: sample this batch and queue its scoring, then learn from the batch sampled
+            # rl_pipeline_depth iterations ago, which the workers scored in the meantime
+            rollouts.append(rl_rollout(model, (feats, bfeats, labels, masks, labels_svo, masks_svo), data,
+                                       reward_pool, opt, seq_per_img, scb_captions, timer))
+            while len(rollouts) <= opt.rl_pipeline_depth:
+                # filling the pipeline when RL starts
+                with timer.stage('data'):
+                    data = train_loader.get_batch()
+                with timer.stage('h2d'):
+                    batch = batch_to_device(data, device)
+                rollouts.append(rl_rollout(model, batch, data, reward_pool, opt, seq_per_img, scb_captions, timer))
+            rollout = rollouts.popleft()
+            feats, bfeats, labels, masks, labels_svo, masks_svo = rollout['batch']
+            data = rollout['data']
+            num_tokens = rollout['num_tokens']
+            model_res = rollout['model_res']
+            with timer.stage('reward'):
+                reward, m_score, g_score = reward_pool.result(rollout['job'])
+        elif rl_training and 0 < opt.micro_batch < len(data['ids']):
+            # every micro-batch's loss is normalised by the tokens of all the captions sampled from the batch,
+            # so they are sampled and scored up front as well
+            with torch.no_grad():
+                _, model_res, _, _, _, _ = model(feats, bfeats, labels, labels_svo)
+            reward, m_score, g_score = rl_reward(model, (feats, bfeats, labels, masks, labels_svo, masks_svo), data,
+                                                 model_res, bcmr_scorer, opt, seq_per_img, scb_captions, timer)
+
+        if model_res is not None:
+            # log-probabilities of the sampled captions under the current weights,
+            # fed back word by word in place of the labels
+            sampled = torch.zeros_like(labels)
+            sampled[:, 0] = labels[:, 0]
+            sampled[:, 1:1 + model_res.size(1)] = model_res
+            reward_tokens = float(reward_mask(sampled[:, 1:]).sum())
+            sampling = (model.mixer_from, model.ss_prob)
+            model.set_mixer_from(0)
+            model.set_ss_prob(0)
+
+        num_rows = labels.size(0)
+        batch_tokens = float(masks[:, 1:].sum())
+        slots = labels.size(0) * (labels.size(1) - 1)
+        loss_value, loss_cap_value, loss_svo_value = 0.0, 0.0, 0.0
+        micros = list(micro_batches((feats, bfeats, labels, masks, labels_svo, masks_svo), data,
+                                    opt.micro_batch, seq_per_img))
+        for micro, ((feats, bfeats, labels, masks, labels_svo, masks_svo), micro_data, rows) in enumerate(micros):
+            # the losses are means over the batch, a micro-batch weighs in with its share of the caption rows
+            # (of the tokens for the cross entropy of the captions, the RL loss is normalised by all the sampled tokens)
+            share = (rows.stop - rows.start) / float(num_rows)
+            # DDP averages the gradients over the ranks once, with the last micro-batch of the logical batch
+            sync = micro == len(micros) - 1 and accum_index == opt.accum_steps - 1
+            with no_sync(forward_model, sync):
+                if rl_training:
+                    if sampled is not None:
+                        pred, model_res, logprobs, pred_svo, res_svo, logprobs_svo = forward_model(feats, bfeats, sampled[rows], labels_svo)
+                        loss = rl_criterion(model_res, logprobs,
+                                            torch.from_numpy(reward[rows]).float().to(device), reward_tokens)
+                    else:
+                        # sampling from model distribution
+                        # model_res, logprobs = model.sample(
+                        #    feats, {'sample_max': 0, 'expand_feat': opt.expand_feat, 'temperature': 1})
+
+                        # using mixer
+                        pred, model_res, logprobs, pred_svo, res_svo, logprobs_svo = forward_model(feats, bfeats, labels, labels_svo)
+                        reward, m_score, g_score = rl_reward(model, (feats, bfeats, labels, masks, labels_svo, masks_svo),
+                                                             micro_data, model_res, bcmr_scorer, opt, seq_per_img,
+                                                             scb_captions, timer)
+                        loss = rl_criterion(
+                                model_res,
+                                logprobs,
+                                Variable(
+                                    torch.from_numpy(reward).float().to(device),
+                                    requires_grad=False))
+                    loss_svo = criterion(pred_svo, labels_svo, torch.ones(labels.shape, device=device))
+                    loss = loss + share * (opt.labda/10.0)*loss_svo
 
-        else:
-            pred, _, _, pred_svo, svo_it, svo_gath = model(feats, bfeats, labels, labels_svo)
-            loss_cap = criterion(pred, labels[:, 1:], masks[:, 1:], bcmrscores=torch.from_numpy(data['bcmrscores'].astype(np.float32)).cuda())
-            if opt.grounder_type in ['None', 'none']:
-                loss = loss_cap
-            else:
-                if opt.grounder_type in ['niuc', 'iuc']:  # unordered
-                    svo_criterion = torch.nn.BCEWithLogitsLoss(pos_weight=pos_weight)
-                    concepts_one_hot = torch.clamp(torch.sum(torch.nn.functional.one_hot(labels_svo, num_classes=model.vocab_size), axis=1),  0, 1)
-                    loss_svo = svo_criterion(pred_svo[:, 0], concepts_one_hot.type(torch.FloatTensor).cuda())  # pred_svo[: 0] undoes the repeat at the end of non_iterative_grounder()
                 else:
-                    loss_svo = criterion(pred_svo, labels_svo, torch.ones(labels.shape).cuda())
-                    # loss_svo = criterion(pred_svo, labels_svo, masks_svo)
-
-                if random.random() < 0.01:  # compare the svos during training
-                    print('---------------------')
-                    print(utils.decode_sequence(opt.vocab, pred.argmax(-1)))
-                    print(utils.decode_sequence(opt.vocab, labels_svo)[0])
-                    print(utils.decode_sequence(opt.vocab, svo_it)[0])
-                loss = loss_cap + (opt.labda/10.0)*loss_svo
-
-        loss.backward()
-        clip_grad_norm_(model.parameters(), opt.grad_clip)
-        optimizer.step()
+                    pred, _, _, pred_svo, svo_it, svo_gath = forward_model(feats, bfeats, labels, labels_svo)
+                    loss_cap = criterion(pred, labels[:, 1:], masks[:, 1:], bcmrscores=torch.from_numpy(micro_data['bcmrscores'].astype(np.float32)).to(device))
+                    cap_share = float(masks[:, 1:].sum()) / batch_tokens
+                    loss_cap_value += cap_share * loss_cap.item()
+                    if opt.grounder_type in ['None', 'none']:
+                        loss = cap_share * loss_cap
+                    else:
+                        if opt.grounder_type in ['niuc', 'iuc']:  # unordered
+                            svo_criterion = torch.nn.BCEWithLogitsLoss(pos_weight=pos_weight)
+                            concepts_one_hot = torch.clamp(torch.sum(torch.nn.functional.one_hot(labels_svo, num_classes=model.vocab_size), axis=1),  0, 1)
+                            loss_svo = svo_criterion(pred_svo[:, 0], concepts_one_hot.float())  # pred_svo[: 0] undoes the repeat at the end of non_iterative_grounder()
+                        else:
+                            loss_svo = criterion(pred_svo, labels_svo, torch.ones(labels.shape, device=device))
+                            # loss_svo = criterion(pred_svo, labels_svo, masks_svo)
+
+                        if random.random() < 0.01:  # compare the svos during training
+                            print('---------------------')
+                            print(utils.decode_sequence(opt.vocab, pred.argmax(-1)))
+                            print(utils.decode_sequence(opt.vocab, labels_svo)[0])
+                            print(utils.decode_sequence(opt.vocab, svo_it)[0])
+                        loss = cap_share * loss_cap + share * (opt.labda/10.0)*loss_svo
+
+                if opt.grounder_type not in ['None', 'none']:
+                    loss_svo_value += share * loss_svo.item()
+                loss_value += loss.item()
+                with timer.stage('backward'):
+                    # and the batches of a logical batch weigh in equally
+                    scaler.scale(loss / opt.accum_steps).backward()
+            del pred
+
+        if sampled is not None:
+            model.set_mixer_from(sampling[0])
+            model.set_ss_prob(sampling[1])
+
+        if accum_index == opt.accum_steps - 1:
+            with timer.stage('optimizer'):
+                scaler.unscale_(optimizer)  # clip the true gradients
+                clip_grad_norm_(model.parameters(), opt.grad_clip)
+                scaler.step(optimizer)
+                scaler.update()
+        timer.count(videos=len(data['ids']), tokens=num_tokens)
+        token_stats['tokens'] += num_tokens
+        token_stats['slots'] += slots
+        token_stats['full_slots'] += num_rows * (data['labels'].size(1) - 1)
+        token_stats['time'] += time.time() - t_start
         # memReport()
-        del pred, feats, labels, masks, labels_svo
-        torch.cuda.empty_cache()
+        del feats, labels, masks, labels_svo
 
-        infos['TrainLoss'] = loss.item()
-        infos['CAPTrainLoss'] = loss_cap.item()
-        if opt.grounder_type not in ['None', 'none']:
-            infos['SVOTrainLoss'] = loss_svo.item()
-        else:
-            infos['SVOTrainLoss'] = 0
+        infos['TrainLoss'] = loss_value
+        infos['CAPTrainLoss'] = loss_cap_value
+        infos['SVOTrainLoss'] = loss_svo_value
         infos['mixer_from'] = mixer_from
         infos['scb_captions'] = scb_captions
 
         if infos['iter'] % opt.print_log_interval == 0:
+            timer.flush(iter=infos['iter'], epoch=infos['epoch'], rl=rl_training)
             elapsed_time = time.time() - t_start
+            # over the batches of all ranks
+            infos['TrainLoss'], infos['CAPTrainLoss'], infos['SVOTrainLoss'] = distributed.all_reduce(
+                [infos['TrainLoss'], infos['CAPTrainLoss'], infos['SVOTrainLoss']])
 
             log_info = [('Epoch', infos['epoch']),
                         ('Iter', infos['iter']),
@@ -276,7 +482,8 @@ def train(model, criterion, optimizer, train_loader, val_loader, opt, rl_criteri
                         ('SVO Loss', infos['SVOTrainLoss'])]
 
             if rl_training:
-                log_info += [('Reward', np.mean(reward[:, 0])),
+                mean_reward, m_score, g_score = distributed.all_reduce([np.mean(reward[:, 0]), m_score, g_score])
+                log_info += [('Reward', mean_reward),
                              ('{} (m)'.format(opt.eval_metric), m_score),
                              ('{} (b)'.format(opt.eval_metric), g_score)]
 
@@ -296,6 +503,24 @@ def train(model, criterion, optimizer, train_loader, val_loader, opt, rl_criteri
         infos['iter'] += 1
 
         if infos['epoch'] < train_loader.get_current_epoch():
+            # the ranks run in step, so the tokens of all of them in this rank's time
+            tokens, slots, full_slots = distributed.all_reduce(
+                [token_stats['tokens'], token_stats['slots'], token_stats['full_slots']], average=False)
+            logger.info('Epoch %d: %.0f caption tokens/s, padding waste %.1f%% (%.1f%% without trimming)',
+                        infos['epoch'], tokens / max(token_stats['time'], 1e-6),
+                        100.0 * (1 - tokens / float(max(slots, 1))),
+                        100.0 * (1 - tokens / float(max(full_slots, 1))))
+            token_stats = {'tokens': 0, 'slots': 0, 'full_slots': 0, 'time': 0.0}
+            if rl_training and isinstance(bcmr_scorer, CiderD) and bcmr_scorer.cache is not None:
+                logger.info('Reward reference cache: %(videos)d videos (%(mbytes).1f MB), '
+                            'hit rate %(hit_rate).3f (%(hits)d hits, %(misses)d misses, %(evictions)d evictions)',
+                            bcmr_scorer.cache.stats())
+            if reward_pool is not None and reward_pool.stats['jobs'] > 0:
+                jobs = reward_pool.stats['jobs']
+                logger.info('Reward scoring: %.0f ms/batch in the workers, %.0f ms/batch waited for, %.0f%% overlapped',
+                            1000.0 * reward_pool.stats['score_time'] / jobs, 1000.0 * reward_pool.stats['wait_time'] / jobs,
+                            100.0 * reward_pool.overlap())
+                reward_pool.reset_stats()
             infos['epoch'] = train_loader.get_current_epoch()
             checkpoint_checked = False
             learning_rate = utils.adjust_learning_rate(
@@ -307,33 +532,46 @@ def train(model, criterion, optimizer, train_loader, val_loader, opt, rl_criteri
         if (infos['epoch'] >= opt.save_checkpoint_from and
                 infos['epoch'] % opt.save_checkpoint_every == 0 and
                 not checkpoint_checked):
-            # evaluate the validation performance
-            results = validate(model, criterion, val_loader, opt)
-            logger.info(
-                'Validation output: %s',
-                json.dumps(
-                    results['scores'],
-                    indent=4,
-                    sort_keys=True))
-            # infos.update(results['scores'])
-
-            # todo added training set eval to check for overfitting
-            cur_index = train_loader.get_current_index()
-            train_loader.reset()
-            results_train = validate(model, criterion, train_loader, opt, max_iters=20, type='train')
-            train_loader.set_current_index(index=cur_index)
-            for k, v in results_train['scores'].items():
-                results['scores']['Train_'+k] = v
-
-            logger.info(
-                'Training output: %s',
-                json.dumps(
-                    results_train['scores'],
-                    indent=4,
-                    sort_keys=True))
-            infos.update(results['scores'])
-
-            check_model(model, opt, infos, infos_history)
+            # only rank 0 validates and writes the checkpoint and history
+            if distributed.is_main():
+                # validation runs its own forwards, they are not counted as training grounder/captioner time
+                model.set_timer(NULL_TIMER)
+                with timer.stage('validation'):
+                    # evaluate the validation performance
+                    results = validate(model, criterion, val_loader, opt)
+                    logger.info(
+                        'Validation output: %s',
+                        json.dumps(
+                            results['scores'],
+                            indent=4,
+                            sort_keys=True))
+                    # infos.update(results['scores'])
+
+                    # todo added training set eval to check for overfitting
+                    # the 20 batches can run past the end of an epoch (of a rank's share of the videos), the epoch
+                    # is restored too so this rank doesn't reach the end of the epoch ahead of the others
+                    cur_index = train_loader.get_current_index()
+                    cur_epoch = train_loader.get_current_epoch()
+                    train_loader.reset()
+                    results_train = validate(model, criterion, train_loader, opt, max_iters=20, type='train')
+                    train_loader.set_current_epoch(cur_epoch)
+                    train_loader.set_current_index(index=cur_index)
+                    for k, v in results_train['scores'].items():
+                        results['scores']['Train_'+k] = v
+
+                    logger.info(
+                        'Training output: %s',
+                        json.dumps(
+                            results_train['scores'],
+                            indent=4,
+                            sort_keys=True))
+                infos.update(results['scores'])
+                model.set_timer(timer)
+
+                with timer.stage('checkpoint'):
+                    check_model(model, opt, infos, infos_history)
+            # the other ranks take rank 0's scores, so all of them agree on the best epoch and when to stop
+            infos, infos_history = distributed.broadcast((infos, infos_history))
             checkpoint_checked = True
 
         if (infos['epoch'] >= opt.max_epochs or
@@ -341,12 +579,16 @@ def train(model, criterion, optimizer, train_loader, val_loader, opt, rl_criteri
             logger.info('>>> Terminating...')
             break
 
+    profiler.close()
+    if reward_pool is not None:
+        reward_pool.close()
     return infos
 
 
-def validate(model, criterion, loader, opt, max_iters=None, type='val'):
+def validate(model, criterion, loader, opt, max_iters=None, type='val', profiler=None):
     model.eval()
     loader.reset()
+    device = torch.device(opt.device)
 
     num_videos = loader.get_num_videos()
     batch_size = loader.get_batch_size()
@@ -369,6 +611,8 @@ def validate(model, criterion, loader, opt, max_iters=None, type='val'):
     test_avglogps = []
     prec_recs = dict()
     for ii in range(num_iters):
+        if profiler is not None:
+            profiler.step()
         data = loader.get_batch()
         feats = data['feats']
         bfeats = data['bfeats']		
@@ -385,13 +629,14 @@ def validate(model, criterion, loader, opt, max_iters=None, type='val'):
                 masks = masks[:last_batch_size * seq_per_img]
                 labels_svo = labels_svo[:last_batch_size * seq_per_img]  # labels shape is DxN
 
-        if torch.cuda.is_available():
-            feats = [feat.cuda() for feat in feats]
-            bfeats = [bfeat.cuda() for bfeat in bfeats]
-            if loader.has_label:
-                labels = labels.cuda()
-                masks = masks.cuda()
-                labels_svo = labels_svo.cuda()
+        feats = [feat.to(device, non_blocking=True) for feat in feats]
+        bfeats = [bfeat.to(device, non_blocking=True) for bfeat in bfeats]
+        if loader.has_label:
+            labels = labels.to(device, non_blocking=True)
+            masks = masks.to(device, non_blocking=True)
+            labels_svo = labels_svo.to(device, non_blocking=True)
+        feats = [feat.float() for feat in feats]
+        bfeats = [bfeat.float() for bfeat in bfeats]
 
         if loader.has_label and model.gt_concepts_while_testing == 0:
             pred, gt_seq, gt_logseq, _, _, _ = model(feats, bfeats, labels, labels_svo)
@@ -403,7 +648,6 @@ def validate(model, criterion, loader, opt, max_iters=None, type='val'):
             loss = criterion(pred, labels[:, 1:], masks[:, 1:])
             loss_sum += loss.item()
             del pred, gt_seq, gt_logseq
-            torch.cuda.empty_cache()
 
         seq, logseq, _, concept_seq = model.sample(feats, bfeats, labels_svo, {'beam_size': opt.beam_size})
         sents = utils.decode_sequence(opt.vocab, seq)
@@ -464,8 +708,9 @@ def validate(model, criterion, loader, opt, max_iters=None, type='val'):
                 logger.debug('[%d] video %s: %s' % (jj, entry['image_id'], entry['caption']))
 
         del feats, labels, masks, labels_svo, seq, logseq
-        torch.cuda.empty_cache()
 
+    if profiler is not None:
+        profiler.close()
     loss = round(loss_sum / num_iters, 3)
     results = {}
     lang_stats = {}
@@ -516,12 +761,13 @@ def validate(model, criterion, loader, opt, max_iters=None, type='val'):
     return results
 
 
-def test(model, criterion, loader, opt):
-    results = validate(model, criterion, loader, opt, type='test')
+def test(model, criterion, loader, opt, profiler=None):
+    results = validate(model, criterion, loader, opt, type='test', profiler=profiler)
     logger.info('Test output: %s', json.dumps(results['scores'], indent=4))
 
     json.dump(results, open(opt.result_file, 'w'))
     logger.info('Wrote output caption to: %s ', opt.result_file)
+    return results
 
 
 def check_model(model, opt, infos, infos_history):
@@ -561,6 +807,8 @@ def check_model(model, opt, infos, infos_history):
 if __name__ == '__main__':
 
     opt = opts.parse_opts()
+    # (0, 0, 1) unless launched with torchrun
+    rank, local_rank, world_size = distributed.init(opt.dist_backend, opt.dist_timeout)
 
     # set the inputs for each dataset
     if opt.dataset == 'msvd':
@@ -605,10 +853,14 @@ if __name__ == '__main__':
     opt.train_cached_tokens = os.path.join('datasets', opt.dataset, 'metadata', opt.dataset+'_train_ciderdf.pkl')
 
     os.makedirs(os.path.join(opt.results_dir, opt.model_id), exist_ok=True)
-    log_path = os.path.join(opt.results_dir, opt.model_id, opt.dataset + '.log')
+    log_path = os.path.join(opt.results_dir, opt.model_id, opt.dataset + ('_rank%d.log' % rank if rank > 0 else '.log'))
     opt.model_file = os.path.join(opt.results_dir, opt.model_id, opt.dataset + '.pth')
     opt.result_file = os.path.join(opt.results_dir, opt.model_id, opt.dataset + '.json')
     opt.history_file = os.path.join(opt.results_dir, opt.model_id, opt.dataset + '_history.json')
+    opt.timing_file = os.path.join(opt.results_dir, opt.model_id,
+                                   opt.dataset + ('_rank%d_timing.jsonl' % rank if rank > 0 else '_timing.jsonl'))
+    if rank > 0:
+        opt.profile_steps = ''  # rank 0 is profiled
 
     logging.basicConfig(filename=log_path,
                         filemode='a', level=getattr(logging, opt.loglevel.upper()),
@@ -616,11 +868,18 @@ if __name__ == '__main__':
 
     logger.info('Input arguments: %s', json.dumps(vars(opt), sort_keys=True, indent=4))
 
+    if world_size > 1:
+        logger.info('Distributed training: rank %d of %d', rank, world_size)
+        if opt.device in ['', 'cuda'] and torch.cuda.is_available():
+            opt.device = 'cuda:%d' % local_rank  # one gpu per rank
+    device = utils.setup_device(opt)
+
     # Set the random seed manually for reproducibility.
-    np.random.seed(opt.seed)
-    torch.manual_seed(opt.seed)
+    # every rank samples its own captions and dropout, DDP starts all of them from rank 0's weights
+    np.random.seed(opt.seed + rank)
+    torch.manual_seed(opt.seed + rank)
     if torch.cuda.is_available():
-        torch.cuda.manual_seed(opt.seed)
+        torch.cuda.manual_seed(opt.seed + rank)
 
     train_opt = {'label_h5': opt.train_label_h5,
                  'batch_size': opt.batch_size,
@@ -632,6 +891,14 @@ if __name__ == '__main__':
                  'eval_metric': opt.eval_metric,
                  'seq_per_img': opt.train_seq_per_img,
                  'num_chunks': opt.num_chunks,
+                 'prefetch': opt.prefetch,
+                 'prefetch_workers': opt.prefetch_workers,
+                 'feat_mmap': opt.feat_mmap,
+                 'labels_in_memory': opt.labels_in_memory,
+                 'buffer_pool': opt.buffer_pool,
+                 'num_workers': opt.num_workers,
+                 'feat_dtype': opt.feat_dtype,
+                 'bucket_by_length': opt.bucket_by_length,
                  'mode': 'train'
                  }
 
@@ -643,6 +910,13 @@ if __name__ == '__main__':
                'cocofmt_file': opt.val_cocofmt_file,
                'seq_per_img': opt.test_seq_per_img,
                'num_chunks': opt.num_chunks,
+               'prefetch': opt.prefetch,
+               'prefetch_workers': opt.prefetch_workers,
+               'feat_mmap': opt.feat_mmap,
+               'labels_in_memory': opt.labels_in_memory,
+               'buffer_pool': opt.buffer_pool,
+               'num_workers': opt.num_workers,
+               'feat_dtype': opt.feat_dtype,
                'mode': 'val'
                }
 
@@ -654,12 +928,27 @@ if __name__ == '__main__':
                 'cocofmt_file': opt.test_cocofmt_file,
                 'seq_per_img': opt.test_seq_per_img,
                 'num_chunks': opt.num_chunks,
+                'prefetch': opt.prefetch,
+                'prefetch_workers': opt.prefetch_workers,
+                'feat_mmap': opt.feat_mmap,
+                'labels_in_memory': opt.labels_in_memory,
+                'buffer_pool': opt.buffer_pool,
+                'num_workers': opt.num_workers,
+                'feat_dtype': opt.feat_dtype,
                 'mode': 'test'
                 }
 
-    train_loader = DataLoader(train_opt)
-    val_loader = DataLoader(val_opt)
-    test_loader = DataLoader(test_opt)
+    loader_class = VideoDataLoader if opt.num_workers > 0 else DataLoader
+    if world_size > 1:
+        # every rank trains on its share of each epoch, in an order all ranks agree on.
+        # only VideoDataLoader shards (it reads in-process with num_workers 0)
+        train_opt.update({'num_replicas': world_size, 'rank': rank, 'seed': opt.seed})
+        train_loader = VideoDataLoader(train_opt)
+    else:
+        train_loader = loader_class(train_opt)
+    # validation and testing run on rank 0
+    val_loader = loader_class(val_opt) if rank == 0 else None
+    test_loader = loader_class(test_opt) if rank == 0 else None
 
     opt.vocab = train_loader.get_vocab()
     opt.vocab_size = train_loader.get_vocab_size()
@@ -677,10 +966,9 @@ if __name__ == '__main__':
     xe_criterion = CrossEntropyCriterion()
     rl_criterion = RewardCriterion()
 
-    if torch.cuda.is_available():
-        model.cuda()
-        xe_criterion.cuda()
-        rl_criterion.cuda()
+    model.to(device)
+    xe_criterion.to(device)
+    rl_criterion.to(device)
 
     logger.info('Start training...')
     start = datetime.now()
@@ -693,12 +981,12 @@ if __name__ == '__main__':
 
     logger.info('Training time: %s', datetime.now() - start)
 
-    if opt.result_file:
+    if opt.result_file and rank == 0:
         logger.info('Start testing...')
         start = datetime.now()
 
         logger.info('Loading model: %s', opt.model_file)
-        checkpoint = torch.load(opt.model_file)
+        checkpoint = torch.load(opt.model_file, map_location=device)
         model.load_state_dict(checkpoint['model'])
 
         test(model, xe_criterion, test_loader, opt)
@@ -713,3 +1001,6 @@ if __name__ == '__main__':
             test(model, xe_criterion, test_loader, opt)
             logger.info('Testing time: %s', datetime.now() - start)
 
+    shutdown_scorers()
+    distributed.close()
+
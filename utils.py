@@ -16,11 +16,23 @@ from pycocoevalcap.bleu.bleu import Bleu
 from pycocoevalcap.rouge.rouge import Rouge
 from pycocoevalcap.meteor.meteor import Meteor
 from pycocoevalcap.cider.cider import Cider
-#from pyciderevalcap.ciderD.ciderD import CiderD
+from pycocoevalcap.scorers import get_scorer
+from ciderd import CiderD
 
 from six.moves import cPickle
 from pdb import set_trace
 
+def setup_device(opt):
+    """Resolve opt.device (empty = cuda when available) and apply the CPU thread settings"""
+    if not opt.device:
+        opt.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    if opt.num_threads > 0:
+        torch.set_num_threads(opt.num_threads)
+    if opt.num_interop_threads > 0:
+        torch.set_num_interop_threads(opt.num_interop_threads)
+    return torch.device(opt.device)
+
+
 def adjust_learning_rate(opt, optimizer, epoch):
     """Sets the learning rate to the initial LR
        decayed by 10 every [lr_update] epochs"""
@@ -37,10 +49,10 @@ def score(ref, hypo):
     score, dictionary of scores
     """
     scorers = [
-        (Bleu(4), ["Bleu_1", "Bleu_2", "Bleu_3", "Bleu_4"]),
-        (Meteor(), "METEOR"),
-        (Rouge(), "ROUGE_L"),
-        (Cider(), "CIDEr")
+        (get_scorer('Bleu'), ["Bleu_1", "Bleu_2", "Bleu_3", "Bleu_4"]),
+        (get_scorer('METEOR'), "METEOR"),
+        (get_scorer('ROUGE_L'), "ROUGE_L"),
+        (get_scorer('CIDEr'), "CIDEr")
     ]
     final_scores = {}
     for scorer, method in scorers:
@@ -208,36 +220,45 @@ def get_self_critical_reward(
         bcmr_scorer,
         expand_feat=0,
         seq_per_img=20,
-        use_eos=0):
+        use_eos=0,
+        video_ids=None):
     
     batch_size = model_res.size(0)
 
     model_res = model_res.cpu().numpy()
     greedy_res = greedy_res.cpu().numpy()
-    
-    res = OrderedDict()
-    for i in range(batch_size):
-        res[i] = [array_to_str(model_res[i], use_eos)]
-    for i in range(batch_size):
-        res[batch_size + i] = [array_to_str(greedy_res[i], use_eos)]
-
-    gts = OrderedDict()
-    for i in range(len(data_gts)):
-        gts[i] = [array_to_str(data_gts[i][j], use_eos)
-                  for j in range(len(data_gts[i]))]
-    
-    #_, scores = Bleu(4).compute_score(gts, res)
-    #scores = np.array(scores[3])
-    if isinstance(bcmr_scorer, CiderD):    
-        res = [{'image_id': i, 'caption': res[i]} for i in range(2 * batch_size)]
-        
-    if expand_feat == 1:
-        gts = {i: gts[(i % batch_size) // seq_per_img]
-               for i in range(2 * batch_size)}
+
+    if isinstance(bcmr_scorer, CiderD):
+        # scored on the token ids, no strings
+        width = max(model_res.shape[1], greedy_res.shape[1])
+        captions = np.zeros((2 * batch_size, width), dtype=np.int64)
+        captions[:batch_size, :model_res.shape[1]] = model_res
+        captions[batch_size:, :greedy_res.shape[1]] = greedy_res
+        videos = np.arange(2 * batch_size) % batch_size
+        if expand_feat == 1:
+            videos = videos // seq_per_img
+        score, scores = bcmr_scorer.compute_scores(captions, data_gts, videos, use_eos, video_ids)
     else:
-        gts = {i: gts[i % batch_size] for i in range(2 * batch_size)}
-    #set_trace()
-    score, scores = bcmr_scorer.compute_score(gts, res)
+        res = OrderedDict()
+        for i in range(batch_size):
+            res[i] = [array_to_str(model_res[i], use_eos)]
+        for i in range(batch_size):
+            res[batch_size + i] = [array_to_str(greedy_res[i], use_eos)]
+
+        gts = OrderedDict()
+        for i in range(len(data_gts)):
+            gts[i] = [array_to_str(data_gts[i][j], use_eos)
+                      for j in range(len(data_gts[i]))]
+
+        #_, scores = Bleu(4).compute_score(gts, res)
+        #scores = np.array(scores[3])
+        if expand_feat == 1:
+            gts = {i: gts[(i % batch_size) // seq_per_img]
+                   for i in range(2 * batch_size)}
+        else:
+            gts = {i: gts[i % batch_size] for i in range(2 * batch_size)}
+        #set_trace()
+        score, scores = bcmr_scorer.compute_score(gts, res)
     
     # if bleu, only use bleu_4
     if isinstance(bcmr_scorer, Bleu):
@@ -268,39 +289,45 @@ def get_cst_reward(
         scb_captions=20,
         scb_baseline=1,
         use_eos=0,
-        use_mixer=0):
+        use_mixer=0,
+        video_ids=None):
     
     """
     Arguments:
         bcmrscores: precomputed scores of GT sequences
         scb_baseline: 1 - use GT to compute baseline, 
                       2 - use MS to compute baseline
+        video_ids: ids of the videos of data_gts, for the reference cache of CiderD
     """
     
     if bcmrscores is None or use_mixer == 1:
         batch_size = model_res.size(0)
 
         model_res = model_res.cpu().numpy()
-        
-        res = OrderedDict()
-        for i in range(batch_size):
-            res[i] = [array_to_str(model_res[i], use_eos)]
-
-        gts = OrderedDict()
-        for i in range(len(data_gts)):
-            gts[i] = [array_to_str(data_gts[i][j], use_eos)
-                      for j in range(len(data_gts[i]))]
 
-        if isinstance(bcmr_scorer, CiderD):    
-            res = [{'image_id': i, 'caption': res[i]} for i in range(batch_size)]
-        
-        if expand_feat == 1:
-            gts = {i: gts[(i % batch_size) // seq_per_img]
-                   for i in range(batch_size)}
+        if isinstance(bcmr_scorer, CiderD):
+            # scored on the token ids, no strings
+            videos = np.arange(batch_size)
+            if expand_feat == 1:
+                videos = videos // seq_per_img
+            _, scores = bcmr_scorer.compute_scores(model_res, data_gts, videos, use_eos, video_ids)
         else:
-            gts = {i: gts[i % batch_size] for i in range(batch_size)}
-        
-        _, scores = bcmr_scorer.compute_score(gts, res)
+            res = OrderedDict()
+            for i in range(batch_size):
+                res[i] = [array_to_str(model_res[i], use_eos)]
+
+            gts = OrderedDict()
+            for i in range(len(data_gts)):
+                gts[i] = [array_to_str(data_gts[i][j], use_eos)
+                          for j in range(len(data_gts[i]))]
+
+            if expand_feat == 1:
+                gts = {i: gts[(i % batch_size) // seq_per_img]
+                       for i in range(batch_size)}
+            else:
+                gts = {i: gts[i % batch_size] for i in range(batch_size)}
+
+            _, scores = bcmr_scorer.compute_score(gts, res)
             
         # if bleu, only use bleu_4
         if isinstance(bcmr_scorer, Bleu):
@@ -0,0 +1,315 @@
+import os
+
+import h5py
+import numpy as np
+import torch
+import torch.utils.data
+from six.moves import cPickle
+
+from dataloader import bucket_order, caption_lengths, sample_rows
+from feature_store import open_feature_store
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class VideoDataset(torch.utils.data.Dataset):
+    """
+    Map-style dataset over the videos of a label h5 file, one item holds one video's features,
+    rois and sampled caption/svo rows. Takes the same options as DataLoader
+    The h5 and feature files are opened lazily by each process that reads items, so workers never share handles
+    """
+
+    def __init__(self, opt):
+        self.opt = opt
+        self.seq_per_img = opt.get('seq_per_img', 1)
+        self.num_chunks = opt.get('num_chunks', 1)
+        self.num_boxes = opt.get('num_boxes', 10)
+        self.feat_mmap = opt.get('feat_mmap', 1)
+        self.feat_dtype = opt.get('feat_dtype', 'float32')
+        self.labels_in_memory = opt.get('labels_in_memory', 0)
+        self.cocofmt_file = opt.get('cocofmt_file', None)
+        self.bcmrscores_pkl = opt.get('bcmrscores_pkl', None)
+
+        # everything small enough is read here once and shipped to the workers,
+        # the handles are closed again before any worker is started
+        with h5py.File(opt['label_h5'], 'r') as label_h5:
+            self.vocab = list(label_h5['vocab'][()])
+            self.videos = list(label_h5['videos'][()])
+            self.has_label = 'labels' in label_h5.keys()
+            if self.has_label:
+                self.seq_length = label_h5['labels'].shape[1]
+                self.svo_length = label_h5['labels_svo'].shape[1]
+                self.label_start_ix = label_h5['label_start_ix'][()]
+                self.label_end_ix = label_h5['label_end_ix'][()]
+                self.label_start_ix_svo = label_h5['label_start_ix_svo'][()]
+                self.label_end_ix_svo = label_h5['label_end_ix_svo'][()]
+                if self.labels_in_memory:
+                    self.labels = label_h5['labels'][()]
+                    self.labels_svo = label_h5['labels_svo'][()]
+                self.caption_lengths = None
+                if opt.get('bucket_by_length', 0):
+                    self.caption_lengths = caption_lengths(label_h5['labels'][()], self.label_start_ix, self.label_end_ix)
+        self.ix_to_word = {i: w for i, w in enumerate(self.vocab)}
+        self.num_videos = len(self.videos)
+
+        self.feat_dims = []
+        for path in opt['feat_h5']:
+            store = open_feature_store(path, mmap=False)
+            self.feat_dims.append(store.sample_shape(int(self.videos[0]))[0])
+            store.close()
+        self.bfeat_dims = []
+        for path in opt['bfeat_h5']:
+            store = open_feature_store(path, mmap=False)
+            self.bfeat_dims.append(store.sample_shape(int(self.videos[0]))[1])
+            store.close()
+
+        if self.bcmrscores_pkl is not None:
+            eval_metric = opt.get('eval_metric', 'CIDEr')
+            logger.info('Loading: %s, with metric: %s', self.bcmrscores_pkl, eval_metric)
+            self.bcmrscores = cPickle.load(open(self.bcmrscores_pkl, 'rb'))
+            if eval_metric == 'CIDEr' and eval_metric not in self.bcmrscores:
+                eval_metric = 'cider'
+            self.bcmrscores = self.bcmrscores[eval_metric]
+
+        self._pid = None
+
+    def _open(self):
+        """(Re)open the files in the current process"""
+        self.feat_stores = [open_feature_store(path, mmap=self.feat_mmap) for path in self.opt['feat_h5']]
+        self.bfeat_stores = [open_feature_store(path, mmap=self.feat_mmap) for path in self.opt['bfeat_h5']]
+        if self.has_label and not self.labels_in_memory:
+            self.label_h5 = h5py.File(self.opt['label_h5'], 'r')
+            self.labels = self.label_h5['labels']
+            self.labels_svo = self.label_h5['labels_svo']
+        self._pid = os.getpid()
+
+    def __getstate__(self):
+        # handles opened by another process must not be pickled into a worker
+        state = dict(self.__dict__)
+        if state['_pid'] is not None:
+            for key in ['feat_stores', 'bfeat_stores', 'label_h5']:
+                state.pop(key, None)
+            if self.has_label and not self.labels_in_memory:
+                state.pop('labels')
+                state.pop('labels_svo')
+            state['_pid'] = None
+        return state
+
+    def __len__(self):
+        return self.num_videos
+
+    def __getitem__(self, idx):
+        if self._pid != os.getpid():
+            self._open()
+        # torch seeds every worker differently, numpy is not
+        rng = np.random.RandomState(torch.randint(2 ** 31 - 1, (1,)).item())
+
+        video_id = int(self.videos[idx])
+        item = {'id': video_id}
+        dtype = getattr(torch, self.feat_dtype)
+        item['feats'] = [torch.from_numpy(store.read_batch([video_id])[0]).to(dtype).unsqueeze(0).expand(self.num_chunks, -1)
+                         for store in self.feat_stores]
+
+        item['bfeats'] = []
+        bb_counts = []
+        for jj, store in enumerate(self.bfeat_stores):
+            boxes, counts = store.read_boxes([video_id], self.num_boxes)
+            boxes = torch.from_numpy(boxes[0]).to(dtype)
+            if counts[0] == 0:
+                boxes = torch.rand(self.num_boxes, self.bfeat_dims[jj]).to(dtype)
+            item['bfeats'].append(boxes)
+            bb_counts.append(counts[0])
+        assert all(nb == bb_counts[0] for nb in bb_counts), 'Wrong rois detected!'
+
+        if self.has_label:
+            start, end = self.label_start_ix[idx], self.label_end_ix[idx]
+            captions = self.labels[start:end]
+            rows = sample_rows(np.array([start]), np.array([end]), self.seq_per_img, rng)
+            item['labels'] = torch.from_numpy(captions[rows - start])
+
+            start_svo, end_svo = self.label_start_ix_svo[idx], self.label_end_ix_svo[idx]
+            rows = sample_rows(np.array([start_svo]), np.array([end_svo]), self.seq_per_img, rng)
+            item['labels_svo'] = torch.from_numpy(self.labels_svo[start_svo:end_svo][rows - start_svo])
+
+            # Used for reward evaluation
+            item['gts'] = captions
+            if self.bcmrscores_pkl is not None:
+                item['bcmrscores'] = self.bcmrscores[idx]
+        return item
+
+
+def collate_batch(items):
+    """Stack dataset items into the data dict DataLoader.get_batch returns"""
+    data = {}
+    data['feats'] = [torch.stack(feats) for feats in zip(*[item['feats'] for item in items])]
+    data['bfeats'] = [torch.stack(bfeats) for bfeats in zip(*[item['bfeats'] for item in items])]
+    data['ids'] = [item['id'] for item in items]
+
+    if 'labels' in items[0]:
+        for key, mask_key in [('labels', 'masks'), ('labels_svo', 'masks_svo')]:
+            labels = torch.cat([item[key] for item in items])
+            # + 1 here to count the <eos> token, because the <eos> token is set to 0
+            nonzeros = (labels != 0).sum(1) + 1
+            data[key] = labels
+            data[mask_key] = (torch.arange(labels.shape[1]).unsqueeze(0) < nonzeros.unsqueeze(1)).float()
+        data['gts'] = [item['gts'] for item in items]
+        data['bcmrscores'] = np.stack([item['bcmrscores'] for item in items]) if 'bcmrscores' in items[0] else None
+    return data
+
+
+class EpochBatchSampler(torch.utils.data.Sampler):
+    """
+    Endless stream of batches of dataset indices, starting at a given (epoch, position)
+    Like DataLoader, batches run on across epoch boundaries. Every epoch is shuffled with seed + epoch,
+    so all ranks agree on the order and each takes every num_replicas-th video of it
+    (padded by repeating videos so all ranks get the same number)
+    Given the caption length of every video, each rank's share is bucketed by length (see bucket_order)
+    """
+
+    def __init__(self, num_videos, batch_size, shuffle=True, num_replicas=1, rank=0, seed=0, lengths=None):
+        self.num_videos = num_videos
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.num_samples = int(np.ceil(num_videos * 1.0 / num_replicas))
+        self.epoch = 0
+        self.start = 0
+
+    def set_position(self, epoch, start):
+        self.epoch = epoch
+        self.start = start
+
+    def epoch_order(self, epoch):
+        if self.shuffle:
+            order = np.random.RandomState(self.seed + epoch).permutation(self.num_videos)
+        else:
+            order = np.arange(self.num_videos)
+        order = np.concatenate([order, order[:self.num_samples * self.num_replicas - self.num_videos]])
+        order = order[self.rank::self.num_replicas]
+        if self.shuffle and self.lengths is not None:
+            order = bucket_order(order, self.lengths, self.batch_size, np.random.RandomState(self.seed + epoch))
+        return order
+
+    def __iter__(self):
+        epoch, start = self.epoch, self.start
+        batch = []
+        while True:
+            for idx in self.epoch_order(epoch)[start:]:
+                batch.append(int(idx))
+                if len(batch) == self.batch_size:
+                    yield batch
+                    batch = []
+            epoch += 1
+            start = 0
+
+
+class VideoDataLoader():
+    """
+    Drop-in replacement for DataLoader that builds batches with torch.utils.data.DataLoader worker processes
+    Extra options: num_workers, num_replicas and rank (to shard the videos across processes)
+    """
+
+    def __init__(self, opt):
+        self.iterator = 0
+        self.epoch = 0
+        self.batch_size = opt.get('batch_size', 128)
+        self.mode = opt.get('mode', 'train')
+
+        self.dataset = VideoDataset(opt)
+        self.has_label = self.dataset.has_label
+        self.cocofmt_file = self.dataset.cocofmt_file
+
+        num_workers = opt.get('num_workers', 2)
+        self.batch_sampler = EpochBatchSampler(self.dataset.num_videos, self.batch_size,
+                                               shuffle=self.mode == 'train' or self.mode == 'val',
+                                               num_replicas=opt.get('num_replicas', 1), rank=opt.get('rank', 0),
+                                               seed=opt.get('seed', np.random.randint(2 ** 31 - 1)),
+                                               lengths=self.dataset.caption_lengths if self.has_label else None)
+        self.num_videos = self.batch_sampler.num_samples
+        loader_kwargs = {}
+        if num_workers > 0:
+            loader_kwargs['persistent_workers'] = True
+            if opt.get('prefetch', 0) > 0:
+                loader_kwargs['prefetch_factor'] = opt['prefetch']
+        self.loader = torch.utils.data.DataLoader(self.dataset, batch_sampler=self.batch_sampler,
+                                                  num_workers=num_workers, collate_fn=collate_batch,
+                                                  pin_memory=torch.cuda.is_available(), **loader_kwargs)
+        self._batches = None
+
+    def get_batch(self):
+        if self._batches is None:
+            self.batch_sampler.set_position(self.epoch, self.iterator)
+            self._batches = iter(self.loader)
+        data = next(self._batches)
+
+        self.iterator += self.batch_size
+        while self.iterator >= self.num_videos:
+            logger.info('===> Finished loading epoch %d', self.epoch)
+            self.iterator -= self.num_videos
+            self.epoch += 1
+        return data
+
+    def _restart(self):
+        """Discard batches the workers built ahead of a position change"""
+        self._batches = None
+
+    def close(self):
+        self._restart()
+
+    def reset(self):
+        self._restart()
+        self.iterator = 0
+
+    def get_current_index(self):
+        return self.iterator
+
+    def set_current_index(self, index):
+        self._restart()
+        self.iterator = index
+
+    def get_current_epoch(self):
+        return self.epoch
+
+    def set_current_epoch(self, epoch):
+        self._restart()
+        self.epoch = epoch
+
+    def get_vocab(self):
+        return self.dataset.ix_to_word
+
+    def get_vocab_size(self):
+        return len(self.dataset.vocab)
+
+    def get_feat_dims(self):
+        return self.dataset.feat_dims
+
+    def get_bfeat_dims(self):
+        return self.dataset.bfeat_dims
+
+    def get_feat_size(self):
+        return sum(self.dataset.feat_dims)
+
+    def get_num_feats(self):
+        return len(self.dataset.feat_dims)
+
+    def get_seq_length(self):
+        return self.dataset.seq_length
+
+    def get_svo_length(self):
+        return self.dataset.svo_length
+
+    def get_seq_per_img(self):
+        return self.dataset.seq_per_img
+
+    def get_num_videos(self):
+        return self.num_videos
+
+    def get_batch_size(self):
+        return self.batch_size
+
+    def get_cocofmt_file(self):
+        return self.cocofmt_file